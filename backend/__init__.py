@@ -2,9 +2,24 @@
 Backend applicativo Studio Medico.
 
 Struttura:
-- db.py       : engine e sessioni SQLAlchemy
+- db.py       : engine e sessioni SQLAlchemy (scrittura + pool di sola lettura)
 - models.py   : modelli ORM e enum
 - services.py : logica di dominio (prenotazioni, agenda, lista d'attesa, notifiche)
 - seed.py     : dati iniziali (medici, sale, tipi visita)
 - cli.py      : simulazione applicativi esterni via CLI
+- api_responses.py : serializzazione risposte API (orjson, colonnare, MessagePack, ETag, compressione)
+- sale.py     : assegnazione automatica delle sale (bitset attrezzature, scelta best fit)
+- versioni.py : contatori di modifica per tabella (ETag) e invalidazione delle cache tra processi
+- write_queue.py : coda di scrittura opzionale con group commit
+- calendario.py : calendario compilato dei medici (orari settimanali, ferie, chiusure) con cache
+- disponibilita.py : calcoli su intervalli (occupati, orari settimanali dei medici, alternative vicine)
+- archivio.py : archivio storico in un DB collegato (ATTACH), job di spostamento e letture su entrambi
+- manutenzione.py : manutenzione online dei DB (optimize, incremental vacuum, checkpoint) e backup a caldo
+- deduplica.py : unione dei pazienti duplicati (stessa chiave normalizzata)
+- idempotenza.py : header Idempotency-Key per i POST che creano prenotazioni e pazienti
+- limiti.py   : middleware di rate limiting (token bucket per IP e globali) e tetto di concorrenza
+- eventi.py   : registro append-only delle modifiche (change feed con cursore since)
+- pubsub.py   : pub/sub in processo (eventi pubblicati al commit) per gli stream SSE di agenda e notifiche
+- jobs.py     : job periodici dell'API (promemoria, completamento appuntamenti) con lease per worker
+- waitlist.py : motore lista d'attesa (heap per medico, riempimento intervalli liberati)
 """
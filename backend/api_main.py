@@ -1,25 +1,46 @@
 from __future__ import annotations
 
-from datetime import date, datetime
-from typing import Any
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import Any, AsyncIterator
 
-from fastapi import Depends, FastAPI, HTTPException, Query, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, status
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, Field
 
 from backend.services import (
+    _crea_paziente,
+    _prenota_appuntamento,
+    _trova_o_crea_paziente,
+    aggiungi_eccezione,
     agenda_giornaliera_flat,
-    crea_paziente,
+    calendario_medico_flat,
     estrai_notifiche_pendenti,
+    heatmap_disponibilita,
+    imposta_orari_medico,
     init_db,
     lista_medici_flat,
     lista_pazienti_flat,
     lista_sale_flat,
     lista_tipi_visita_flat,
-    prenota_appuntamento,
-    notifiche_pendenti_flat
+    prenota_serie,
+    prime_disponibilita,
+    notifiche_pendenti_flat,
+    registra_assenza_medico,
+    rimuovi_eccezione,
+    storico_paziente_flat,
 )
+from backend.eventi import MAX_LIMIT as MAX_LIMIT_EVENTI, modifiche_flat
+from backend.idempotenza import esegui_idempotente
+from backend.jobs import crea_runner, stato_jobs_flat
+from backend.limiti import LIMITI_ATTIVI, LimiteRichieste
+from backend.models import FrequenzaSerie
+from backend.pubsub import CANALE_AGENDA, CANALE_NOTIFICHE, flusso_sse
 from backend.seed import seed_base
+from backend.versioni import SINCRONIZZAZIONE_SECONDI, sincronizza_periodicamente
+from backend.api_responses import FastJSONResponse, rispondi_lista
 
 # Import per registrare le tabelle Auth nel metadata
 from backend.auth_models import Utente  # noqa: F401
@@ -29,18 +50,39 @@ from backend.auth_security import create_access_token, get_subject
 # OAuth2 Bearer (Authorization: Bearer <token>)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
-app = FastAPI(title="Studio Medico API", version="1.0.0")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Crea tabelle (incluse Utente) e seed base (idempotente), poi avvia i job periodici
+    init_db()
+    seed_base()
+    runner = crea_runner()
+    await runner.avvia()
+    # modifiche fatte dagli altri worker: invalida le cache e avvisa gli stream SSE anche senza richieste
+    sincronizzazione = asyncio.create_task(sincronizza_periodicamente(SINCRONIZZAZIONE_SECONDI))
+    try:
+        yield
+    finally:
+        sincronizzazione.cancel()
+        await runner.ferma()
 
 
-# Startup
+app = FastAPI(
+    title="Studio Medico API",
+    version="1.0.0",
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan,
+)
 
-@app.on_event("startup")
-def startup() -> None:
-    # Crea tabelle (incluse Utente) e seed base (idempotente)
-    init_db()
-    seed_base()
+# Rate limiting e tetto di concorrenza su login e prenotazione pubblica
+if LIMITI_ATTIVI:
+    app.add_middleware(LimiteRichieste)
 
+# ?format=columns sugli endpoint lista: un array per campo invece di una lista di oggetti
+FORMATO_LISTA = Query(None, alias="format", pattern="^(rows|columns)$")
+
+# Header Idempotency-Key sui POST che creano dati: le ripetizioni ricevono la risposta della prima esecuzione
+IDEMPOTENCY_KEY = Header(None, alias="Idempotency-Key", max_length=200)
 
 
 # Schemi Auth
@@ -76,17 +118,30 @@ class AppuntamentoCreateIn(BaseModel):
     paziente_id: str
     medico_id: str
     tipo_visita_id: int
-    sala_id: int
+    sala_id: int | None = None  # None = assegnazione automatica (sala libera e attrezzata)
     start: datetime
     note: str | None = None
     inserisci_waitlist_se_pieno: bool = True
 
 
+class SerieCreateIn(BaseModel):
+    # serie ricorrente (es. settimanale per 12 settimane) per un paziente esistente
+    paziente_id: str
+    medico_id: str
+    tipo_visita_id: int
+    sala_id: int
+    primo_inizio: datetime
+    frequenza: FrequenzaSerie = FrequenzaSerie.SETTIMANALE
+    intervallo: int = Field(1, ge=1, le=52)
+    occorrenze: int = Field(..., ge=1, le=104)
+    note: str | None = None
+
+
 class PrenotazionePubblicaIn(BaseModel):
     # prenotazione “pubblica” (crea paziente al volo)
     medico_id: str
     tipo_visita_id: int
-    sala_id: int
+    sala_id: int | None = None  # None = assegnazione automatica (sala libera e attrezzata)
     start: datetime
     note: str | None = None
     inserisci_waitlist_se_pieno: bool = True
@@ -96,6 +151,38 @@ class PrenotazionePubblicaIn(BaseModel):
     cognome: str = Field(..., min_length=1)
     email: str | None = None
     telefono: str | None = None
+    codice_fiscale: str | None = Field(None, max_length=16)
+
+
+
+class AssenzaMedicoIn(BaseModel):
+    # annulla tutti gli appuntamenti del medico con inizio in [dal, al)
+    dal: datetime
+    al: datetime
+    motivo: str | None = None
+
+
+
+ORA_HHMM = r"^([01]\d|2[0-3]):[0-5]\d$"
+
+
+class FasciaOrariaIn(BaseModel):
+    giorno_settimana: int = Field(..., ge=0, le=6)  # 0=Lunedì ... 6=Domenica
+    ora_inizio: str = Field(..., pattern=ORA_HHMM)
+    ora_fine: str = Field(..., pattern=ORA_HHMM)
+
+
+class OrariMedicoIn(BaseModel):
+    # sostituisce tutti gli orari settimanali del medico (lista vuota = orario studio)
+    fasce: list[FasciaOrariaIn]
+
+
+class EccezioneIn(BaseModel):
+    # giorni di ferie del medico o, senza medico_id, chiusura dello studio (estremi inclusi)
+    medico_id: str | None = None
+    dal: date
+    al: date
+    motivo: str | None = None
 
 
 
@@ -151,96 +238,354 @@ def protected_ping(user: Utente = Depends(get_current_user)) -> dict[str, Any]:
 # PUBLIC endpoints (no JWT)
 
 @app.get("/api/medici")
-def api_medici() -> list[dict]:
-    return lista_medici_flat()
+def api_medici(request: Request, formato: str | None = FORMATO_LISTA) -> Response:
+    return rispondi_lista(request, lista_medici_flat, formato, tabelle=("medici",))
 
 
 @app.get("/api/sale")
-def api_sale() -> list[dict]:
-    return lista_sale_flat()
+def api_sale(request: Request, formato: str | None = FORMATO_LISTA) -> Response:
+    return rispondi_lista(request, lista_sale_flat, formato, tabelle=("sale_visita",))
 
 
 @app.get("/api/tipi-visita")
-def api_tipi_visita() -> list[dict]:
-    return lista_tipi_visita_flat()
+def api_tipi_visita(request: Request, formato: str | None = FORMATO_LISTA) -> Response:
+    return rispondi_lista(request, lista_tipi_visita_flat, formato, tabelle=("tipi_visita",))
+
+
+@app.get("/api/disponibilita/heatmap")
+def api_heatmap_disponibilita(
+    request: Request,
+    settimana: date = Query(..., description="Un giorno qualsiasi della prima settimana (si parte dal lunedì)"),
+    giorni: int = Query(7, ge=1, le=31),
+    medico_id: str | None = Query(None, description="Se assente: tutti i medici attivi"),
+    sale: bool = False,
+    slot: bool = False,
+) -> Response:
+    # solo libero/occupato aggregato: nessun dato paziente, quindi pubblico come i lookup del form
+    lunedi = settimana - timedelta(days=settimana.weekday())
+
+    def _calcola() -> dict[str, Any]:
+        dati = heatmap_disponibilita(lunedi, giorni, medico_id, includi_sale=sale, includi_slot=slot)
+        if dati is None:
+            raise HTTPException(status_code=404, detail="Medico non trovato")
+        return dati
+
+    return rispondi_lista(request, _calcola, tabelle=("appuntamenti", "medici", "sale_visita", "disponibilita"))
+
+
+@app.get("/api/disponibilita/prima")
+def api_prima_disponibilita(
+    request: Request,
+    specializzazione: str = Query(..., min_length=1),
+    tipo_visita_id: int = Query(...),
+    dal: datetime | None = Query(None, description="Default: adesso"),
+    k: int = Query(5, ge=1, le=50),
+    giorni: int = Query(30, ge=1, le=180),
+    formato: str | None = FORMATO_LISTA,
+) -> Response:
+    # primo medico disponibile di una specializzazione (pubblico, come la heatmap)
+    inizio = dal or datetime.now().replace(second=0, microsecond=0)
+
+    def _calcola() -> list[dict]:
+        opzioni = prime_disponibilita(specializzazione, tipo_visita_id, inizio, k=k, giorni=giorni)
+        if opzioni is None:
+            raise HTTPException(status_code=404, detail="Tipo visita non valido")
+        return opzioni
+
+    # senza `dal` il risultato dipende dall'ora corrente: niente ETag
+    tabelle = ("appuntamenti", "medici", "sale_visita", "tipi_visita", "disponibilita") if dal else ()
+    return rispondi_lista(request, _calcola, formato, tabelle=tabelle)
 
 
 @app.post("/api/public/prenotazioni")
-def prenotazione_pubblica(payload: PrenotazionePubblicaIn) -> dict[str, Any]:
+def prenotazione_pubblica(
+    payload: PrenotazionePubblicaIn, response: Response, idempotency_key: str | None = IDEMPOTENCY_KEY
+) -> dict[str, Any]:
     """
     Prenotazione senza login:
-    - crea un paziente al volo
+    - riconosce il paziente già registrato (codice fiscale e nome, o nome + email/telefono), altrimenti lo crea
     - prova a prenotare l’appuntamento
     """
-    paziente_id = crea_paziente(
-        payload.nome,
-        payload.cognome,
-        payload.email,
-        payload.telefono,
+    def _prenota(s) -> dict[str, Any]:
+        # l'id e l'esito della ricerca del paziente non vengono restituiti: il chiamante non è autenticato
+        paziente_id, _creato = _trova_o_crea_paziente(
+            s,
+            payload.nome,
+            payload.cognome,
+            payload.email,
+            payload.telefono,
+            payload.codice_fiscale,
+            completa_cf=False,  # un paziente esistente senza codice fiscale lo completa il personale
+        )
+
+        esito = _prenota_appuntamento(
+            s,
+            paziente_id=paziente_id,
+            medico_id=payload.medico_id,
+            tipo_visita_id=payload.tipo_visita_id,
+            sala_id=payload.sala_id,
+            start=payload.start,
+            note=payload.note,
+            inserisci_waitlist_se_pieno=payload.inserisci_waitlist_se_pieno,
+        )
+
+        return {
+            "ok": bool(getattr(esito, "ok", False)),
+            "messaggio": getattr(esito, "messaggio", ""),
+            "appuntamento_id": getattr(esito, "appuntamento_id", None),
+            "messo_in_waitlist": bool(getattr(esito, "messo_in_waitlist", False)),
+            "sala_id": getattr(esito, "sala_id", None),
+        }
+
+    return esegui_idempotente(
+        idempotency_key, "POST /api/public/prenotazioni", payload.model_dump(mode="json"), response, _prenota
     )
 
-    esito = prenota_appuntamento(
-        paziente_id=paziente_id,
-        medico_id=payload.medico_id,
-        tipo_visita_id=payload.tipo_visita_id,
-        sala_id=payload.sala_id,
-        start=payload.start,
-        note=payload.note,
-        inserisci_waitlist_se_pieno=payload.inserisci_waitlist_se_pieno,
-    )
-
-    return {
-        "ok": bool(getattr(esito, "ok", False)),
-        "messaggio": getattr(esito, "messaggio", ""),
-        "appuntamento_id": getattr(esito, "appuntamento_id", None),
-        "messo_in_waitlist": bool(getattr(esito, "messo_in_waitlist", False)),
-        "paziente_id": paziente_id,
-    }
-
 
 
 # PROTECTED endpoints (JWT)
 
 @app.get("/api/pazienti")
-def api_pazienti(user: Utente = Depends(get_current_user)) -> list[dict]:
-    return lista_pazienti_flat()
+def api_pazienti(
+    request: Request,
+    limit: int | None = Query(None, ge=1),
+    offset: int = Query(0, ge=0),
+    formato: str | None = FORMATO_LISTA,
+    user: Utente = Depends(get_current_user),
+) -> Response:
+    return rispondi_lista(
+        request,
+        lambda: lista_pazienti_flat(limit=limit, offset=offset),
+        formato,
+        tabelle=("pazienti",),
+    )
+
+
+@app.get("/api/pazienti/{paziente_id}/appuntamenti")
+def api_storico_paziente(
+    request: Request,
+    paziente_id: str,
+    limit: int | None = Query(None, ge=1),
+    offset: int = Query(0, ge=0),
+    formato: str | None = FORMATO_LISTA,
+    user: Utente = Depends(get_current_user),
+) -> Response:
+    def _storico() -> list[dict[str, Any]]:
+        righe = storico_paziente_flat(paziente_id, limit=limit, offset=offset)
+        if righe is None:
+            raise HTTPException(status_code=404, detail="Paziente non trovato")
+        return righe
+
+    return rispondi_lista(request, _storico, formato, tabelle=("appuntamenti", "pazienti", "medici"))
 
 
 @app.post("/api/pazienti")
-def api_crea_paziente(payload: PazienteCreateIn, user: Utente = Depends(get_current_user)) -> dict[str, Any]:
-    pid = crea_paziente(payload.nome, payload.cognome, payload.email, payload.telefono)
-    return {"ok": True, "paziente_id": pid}
+def api_crea_paziente(
+    payload: PazienteCreateIn,
+    response: Response,
+    idempotency_key: str | None = IDEMPOTENCY_KEY,
+    user: Utente = Depends(get_current_user),
+) -> dict[str, Any]:
+    def _crea(s) -> dict[str, Any]:
+        pid = _crea_paziente(s, payload.nome, payload.cognome, payload.email, payload.telefono)
+        return {"ok": True, "paziente_id": pid}
+
+    return esegui_idempotente(
+        idempotency_key, f"POST /api/pazienti:{user.id}", payload.model_dump(mode="json"), response, _crea
+    )
 
 
 @app.post("/api/appuntamenti")
-def api_crea_appuntamento(payload: AppuntamentoCreateIn, user: Utente = Depends(get_current_user)) -> dict[str, Any]:
-    esito = prenota_appuntamento(
+def api_crea_appuntamento(
+    payload: AppuntamentoCreateIn,
+    response: Response,
+    idempotency_key: str | None = IDEMPOTENCY_KEY,
+    user: Utente = Depends(get_current_user),
+) -> dict[str, Any]:
+    def _prenota(s) -> dict[str, Any]:
+        esito = _prenota_appuntamento(
+            s,
+            paziente_id=payload.paziente_id,
+            medico_id=payload.medico_id,
+            tipo_visita_id=payload.tipo_visita_id,
+            sala_id=payload.sala_id,
+            start=payload.start,
+            note=payload.note,
+            inserisci_waitlist_se_pieno=payload.inserisci_waitlist_se_pieno,
+        )
+
+        return {
+            "ok": bool(getattr(esito, "ok", False)),
+            "messaggio": getattr(esito, "messaggio", ""),
+            "appuntamento_id": getattr(esito, "appuntamento_id", None),
+            "messo_in_waitlist": bool(getattr(esito, "messo_in_waitlist", False)),
+            "sala_id": getattr(esito, "sala_id", None),
+        }
+
+    return esegui_idempotente(
+        idempotency_key, f"POST /api/appuntamenti:{user.id}", payload.model_dump(mode="json"), response, _prenota
+    )
+
+
+@app.post("/api/appuntamenti/serie")
+def api_crea_serie(payload: SerieCreateIn, user: Utente = Depends(get_current_user)) -> dict[str, Any]:
+    esito = prenota_serie(
         paziente_id=payload.paziente_id,
         medico_id=payload.medico_id,
         tipo_visita_id=payload.tipo_visita_id,
         sala_id=payload.sala_id,
-        start=payload.start,
+        primo_inizio=payload.primo_inizio,
+        occorrenze=payload.occorrenze,
+        frequenza=payload.frequenza,
+        intervallo=payload.intervallo,
         note=payload.note,
-        inserisci_waitlist_se_pieno=payload.inserisci_waitlist_se_pieno,
     )
 
     return {
-        "ok": bool(getattr(esito, "ok", False)),
-        "messaggio": getattr(esito, "messaggio", ""),
-        "appuntamento_id": getattr(esito, "appuntamento_id", None),
-        "messo_in_waitlist": bool(getattr(esito, "messo_in_waitlist", False)),
+        "ok": esito.ok,
+        "messaggio": esito.messaggio,
+        "serie_id": esito.serie_id,
+        "prenotati": esito.prenotati,
+        "conflitti": [
+            {"inizio": c.inizio, "motivo": c.motivo, "alternative": list(c.alternative)}
+            for c in esito.conflitti
+        ],
     }
 
 
 @app.get("/api/agenda")
 def api_agenda(
+    request: Request,
     medico_id: str = Query(...),
     giorno: date = Query(...),
+    formato: str | None = FORMATO_LISTA,
     user: Utente = Depends(get_current_user),
-) -> list[dict]:
-    return agenda_giornaliera_flat(medico_id, giorno)
+) -> Response:
+    return rispondi_lista(
+        request,
+        lambda: agenda_giornaliera_flat(medico_id, giorno),
+        formato,
+        tabelle=("appuntamenti", "sale_visita", "tipi_visita"),
+    )
 
 
 @app.get("/api/notifiche/pendenti")
-def api_notifiche_pendenti(limit: int = 200, user=Depends(get_current_user)) -> list[dict]:
-    return notifiche_pendenti_flat(limit=limit)
\ No newline at end of file
+def api_notifiche_pendenti(
+    request: Request,
+    limit: int = 200,
+    offset: int = Query(0, ge=0),
+    formato: str | None = FORMATO_LISTA,
+    user=Depends(get_current_user),
+) -> Response:
+    return rispondi_lista(
+        request,
+        lambda: notifiche_pendenti_flat(limit=limit, offset=offset),
+        formato,
+        tabelle=("notifiche", "appuntamenti", "pazienti"),
+    )
+
+
+# Stream SSE (text/event-stream): una riga "data:" JSON per modifica, "ricarica" = rileggere la lista
+
+def _risposta_sse(request: Request, canale: str, filtro, last_event_id: str | None) -> StreamingResponse:
+    return StreamingResponse(
+        flusso_sse(request, canale, filtro, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/stream/agenda")
+def api_stream_agenda(
+    request: Request,
+    medico_id: str | None = None,
+    giorno: date | None = None,
+    last_event_id: str | None = Header(None, alias="Last-Event-ID"),
+    user: Utente = Depends(get_current_user),
+) -> StreamingResponse:
+    def filtro(dati: dict[str, Any]) -> bool:
+        return (medico_id is None or dati["medico_id"] == medico_id) and (
+            giorno is None or dati["giorno"] == giorno.isoformat()
+        )
+
+    return _risposta_sse(request, CANALE_AGENDA, filtro, last_event_id)
+
+
+@app.get("/api/stream/notifiche")
+def api_stream_notifiche(
+    request: Request,
+    last_event_id: str | None = Header(None, alias="Last-Event-ID"),
+    user: Utente = Depends(get_current_user),
+) -> StreamingResponse:
+    return _risposta_sse(request, CANALE_NOTIFICHE, lambda _dati: True, last_event_id)
+
+
+@app.get("/api/medici/{medico_id}/orari")
+def api_orari_medico(medico_id: str, user: Utente = Depends(get_current_user)) -> dict[str, Any]:
+    dati = calendario_medico_flat(medico_id)
+    if dati is None:
+        raise HTTPException(status_code=404, detail="Medico non trovato")
+    return dati
+
+
+@app.put("/api/medici/{medico_id}/orari")
+def api_imposta_orari_medico(
+    medico_id: str, payload: OrariMedicoIn, user: Utente = Depends(get_current_user)
+) -> dict[str, Any]:
+    if any(f.ora_fine <= f.ora_inizio for f in payload.fasce):
+        raise HTTPException(status_code=400, detail="Fascia non valida: 'ora_fine' deve essere successiva a 'ora_inizio'.")
+
+    fasce = [(f.giorno_settimana, f.ora_inizio, f.ora_fine) for f in payload.fasce]
+    if not imposta_orari_medico(medico_id, fasce):
+        raise HTTPException(status_code=404, detail="Medico non trovato")
+    return {"ok": True, "fasce": len(fasce)}
+
+
+@app.post("/api/eccezioni")
+def api_aggiungi_eccezione(payload: EccezioneIn, user: Utente = Depends(get_current_user)) -> dict[str, Any]:
+    if payload.al < payload.dal:
+        raise HTTPException(status_code=400, detail="Intervallo non valido: 'al' non può precedere 'dal'.")
+
+    eccezione_id = aggiungi_eccezione(payload.dal, payload.al, payload.medico_id, payload.motivo)
+    if eccezione_id is None:
+        raise HTTPException(status_code=404, detail="Medico non trovato")
+    return {"ok": True, "eccezione_id": eccezione_id}
+
+
+@app.delete("/api/eccezioni/{eccezione_id}")
+def api_rimuovi_eccezione(eccezione_id: int, user: Utente = Depends(get_current_user)) -> dict[str, Any]:
+    if not rimuovi_eccezione(eccezione_id):
+        raise HTTPException(status_code=404, detail="Eccezione non trovata")
+    return {"ok": True}
+
+
+@app.get("/api/changes")
+def api_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=MAX_LIMIT_EVENTI),
+    entita: str | None = Query(None, pattern="^(appuntamento|paziente)$"),
+    user: Utente = Depends(get_current_user),
+) -> dict[str, Any]:
+    return modifiche_flat(since, limit, entita)
+
+
+@app.get("/api/jobs")
+def api_stato_jobs(user: Utente = Depends(get_current_user)) -> list[dict[str, Any]]:
+    # tempi, esito, checkpoint e titolare del lock dei job periodici
+    return stato_jobs_flat()
+
+
+@app.post("/api/medici/{medico_id}/assenze")
+def api_assenza_medico(medico_id: str, payload: AssenzaMedicoIn, user: Utente = Depends(get_current_user)) -> dict[str, Any]:
+    if payload.al <= payload.dal:
+        raise HTTPException(status_code=400, detail="Intervallo non valido: 'al' deve essere successivo a 'dal'.")
+
+    esito = registra_assenza_medico(medico_id, payload.dal, payload.al, payload.motivo)
+    if esito is None:
+        raise HTTPException(status_code=404, detail="Medico non trovato")
+
+    return {
+        "ok": True,
+        "annullati": esito.annullati,
+        "riassegnati_da_waitlist": esito.riassegnati_da_waitlist,
+    }
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+from typing import Any, Callable
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+from .versioni import versioni_condivise
+
+# Serializzazione delle risposte API.
+# - orjson se installato (molto più veloce di json, datetime nativi), altrimenti json standard
+# - liste grandi: formato colonnare opzionale (?format=columns, un array per campo)
+# - MessagePack su richiesta (Accept: application/x-msgpack), se il pacchetto msgpack è installato
+# - ETag dai contatori di modifica per tabella (If-None-Match -> 304 senza query né serializzazione)
+# - compressione brotli/gzip solo sopra una soglia di dimensione
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    brotli = None
+
+MSGPACK_MEDIA_TYPES = ("application/x-msgpack", "application/msgpack")
+COMPRESSIONE_MIN_BYTES = int(os.getenv("API_COMPRESSIONE_MIN_BYTES", "1024"))
+VARY = "Accept, Accept-Encoding, Authorization"
+
+
+def dumps_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serializzata con orjson (default_response_class dell'app)."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+
+def _colonne(righe: list[dict]) -> dict[str, Any]:
+    """[{a: 1, b: 2}, {a: 3, b: 4}] -> {"righe": 2, "colonne": {"a": [1, 3], "b": [2, 4]}}"""
+    campi = list(righe[0]) if righe else []
+    return {
+        "righe": len(righe),
+        "colonne": {c: [r[c] for r in righe] for c in campi},
+    }
+
+
+def _vuole_msgpack(request: Request) -> bool:
+    accept = request.headers.get("accept", "")
+    return msgpack is not None and any(mt in accept for mt in MSGPACK_MEDIA_TYPES)
+
+
+def etag_richiesta(request: Request, tabelle: tuple[str, ...]) -> str:
+    """
+    ETag debole: endpoint + parametri + formato richiesto + versioni delle tabelle lette (da versioni_tabelle:
+    lo stesso ETag vale per tutti i worker e dopo un riavvio).
+    """
+    base = "|".join(
+        [
+            request.url.path,
+            str(request.query_params),
+            request.headers.get("accept", ""),
+            ",".join(f"{t}={v}" for t, v in zip(tabelle, versioni_condivise(*tabelle))),
+        ]
+    )
+    return f'W/"{hashlib.blake2b(base.encode(), digest_size=12).hexdigest()}"'
+
+
+def _etag_corrisponde(request: Request, tag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    candidati = {c.strip() for c in inm.split(",")}
+    return "*" in candidati or tag in candidati or tag.removeprefix("W/") in candidati
+
+
+def _comprimi(request: Request, body: bytes, headers: dict[str, str]) -> bytes:
+    """Comprime solo le risposte abbastanza grandi da trarne vantaggio."""
+    if len(body) < COMPRESSIONE_MIN_BYTES:
+        return body
+
+    accept = request.headers.get("accept-encoding", "")
+    if brotli is not None and "br" in accept:
+        headers["Content-Encoding"] = "br"
+        return brotli.compress(body, quality=4)
+    if "gzip" in accept:
+        headers["Content-Encoding"] = "gzip"
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+
+def rispondi_lista(
+    request: Request,
+    righe: Callable[[], list[dict] | dict[str, Any]],
+    formato: str | None = None,
+    tabelle: tuple[str, ...] = (),
+) -> Response:
+    """
+    Risposta per endpoint che ritornano liste di record.
+    - righe: funzione che produce i record, chiamata solo se il client non ha già la versione corrente
+    - tabelle: tabelle lette dall'endpoint, per l'ETag (vuoto = nessun ETag)
+    - formato None/"rows": lista di oggetti (compatibile con i client esistenti), o l'oggetto così com'è
+    - formato "columns": un array per campo (payload più piccolo, niente chiavi ripetute)
+    - Accept: application/x-msgpack -> stesso contenuto codificato in MessagePack
+    """
+    headers = {"Vary": VARY}
+
+    if tabelle:
+        headers["ETag"] = etag_richiesta(request, tabelle)
+        if _etag_corrisponde(request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+
+    dati = righe()
+    content: Any = _colonne(dati) if formato == "columns" else dati
+
+    if _vuole_msgpack(request):
+        body = msgpack.packb(content, use_bin_type=True, default=str)
+        media_type = MSGPACK_MEDIA_TYPES[0]
+    else:
+        body = dumps_json(content)
+        media_type = "application/json"
+
+    return Response(_comprimi(request, body, headers), media_type=media_type, headers=headers)
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import math
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Index, MetaData, Table, and_, delete, exists, func, insert, select, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import FromClause, Select, Subquery
+
+from .db import ARCHIVIO_SCHEMA, engine
+from .models import Appuntamento, MetaVersione, Notifica, StatoAppuntamento
+from .versioni import incrementa
+from .write_queue import esegui_scrittura
+
+# Partizionamento caldo/freddo.
+# Le tabelle "calde" (appuntamenti, notifiche) restano piccole: il job sposta nell'archivio (file SQLite
+# collegato come schema "archivio", vedi db.py) gli appuntamenti COMPLETATI/ANNULLATI terminati da più di
+# ARCHIVIO_GIORNI giorni e le notifiche inviate da più di ARCHIVIO_GIORNI giorni il cui appuntamento è già
+# archiviato. Lo spostamento avviene a blocchi.
+# Le letture storiche (agenda, storico paziente, export) usano `appuntamenti_storico`, una union che copre
+# entrambi i database, solo quando l'archivio può contenere righe utili: la soglia dell'archivio (in
+# meta_versioni, aggiornata prima di ogni spostamento) è un istante prima del quale terminano tutti gli
+# appuntamenti archiviati, quindi agenda ed export da quella data in poi leggono solo la tabella calda.
+#
+# In WAL il COMMIT su due file non è atomico, quindi ogni blocco usa due transazioni: prima la copia
+# nell'archivio (INSERT OR REPLACE, ripetibile), poi la DELETE dalla tabella calda. Dopo un crash nel mezzo
+# una riga può trovarsi in entrambi i database, mai in nessuno: la union scarta la copia archiviata
+# finché la riga è ancora calda, e il giro successivo completa lo spostamento.
+
+ARCHIVIO_GIORNI = int(os.getenv("ARCHIVIO_GIORNI", "180"))
+ARCHIVIO_BATCH = 500
+SOGLIA_META = "archivio_soglia"  # in meta_versioni, secondi Unix
+
+_metadata = MetaData(schema=ARCHIVIO_SCHEMA)
+
+
+def _copia_tabella(origine: Table) -> Table:
+    """Stesse colonne della tabella calda, senza FK (i riferimenti restano nel DB principale) né vincoli."""
+    return Table(
+        origine.name,
+        _metadata,
+        *[Column(c.name, c.type.copy(), primary_key=c.primary_key, nullable=c.nullable) for c in origine.columns],
+    )
+
+
+appuntamenti_archivio = _copia_tabella(Appuntamento.__table__)
+notifiche_archivio = _copia_tabella(Notifica.__table__)
+
+Index("ix_arch_app_medico_inizio", appuntamenti_archivio.c.medico_id, appuntamenti_archivio.c.inizio)
+Index("ix_arch_app_paziente_inizio", appuntamenti_archivio.c.paziente_id, appuntamenti_archivio.c.inizio)
+Index("ix_arch_notifiche_appuntamento", notifiche_archivio.c.appuntamento_id)
+Index("ix_arch_notifiche_paziente", notifiche_archivio.c.paziente_id)
+
+
+def crea_archivio() -> None:
+    """Crea le tabelle dell'archivio e aggiunge le colonne nate dopo sulla tabella calda (chiamata da init_db)."""
+    _metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for tabella in _metadata.sorted_tables:
+            esistenti = {r[1] for r in conn.exec_driver_sql(f"PRAGMA {ARCHIVIO_SCHEMA}.table_info({tabella.name})")}
+            for c in tabella.columns:
+                if c.name not in esistenti:
+                    tipo = c.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {ARCHIVIO_SCHEMA}.{tabella.name} ADD COLUMN {c.name} {tipo}")
+        # archivi creati prima della soglia: la ricavo dagli appuntamenti già archiviati (una volta sola)
+        if conn.scalar(select(MetaVersione.valore).where(MetaVersione.chiave == SOGLIA_META)) is None:
+            fine_max = conn.scalar(select(func.max(appuntamenti_archivio.c.fine)))
+            if fine_max is not None:
+                _salva_soglia(conn, fine_max)
+
+
+def _salva_soglia(conn, soglia: datetime) -> None:
+    """Alza la soglia dell'archivio (non la abbassa mai: restano archiviati gli appuntamenti già spostati)."""
+    valore = math.ceil(soglia.timestamp())
+    stmt = sqlite_insert(MetaVersione).values(chiave=SOGLIA_META, valore=valore)
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[MetaVersione.chiave], set_={"valore": func.max(MetaVersione.valore, stmt.excluded.valore)}
+        )
+    )
+
+
+def soglia_archivio(s: Session) -> datetime | None:
+    """Tutti gli appuntamenti archiviati terminano prima di questo istante (None = archivio vuoto)."""
+    valore = s.scalar(select(MetaVersione.valore).where(MetaVersione.chiave == SOGLIA_META))
+    return datetime.fromtimestamp(valore) if valore is not None else None
+
+
+def appuntamenti_storico() -> Subquery:
+    """Appuntamenti caldi + archiviati (stesse colonne di Appuntamento)."""
+    return union_all(
+        select(*Appuntamento.__table__.columns),
+        select(*appuntamenti_archivio.columns).where(appuntamenti_archivio.c.id.not_in(select(Appuntamento.id))),
+    ).subquery("appuntamenti_storico")
+
+
+def appuntamenti_dal(s: Session, dal: datetime) -> FromClause:
+    """Da dove leggere gli appuntamenti con inizio >= dal: solo la tabella calda se l'archivio non arriva a dal."""
+    soglia = soglia_archivio(s)
+    return Appuntamento.__table__ if soglia is None or dal >= soglia else appuntamenti_storico()
+
+
+def appuntamenti_paziente(s: Session, paziente_id: str) -> FromClause:
+    """Da dove leggere gli appuntamenti del paziente: la union solo se ne ha di archiviati (indice paziente_id)."""
+    archiviati = s.scalar(select(exists().where(appuntamenti_archivio.c.paziente_id == paziente_id)))
+    return appuntamenti_storico() if archiviati else Appuntamento.__table__
+
+
+def archivia(giorni: int = ARCHIVIO_GIORNI, batch: int = ARCHIVIO_BATCH, ora: datetime | None = None) -> int:
+    """
+    Job: sposta nell'archivio appuntamenti chiusi e notifiche inviate più vecchi di `giorni`.
+    Ritorna il numero di righe spostate (appuntamenti + notifiche).
+    """
+    soglia = (ora or datetime.now()) - timedelta(days=giorni)
+    # prima di spostare qualunque riga: le letture da soglia in poi smettono di consultare l'archivio
+    esegui_scrittura(lambda s: _salva_soglia(s, soglia))
+    totale = 0
+    # prima gli appuntamenti: le loro notifiche diventano archiviabili solo dopo
+    for da_archiviare, calda, fredda in (
+        (_appuntamenti_da_archiviare, Appuntamento.__table__, appuntamenti_archivio),
+        (_notifiche_da_archiviare, Notifica.__table__, notifiche_archivio),
+    ):
+        while True:
+            ids = esegui_scrittura(_copia_in_archivio, da_archiviare(soglia).limit(batch), calda, fredda)
+            if ids:
+                esegui_scrittura(_elimina_archiviati, calda, ids)
+            totale += len(ids)
+            if len(ids) < batch:
+                break
+    return totale
+
+
+def _copia_in_archivio(s, da_archiviare: Select, calda: Table, fredda: Table) -> list:
+    ids = list(s.scalars(da_archiviare))
+    if ids:
+        s.execute(
+            insert(fredda).prefix_with("OR REPLACE").from_select(
+                [c.name for c in calda.columns], select(*calda.columns).where(calda.c.id.in_(ids))
+            )
+        )
+    return ids
+
+
+def _elimina_archiviati(s, calda: Table, ids: list) -> None:
+    s.execute(delete(calda).where(calda.c.id.in_(ids)))
+    incrementa(s, calda.name)
+
+
+def _appuntamenti_da_archiviare(soglia: datetime) -> Select:
+    return select(Appuntamento.id).where(
+        and_(
+            Appuntamento.stato.in_([StatoAppuntamento.COMPLETATO, StatoAppuntamento.ANNULLATO]),
+            Appuntamento.fine < soglia,
+        )
+    )
+
+
+def _notifiche_da_archiviare(soglia: datetime) -> Select:
+    return select(Notifica.id).where(
+        and_(
+            Notifica.inviata_il < soglia,
+            ~exists().where(Appuntamento.id == Notifica.appuntamento_id),
+            # l'id più alto resta: senza AUTOINCREMENT SQLite lo riassegnerebbe a una nuova notifica
+            Notifica.id < select(func.max(Notifica.id)).scalar_subquery(),
+        )
+    )
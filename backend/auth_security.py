@@ -2,28 +2,38 @@ from __future__ import annotations
 
 import os
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Any
 
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+# jose, passlib e dotenv vengono importati al primo utilizzo:
+# l'import di backend.api_main (avvio worker) resta leggero.
 
-from dotenv import load_dotenv
-load_dotenv()
-
-# Da mettere in .env in produzione: 
-JWT_SECRET = os.getenv("JWT_SECRET", "CHANGE_ME_DEV_SECRET")
 JWT_ALG = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("JWT_EXPIRE_MINUTES", "60"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+@lru_cache(maxsize=1)
+def _config() -> tuple[str, int]:
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # Da mettere in .env in produzione:
+    jwt_secret = os.getenv("JWT_SECRET", "CHANGE_ME_DEV_SECRET")
+    expire_minutes = int(os.getenv("JWT_EXPIRE_MINUTES", "60"))
+    return jwt_secret, expire_minutes
+
+
+@lru_cache(maxsize=1)
+def _pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return _pwd_context().hash(password)
 
 
 def verify_password(password: str, password_hash: str) -> bool:
-    return pwd_context.verify(password, password_hash)
+    return _pwd_context().verify(password, password_hash)
 
 
 def create_access_token(subject: str, extra: dict[str, Any] | None = None) -> str:
@@ -31,8 +41,11 @@ def create_access_token(subject: str, extra: dict[str, Any] | None = None) -> st
     subject: tipicamente user_id (o username).
     Usa datetime timezone-aware per evitare offset/bug su timestamp.
     """
+    from jose import jwt
+
+    jwt_secret, expire_minutes = _config()
     now = datetime.now(timezone.utc)
-    expire = now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = now + timedelta(minutes=expire_minutes)
 
     payload: dict[str, Any] = {
         "sub": subject,
@@ -42,13 +55,18 @@ def create_access_token(subject: str, extra: dict[str, Any] | None = None) -> st
     if extra:
         payload.update(extra)
 
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALG)
+    return jwt.encode(payload, jwt_secret, algorithm=JWT_ALG)
 
 def decode_token(token: str) -> dict[str, Any]:
-    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+    from jose import jwt
+
+    jwt_secret, _ = _config()
+    return jwt.decode(token, jwt_secret, algorithms=[JWT_ALG])
 
 
 def get_subject(token: str) -> str | None:
+    from jose import JWTError
+
     try:
         payload = decode_token(token)
         return payload.get("sub")
@@ -1,10 +1,29 @@
 from __future__ import annotations
 
+import threading
+
 from sqlalchemy import select
 
 from backend.db import db_session
 from backend.auth_models import Utente
 from backend.auth_security import hash_password, verify_password
+from backend.versioni import incrementa, registra_invalidazione, sincronizza
+from backend.write_queue import esegui_scrittura
+
+# Utenti letti da get_current_user a ogni richiesta protetta: cache per id, svuotata quando la tabella
+# utenti cambia (anche da un altro worker, vedi versioni.py)
+MAX_UTENTI_IN_CACHE = 1000
+
+_utenti: dict[str, Utente | None] = {}
+_utenti_lock = threading.Lock()
+
+
+def _svuota_utenti() -> None:
+    with _utenti_lock:
+        _utenti.clear()
+
+
+registra_invalidazione(_svuota_utenti, "utenti")
 
 
 def crea_utente(username: str, password: str) -> str:
@@ -12,15 +31,20 @@ def crea_utente(username: str, password: str) -> str:
     if not username or not password:
         raise ValueError("Username e password sono obbligatori.")
 
-    with db_session() as s:
-        exists = s.execute(select(Utente).where(Utente.username == username)).scalar_one_or_none()
-        if exists:
-            raise ValueError("Username già registrato.")
+    # hash calcolato fuori dalla transazione: bcrypt è lento e non deve occupare il writer
+    return esegui_scrittura(_crea_utente, username, hash_password(password))
+
+
+def _crea_utente(s, username: str, password_hash: str) -> str:
+    exists = s.execute(select(Utente).where(Utente.username == username)).scalar_one_or_none()
+    if exists:
+        raise ValueError("Username già registrato.")
 
-        u = Utente(username=username, password_hash=hash_password(password), is_active=True)
-        s.add(u)
-        s.flush()
-        return u.id
+    u = Utente(username=username, password_hash=password_hash, is_active=True)
+    s.add(u)
+    s.flush()
+    incrementa(s, "utenti")
+    return u.id
 
 
 def autentica(username: str, password: str) -> Utente | None:
@@ -35,5 +59,14 @@ def autentica(username: str, password: str) -> Utente | None:
 
 
 def get_utente_by_id(user_id: str) -> Utente | None:
+    sincronizza()
+    with _utenti_lock:
+        if user_id in _utenti:
+            return _utenti[user_id]
     with db_session() as s:
-        return s.get(Utente, user_id)
+        u = s.get(Utente, user_id)
+    with _utenti_lock:
+        if len(_utenti) >= MAX_UTENTI_IN_CACHE:
+            _utenti.clear()
+        _utenti[user_id] = u
+    return u
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import threading
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .db import al_commit, al_rollback
+from .disponibilita import ORARIO_STUDIO, Intervallo, finestre_settimanali, hm_to_min, unisci
+from .models import EccezioneCalendario
+from .versioni import registra_invalidazione, sincronizza
+
+# Calendario compilato dei medici.
+# Orari settimanali (DisponibilitaMedico, "HH:MM") ed eccezioni (ferie, chiusure) vengono letti una volta
+# e trasformati in fasce in minuti dalla mezzanotte, già unite e ordinate, più l'insieme dei giorni chiusi:
+# il controllo di una prenotazione è un lookup + bisect, senza query né parsing di stringhe.
+# La cache si invalida quando una transazione che modifica orari o eccezioni fa COMMIT (o ROLLBACK),
+# anche in un altro processo (contatore "disponibilita", vedi versioni.py).
+
+Fasce = tuple[tuple[int, int], ...]
+
+MINUTI_STUDIO: Fasce = ((hm_to_min(ORARIO_STUDIO[0]), hm_to_min(ORARIO_STUDIO[1])),)
+
+
+@dataclass(frozen=True)
+class OrarioMedico:
+    # 7 giorni (0=Lunedì) di fasce in minuti; None = nessun orario configurato (vale l'orario studio)
+    settimana: tuple[Fasce, ...] | None
+    chiusure: frozenset[date]
+
+
+def _minuto(t: datetime, per_eccesso: bool = False) -> int:
+    m = t.hour * 60 + t.minute
+    if per_eccesso and (t.second or t.microsecond):
+        m += 1
+    return m
+
+
+class Calendario:
+    def __init__(self) -> None:
+        self._orari: dict[str, OrarioMedico] | None = None
+        self._chiusure_studio: frozenset[date] = frozenset()
+        self._generazione = 0
+        self._lock = threading.Lock()
+
+    def invalida(self) -> None:
+        with self._lock:
+            self._orari = None
+            self._generazione += 1
+
+    def segna_modifica(self, s: Session) -> None:
+        """Da chiamare nelle transazioni che scrivono orari o eccezioni."""
+        al_commit(s, self.invalida)
+        al_rollback(s, self.invalida)
+
+    def _carica(self, s: Session) -> tuple[dict[str, OrarioMedico], frozenset[date]]:
+        sincronizza()
+        with self._lock:
+            if self._orari is not None:
+                return self._orari, self._chiusure_studio
+            generazione = self._generazione
+
+        settimanali = finestre_settimanali(s, None)
+        chiusure: dict[str | None, set[date]] = {}
+        for medico_id, dal, al in s.execute(
+            select(EccezioneCalendario.medico_id, EccezioneCalendario.dal, EccezioneCalendario.al)
+        ):
+            giorni = chiusure.setdefault(medico_id, set())
+            for n in range((al - dal).days + 1):
+                giorni.add(dal + timedelta(days=n))
+
+        studio = frozenset(chiusure.pop(None, set()))
+        orari: dict[str, OrarioMedico] = {}
+        for medico_id in settimanali.keys() | chiusure.keys():
+            giorni = settimanali.get(medico_id)
+            settimana = None
+            if giorni is not None:
+                settimana = tuple(tuple(unisci(giorni.get(g, []))) for g in range(7))
+            orari[medico_id] = OrarioMedico(settimana, studio | chiusure.get(medico_id, set()))
+
+        with self._lock:
+            # una modifica arrivata durante il caricamento lo rende già vecchio: non lo salvo
+            if self._generazione == generazione:
+                self._orari, self._chiusure_studio = orari, studio
+        return orari, studio
+
+    def orario(self, s: Session, medico_id: str | None) -> OrarioMedico:
+        """Orario compilato del medico (medico_id None = studio: orario standard e sole chiusure generali)."""
+        orari, studio = self._carica(s)
+        if medico_id is not None and medico_id in orari:
+            return orari[medico_id]
+        return OrarioMedico(None, studio)
+
+    @staticmethod
+    def _fasce(o: OrarioMedico, giorno: date) -> Fasce:
+        if giorno in o.chiusure:
+            return ()
+        return MINUTI_STUDIO if o.settimana is None else o.settimana[giorno.weekday()]
+
+    def disponibile(self, s: Session, medico_id: str, inizio: datetime, fine: datetime) -> bool:
+        """True se [inizio, fine) cade in un giorno non chiuso e dentro una fascia di lavoro del medico."""
+        giorno = inizio.date()
+        if fine.date() != giorno and fine != datetime.combine(giorno + timedelta(days=1), time.min):
+            return False  # nessuna fascia attraversa la mezzanotte
+
+        fasce = self._fasce(self.orario(s, medico_id), giorno)
+        a = _minuto(inizio)
+        b = 24 * 60 if fine.date() != giorno else _minuto(fine, per_eccesso=True)
+        i = bisect_right(fasce, (a, 24 * 60 + 1)) - 1
+        return i >= 0 and fasce[i][1] >= b
+
+    def finestre_giorno(self, s: Session, medico_id: str | None, giorno: date) -> list[Intervallo]:
+        """Fasce di lavoro del giorno come datetime (vuoto nei giorni chiusi; orario studio se non configurato)."""
+        fasce = self._fasce(self.orario(s, medico_id), giorno)
+        mezzanotte = datetime.combine(giorno, time.min)
+        return [(mezzanotte + timedelta(minutes=a), mezzanotte + timedelta(minutes=b)) for a, b in fasce]
+
+
+calendario = Calendario()
+registra_invalidazione(calendario.invalida, "disponibilita")
@@ -1,12 +1,31 @@
 from __future__ import annotations
 
 import argparse
+import csv
+import json
+import sys
 from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable
 
+from sqlalchemy import select
+
+from backend.archivio import ARCHIVIO_GIORNI, archivia
+from backend.deduplica import unisci_pazienti_duplicati
+from backend.db import SessionLocal, annulla_callback, segna_callback
+from backend.manutenzione import BACKUP_DIR, backup_db, manutenzione_db
+from backend.models import Notifica
 from backend.seed import seed_base
 from backend.services import (
+    PROMEMORIA_ORE_ANTICIPO,
+    _annulla_appuntamento,
+    _crea_paziente,
+    _marca_notifica_inviata,
+    _prenota_appuntamento,
     crea_paziente,
+    esporta_appuntamenti,
     estrai_notifiche_pendenti,
+    genera_promemoria,
     init_db,
     lista_medici_attivi,
     lista_pazienti,
@@ -15,6 +34,8 @@ from backend.services import (
     marca_notifica_inviata,
     prenota_appuntamento,
     annulla_appuntamento,
+    completa_appuntamenti_passati,
+    registra_assenza_medico,
 )
 
 
@@ -57,7 +78,7 @@ def cmd_book(args: argparse.Namespace) -> None:
     )
     print(esito.messaggio)
     if esito.appuntamento_id:
-        print(f"Appuntamento ID: {esito.appuntamento_id}")
+        print(f"Appuntamento ID: {esito.appuntamento_id} (sala {esito.sala_id})")
 
 
 def cmd_cancel(args: argparse.Namespace) -> None:
@@ -65,6 +86,17 @@ def cmd_cancel(args: argparse.Namespace) -> None:
     print("Annullato." if ok else "Non trovato / già annullato.")
 
 
+def cmd_absence(args: argparse.Namespace) -> None:
+    dal = datetime.fromisoformat(args.dal)
+    al = datetime.fromisoformat(args.al)
+    esito = registra_assenza_medico(args.medico_id, dal, al, motivo=args.motivo)
+    if esito is None:
+        print("Medico non trovato.")
+        return
+    print(f"Appuntamenti annullati: {esito.annullati}")
+    print(f"Riassegnati da lista d'attesa: {esito.riassegnati_da_waitlist}")
+
+
 def cmd_notifications(args: argparse.Namespace) -> None:
     """
     Simula un “Sistema Notifiche” esterno:
@@ -86,6 +118,167 @@ def cmd_notifications(args: argparse.Namespace) -> None:
         print("Notifiche marcate come inviate.")
 
 
+# Batch: comandi JSONL in un solo processo e una sola connessione
+
+def _batch_add_patient(s, c: dict) -> dict[str, Any]:
+    pid = _crea_paziente(s, c["nome"], c["cognome"], c.get("email"), c.get("telefono"))
+    return {"ok": True, "paziente_id": pid}
+
+
+def _batch_book(s, c: dict) -> dict[str, Any]:
+    esito = _prenota_appuntamento(
+        s,
+        paziente_id=c["paziente_id"],
+        medico_id=c["medico_id"],
+        tipo_visita_id=int(c["tipo_visita_id"]),
+        sala_id=int(c["sala_id"]) if c.get("sala_id") is not None else None,
+        start=datetime.fromisoformat(c["start"]),
+        note=c.get("note"),
+        inserisci_waitlist_se_pieno=not c.get("no_waitlist", False),
+    )
+    return {
+        "ok": esito.ok,
+        "messaggio": esito.messaggio,
+        "appuntamento_id": esito.appuntamento_id,
+        "messo_in_waitlist": esito.messo_in_waitlist,
+        "sala_id": esito.sala_id,
+    }
+
+
+def _batch_cancel(s, c: dict) -> dict[str, Any]:
+    return {"ok": _annulla_appuntamento(s, c["appuntamento_id"], motivo=c.get("motivo"))}
+
+
+def _batch_notifications(s, c: dict) -> dict[str, Any]:
+    q = select(Notifica).where(Notifica.inviata_il.is_(None)).order_by(Notifica.creata_il.asc()).limit(int(c.get("limit", 50)))
+    out = []
+    for n in s.scalars(q):
+        out.append({"id": n.id, "tipo": n.tipo.value, "creata_il": n.creata_il.isoformat(), "messaggio": n.messaggio})
+        if c.get("mark_sent"):
+            _marca_notifica_inviata(s, n.id)
+    return {"ok": True, "notifiche": out}
+
+
+BATCH_COMANDI: dict[str, Callable[[Any, dict], dict[str, Any]]] = {
+    "add-patient": _batch_add_patient,
+    "book": _batch_book,
+    "cancel": _batch_cancel,
+    "notifications": _batch_notifications,
+}
+
+
+def cmd_batch(args: argparse.Namespace) -> None:
+    """
+    Esegue una sequenza di comandi JSONL (uno per riga) in un'unica sessione:
+      {"cmd": "book", "paziente_id": "...", "medico_id": "...", "tipo_visita_id": 1, "sala_id": 1, "start": "2026-01-14T10:30"}
+    - ogni comando gira in un SAVEPOINT: un errore annulla solo quel comando
+    - COMMIT ogni --commit-every comandi (e alla fine)
+    - per ogni comando stampa una riga JSONL di esito (dopo il COMMIT che lo rende definitivo);
+      l'eventuale campo "id" del comando viene riportato nell'esito
+    """
+    sorgente = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+    s = SessionLocal()
+    in_sospeso: list[dict[str, Any]] = []
+
+    def commit() -> None:
+        s.commit()
+        for esito in in_sospeso:
+            print(json.dumps(esito, ensure_ascii=False, default=str))
+        in_sospeso.clear()
+        sys.stdout.flush()
+
+    try:
+        for riga_n, riga in enumerate(sorgente, start=1):
+            riga = riga.strip()
+            if not riga:
+                continue
+
+            esito: dict[str, Any] = {"riga": riga_n}
+            segno = segna_callback(s)
+            try:
+                comando = json.loads(riga)
+                if "id" in comando:
+                    esito["id"] = comando["id"]
+                fn = BATCH_COMANDI.get(comando.get("cmd"))
+                if fn is None:
+                    raise ValueError(f"Comando sconosciuto: {comando.get('cmd')!r}")
+                with s.begin_nested():
+                    esito.update(fn(s, comando))
+            except Exception as e:
+                annulla_callback(s, segno)
+                esito.update({"ok": False, "errore": f"{type(e).__name__}: {e}"})
+
+            in_sospeso.append(esito)
+            if len(in_sospeso) >= args.commit_every:
+                commit()
+
+        commit()
+    except Exception:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+        if sorgente is not sys.stdin:
+            sorgente.close()
+
+
+def cmd_reminders(args: argparse.Namespace) -> None:
+    """Job promemoria (idempotente: può essere schedulato ogni pochi minuti, es. da cron)."""
+    creati = genera_promemoria(ore_anticipo=args.ore)
+    print(f"Promemoria creati: {creati}")
+
+
+def cmd_complete_past(args: argparse.Namespace) -> None:
+    """Porta a COMPLETATO gli appuntamenti già terminati (lo stesso job che l'API esegue periodicamente)."""
+    completati = completa_appuntamenti_passati()
+    print(f"Appuntamenti completati: {completati}")
+
+
+def cmd_archive(args: argparse.Namespace) -> None:
+    """Sposta nell'archivio appuntamenti chiusi e notifiche inviate più vecchi di --giorni."""
+    spostati = archivia(giorni=args.giorni)
+    print(f"Righe archiviate: {spostati}")
+
+
+def cmd_export(args: argparse.Namespace) -> None:
+    """Export CSV degli appuntamenti (DB corrente + archivio)."""
+    righe = esporta_appuntamenti(datetime.fromisoformat(args.dal), datetime.fromisoformat(args.al))
+    destinazione = sys.stdout if args.file == "-" else open(args.file, "w", newline="", encoding="utf-8")
+    try:
+        writer = None
+        for riga in righe:
+            if writer is None:
+                writer = csv.DictWriter(destinazione, fieldnames=list(riga))
+                writer.writeheader()
+            writer.writerow(riga)
+    finally:
+        if destinazione is not sys.stdout:
+            destinazione.close()
+
+
+def cmd_maintenance(args: argparse.Namespace) -> None:
+    """Statistiche del planner, pagine libere e checkpoint del WAL (database e archivio)."""
+    for e in manutenzione_db(vacuum_completo=args.vacuum_completo):
+        stato_vacuum = "incrementale" if e.auto_vacuum_incrementale else "da convertire (--vacuum-completo)"
+        print(
+            f"{e.schema}: ANALYZE {'completo' if e.analizzato else 'optimize'} | "
+            f"pagine liberate {e.pagine_liberate} | auto_vacuum {stato_vacuum} | checkpoint {e.wal_checkpoint}"
+        )
+
+
+def cmd_backup(args: argparse.Namespace) -> None:
+    """Backup a caldo (backup API di SQLite) di database e archivio."""
+    for file in backup_db(Path(args.dir)):
+        print(f"Backup: {file}")
+
+
+def cmd_dedupe_patients(args: argparse.Namespace) -> None:
+    """Unisce i pazienti duplicati (stessa chiave normalizzata) spostando appuntamenti, lista d'attesa e notifiche."""
+    esito = unisci_pazienti_duplicati()
+    print(f"Gruppi di duplicati: {esito.gruppi}")
+    print(f"Pazienti rimossi: {esito.pazienti_rimossi}")
+
+
 def build_parser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(prog="studio_medico_cli", description="CLI Studio Medico (simulazione sistemi esterni)")
     sub = p.add_subparsers(required=True)
@@ -108,7 +301,7 @@ def build_parser() -> argparse.ArgumentParser:
     p_book.add_argument("--paziente-id", required=True)
     p_book.add_argument("--medico-id", required=True)
     p_book.add_argument("--tipo-visita-id", type=int, required=True)
-    p_book.add_argument("--sala-id", type=int, required=True)
+    p_book.add_argument("--sala-id", type=int, default=None, help="Se omessa: sala libera con le attrezzature richieste")
     p_book.add_argument("--start", required=True, help="ISO datetime es: 2026-01-14T10:30")
     p_book.add_argument("--note", default=None)
     p_book.add_argument("--no-waitlist", action="store_true", help="Se slot pieno, NON inserire in lista d'attesa")
@@ -119,11 +312,55 @@ def build_parser() -> argparse.ArgumentParser:
     p_cancel.add_argument("--motivo", default=None)
     p_cancel.set_defaults(func=cmd_cancel)
 
+    p_abs = sub.add_parser("absence", help="Assenza medico: annulla in blocco gli appuntamenti in un intervallo")
+    p_abs.add_argument("--medico-id", required=True)
+    p_abs.add_argument("--dal", required=True, help="ISO datetime es: 2026-01-14T08:00")
+    p_abs.add_argument("--al", required=True, help="ISO datetime (escluso) es: 2026-01-15T00:00")
+    p_abs.add_argument("--motivo", default=None)
+    p_abs.set_defaults(func=cmd_absence)
+
     p_not = sub.add_parser("notifications", help="Legge e invia notifiche pendenti (simulazione)")
     p_not.add_argument("--limit", type=int, default=50)
     p_not.add_argument("--mark-sent", action="store_true", help="Marca come inviate dopo averle stampate")
     p_not.set_defaults(func=cmd_notifications)
 
+    p_rem = sub.add_parser("reminders", help="Crea i promemoria per gli appuntamenti confermati delle prossime ore")
+    p_rem.add_argument("--ore", type=int, default=PROMEMORIA_ORE_ANTICIPO, help="Finestra in ore da adesso")
+    p_rem.set_defaults(func=cmd_reminders)
+
+    p_cp = sub.add_parser("complete-past", help="Segna come completati gli appuntamenti già terminati")
+    p_cp.set_defaults(func=cmd_complete_past)
+
+    p_arch = sub.add_parser("archive", help="Archivia appuntamenti chiusi e notifiche inviate più vecchi di N giorni")
+    p_arch.add_argument("--giorni", type=int, default=ARCHIVIO_GIORNI)
+    p_arch.set_defaults(func=cmd_archive)
+
+    p_exp = sub.add_parser("export", help="Export CSV degli appuntamenti, inclusi quelli archiviati")
+    p_exp.add_argument("--dal", required=True, help="ISO datetime es: 2025-01-01T00:00")
+    p_exp.add_argument("--al", required=True, help="ISO datetime (escluso)")
+    p_exp.add_argument("--file", default="-", help="File CSV di destinazione ('-' = stdout)")
+    p_exp.set_defaults(func=cmd_export)
+
+    p_mnt = sub.add_parser("maintenance", help="ANALYZE/optimize, incremental vacuum e checkpoint del WAL")
+    p_mnt.add_argument(
+        "--vacuum-completo",
+        action="store_true",
+        help="VACUUM completo (blocca le scritture): una tantum per attivare l'auto_vacuum incrementale sui DB esistenti",
+    )
+    p_mnt.set_defaults(func=cmd_maintenance)
+
+    p_bak = sub.add_parser("backup", help="Backup a caldo di database e archivio")
+    p_bak.add_argument("--dir", default=str(BACKUP_DIR), help="Cartella di destinazione")
+    p_bak.set_defaults(func=cmd_backup)
+
+    p_dd = sub.add_parser("dedupe-patients", help="Unisce i pazienti duplicati (una tantum)")
+    p_dd.set_defaults(func=cmd_dedupe_patients)
+
+    p_batch = sub.add_parser("batch", help="Esegue comandi JSONL (book, cancel, add-patient, notifications) in un solo processo")
+    p_batch.add_argument("--file", default="-", help="File JSONL dei comandi ('-' = stdin)")
+    p_batch.add_argument("--commit-every", type=int, default=500, help="COMMIT ogni N comandi")
+    p_batch.set_defaults(func=cmd_batch)
+
     return p
 
 
@@ -1,22 +1,52 @@
 from __future__ import annotations
 
+import os
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterator
+from typing import Callable, Iterator
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import DeclarativeBase, Session, sessionmaker
 
 # DB SQLite su file nella root del progetto (accanto a streamlit_app.py)
 DB_PATH = Path(__file__).resolve().parents[1] / "studio_medico.sqlite"
 DATABASE_URL = f"sqlite:///{DB_PATH}"
 
+# Archivio "freddo": appuntamenti chiusi e notifiche inviate ormai vecchi (vedi archivio.py),
+# in un secondo file SQLite collegato a ogni connessione con ATTACH come schema "archivio"
+ARCHIVIO_SCHEMA = "archivio"
+ARCHIVIO_PATH = Path(os.getenv("STUDIO_ARCHIVIO_PATH", str(DB_PATH.with_name("studio_medico_archivio.sqlite"))))
+
 engine = create_engine(
     DATABASE_URL,
     echo=False,              # True se si vuole vedere le query
     future=True,
 )
 
+
+# Transazioni gestite da SQLAlchemy (non dal driver sqlite3), così i SAVEPOINT
+# funzionano correttamente (ricetta ufficiale SQLAlchemy per pysqlite).
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_conn, _record) -> None:
+    dbapi_conn.isolation_level = None
+    # WAL: i lettori non bloccano il writer (e viceversa); l'impostazione resta salvata nel file
+    # auto_vacuum INCREMENTAL: vale subito per i file nuovi, per quelli esistenti dal primo VACUUM completo
+    # (vedi manutenzione.py); deve precedere journal_mode, che crea il file
+    dbapi_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    dbapi_conn.execute("PRAGMA journal_mode = WAL")
+    dbapi_conn.execute(f"ATTACH DATABASE ? AS {ARCHIVIO_SCHEMA}", (str(ARCHIVIO_PATH),))
+    dbapi_conn.execute(f"PRAGMA {ARCHIVIO_SCHEMA}.auto_vacuum = INCREMENTAL")
+    dbapi_conn.execute(f"PRAGMA {ARCHIVIO_SCHEMA}.journal_mode = WAL")
+
+
+@event.listens_for(engine, "begin")
+def _on_begin(conn) -> None:
+    # IMMEDIATE: il lock di scrittura si prende all'inizio (attesa fino al timeout del driver, 5 s), non al primo
+    # INSERT/UPDATE dopo le letture: in WAL quel passaggio fallisce subito con "database is locked" (SQLITE_BUSY_SNAPSHOT)
+    # se nel frattempo ha scritto un'altra connessione. Le sole letture passano da read_engine
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
 SessionLocal = sessionmaker(
     bind=engine,
     autoflush=False,
@@ -26,6 +56,84 @@ SessionLocal = sessionmaker(
 )
 
 
+# Engine di sola lettura (query "flat", report, export): pool separato e più ampio,
+# così le letture lunghe non contendono le connessioni delle transazioni di prenotazione.
+READ_DATABASE_URL = f"sqlite:///{DB_PATH.as_uri()}?mode=ro&uri=true"
+READ_POOL_SIZE = int(os.getenv("STUDIO_READ_POOL_SIZE", str(max(4, 2 * (os.cpu_count() or 2)))))
+
+read_engine = create_engine(
+    READ_DATABASE_URL,
+    echo=False,
+    future=True,
+    pool_size=READ_POOL_SIZE,
+    max_overflow=READ_POOL_SIZE,
+)
+
+
+@event.listens_for(read_engine, "connect")
+def _on_connect_read(dbapi_conn, _record) -> None:
+    # mode=ro non crea il file: se l'archivio non esiste ancora parto da un file vuoto (DB valido senza tabelle)
+    ARCHIVIO_PATH.touch(exist_ok=True)
+    dbapi_conn.execute(f"ATTACH DATABASE ? AS {ARCHIVIO_SCHEMA}", (f"{ARCHIVIO_PATH.as_uri()}?mode=ro",))
+    dbapi_conn.execute("PRAGMA query_only = ON")
+
+
+ReadSessionLocal = sessionmaker(
+    bind=read_engine,
+    autoflush=False,
+    autocommit=False,
+    future=True,
+    expire_on_commit=False
+)
+
+
+# Callback legati all'esito della transazione (es. strutture in memoria da aggiornare o invalidare).
+# Scattano solo sulla transazione esterna: i SAVEPOINT sono gestiti da chi li apre
+# (vedi segna_callback / annulla_callback).
+
+def al_commit(s: Session, fn: Callable[[], None]) -> None:
+    """Esegue fn dopo il COMMIT della transazione corrente (scartata in caso di rollback)."""
+    s.info.setdefault("al_commit", []).append(fn)
+
+
+def al_rollback(s: Session, fn: Callable[[], None]) -> None:
+    """Esegue fn dopo il ROLLBACK della transazione corrente (scartata in caso di commit)."""
+    s.info.setdefault("al_rollback", []).append(fn)
+
+
+def segna_callback(s: Session) -> tuple[int, int]:
+    """Punto di ripristino dei callback, da prendere prima di un SAVEPOINT."""
+    return len(s.info.get("al_commit", [])), len(s.info.get("al_rollback", []))
+
+
+def annulla_callback(s: Session, segno: tuple[int, int]) -> None:
+    """Dopo il rollback di un SAVEPOINT: esegue i suoi al_rollback e scarta i suoi al_commit."""
+    n_commit, n_rollback = segno
+    del s.info.get("al_commit", [])[n_commit:]
+    da_eseguire = s.info.get("al_rollback", [])[n_rollback:]
+    del s.info.get("al_rollback", [])[n_rollback:]
+    for fn in da_eseguire:
+        fn()
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _esegui_al_commit(s: Session) -> None:
+    if s.in_nested_transaction():
+        return
+    s.info.pop("al_rollback", None)
+    for fn in s.info.pop("al_commit", []):
+        fn()
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _esegui_al_rollback(s: Session) -> None:
+    if s.in_nested_transaction():
+        return
+    s.info.pop("al_commit", None)
+    for fn in s.info.pop("al_rollback", []):
+        fn()
+
+
 class Base(DeclarativeBase):
     """Base ORM per tutti i modelli."""
     pass
@@ -48,3 +156,14 @@ def db_session() -> Iterator[Session]:
         raise
     finally:
         session.close()
+
+
+@contextmanager
+def db_read_session() -> Iterator[Session]:
+    """Sessione di sola lettura sul pool dedicato (nessun commit: la connessione è query_only)."""
+    session: Session = ReadSessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
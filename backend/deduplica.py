@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+from sqlalchemy import Column, MetaData, String, Table, delete, insert, literal_column, or_, select, update
+
+from .archivio import appuntamenti_archivio, notifiche_archivio
+from .db import Base, al_commit, al_rollback, db_read_session
+from .eventi import registra_paziente, registra_unione
+from .models import Paziente
+from .versioni import incrementa
+from .waitlist import waitlist_engine
+from .write_queue import esegui_scrittura
+
+# Unione dei pazienti duplicati (stessa chiave_normalizzata o chiave_telefono, es. creati da prenotazioni
+# pubbliche ripetute). Per ogni gruppo resta il paziente registrato per primo (o quello con codice fiscale); i riferimenti dei
+# doppioni vengono spostati in blocco con un UPDATE ... FROM su una tabella temporanea doppione -> superstite.
+# Due pazienti con codici fiscali diversi restano distinti anche con la stessa chiave.
+# Prima si aggiorna l'archivio, poi (in un'altra transazione) le tabelle del DB principale e la DELETE dei
+# doppioni: un'interruzione nel mezzo lascia riferimenti a pazienti ancora esistenti, e si può rilanciare.
+
+_mappa = Table(
+    "_mappa_pazienti",
+    MetaData(),
+    Column("doppione", String(36), primary_key=True),
+    Column("superstite", String(36), nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+# Dati anagrafici che il superstite eredita dai doppioni se non li ha
+CAMPI_DA_COMPLETARE = ("data_nascita", "telefono", "email", "codice_fiscale")
+
+
+@dataclass(frozen=True)
+class EsitoDeduplica:
+    gruppi: int
+    pazienti_rimossi: int
+
+
+def _tabelle_con_paziente() -> list[Table]:
+    """Tabelle del DB principale con una FK verso pazienti.id."""
+    return [
+        t
+        for t in Base.metadata.sorted_tables
+        if t is not Paziente.__table__ and any(fk.column is Paziente.__table__.c.id for fk in t.foreign_keys)
+    ]
+
+
+def unisci_pazienti_duplicati() -> EsitoDeduplica:
+    """Job una tantum (CLI): unisce i pazienti con la stessa chiave normalizzata."""
+    coppie = _coppie_duplicati()
+    if coppie:
+        esegui_scrittura(_ripunta, coppie, [appuntamenti_archivio, notifiche_archivio])
+        esegui_scrittura(_unisci, coppie)
+    return EsitoDeduplica(gruppi=len({superstite for _, superstite in coppie}), pazienti_rimossi=len(coppie))
+
+
+def _coppie_duplicati() -> list[tuple[str, str]]:
+    """(doppione, superstite) per ogni paziente da unire: stesso gruppo se condividono la chiave email o telefono."""
+    with db_read_session() as s:
+        rows = s.execute(
+            select(Paziente.id, Paziente.chiave_normalizzata, Paziente.chiave_telefono, Paziente.codice_fiscale)
+            .where(or_(Paziente.chiave_normalizzata.is_not(None), Paziente.chiave_telefono.is_not(None)))
+            .order_by(literal_column("pazienti.rowid"))
+        ).all()
+
+    # union-find sulle due chiavi: A e B con la stessa email, B e C con lo stesso telefono -> un solo gruppo
+    padre: dict[str, str] = {}
+
+    def radice(pid: str) -> str:
+        while padre[pid] != pid:
+            padre[pid] = padre[padre[pid]]
+            pid = padre[pid]
+        return pid
+
+    primo_per_chiave: dict[tuple[str, str], str] = {}
+    for r in rows:
+        padre[r.id] = r.id
+        for chiave in (("email", r.chiave_normalizzata), ("telefono", r.chiave_telefono)):
+            if chiave[1] is None:
+                continue
+            altro = primo_per_chiave.setdefault(chiave, r.id)
+            a, b = radice(altro), radice(r.id)
+            if a != b:
+                padre[b] = a
+
+    gruppi: dict[str, list[tuple[str, str | None]]] = {}
+    for r in rows:  # in ordine di registrazione
+        gruppi.setdefault(radice(r.id), []).append((r.id, r.codice_fiscale))
+
+    coppie: list[tuple[str, str]] = []
+    for membri in gruppi.values():
+        if len(membri) < 2:
+            continue
+        superstite, cf = next((m for m in membri if m[1] is not None), membri[0])
+        coppie.extend((pid, superstite) for pid, altro_cf in membri if pid != superstite and altro_cf in (None, cf))
+    return coppie
+
+
+def _ripunta(s, coppie: list[tuple[str, str]], tabelle: list[Table]) -> None:
+    _mappa.create(s.connection(), checkfirst=True)
+    s.execute(insert(_mappa), [{"doppione": d, "superstite": p} for d, p in coppie])
+    for t in tabelle:
+        s.execute(
+            update(t)
+            .where(t.c.paziente_id == _mappa.c.doppione)
+            .values(paziente_id=_mappa.c.superstite)
+            .execution_options(synchronize_session=False)
+        )
+    _mappa.drop(s.connection())
+
+
+def _unisci(s, coppie: list[tuple[str, str]]) -> None:
+    _ripunta(s, coppie, _tabelle_con_paziente())
+
+    doppioni: dict[str, list[Paziente]] = {}
+    for doppione, superstite in coppie:
+        d = s.get(Paziente, doppione)
+        doppioni.setdefault(superstite, []).append(d)
+        registra_unione(s, d, superstite)
+
+    completamenti: dict[str, dict[str, object]] = {}
+    for superstite, altri in doppioni.items():
+        p = s.get(Paziente, superstite)
+        for campo in CAMPI_DA_COMPLETARE:
+            if getattr(p, campo) is None:
+                valore = next((getattr(d, campo) for d in altri if getattr(d, campo) is not None), None)
+                if valore is not None:
+                    completamenti.setdefault(superstite, {})[campo] = valore
+
+    s.execute(
+        delete(Paziente).where(Paziente.id.in_([d for d, _ in coppie])).execution_options(synchronize_session=False)
+    )
+    for d, _ in coppie:
+        s.expunge(s.get(Paziente, d))
+    # dopo la DELETE (il codice fiscale è unico); il flush ricalcola anche le chiavi
+    for superstite, valori in completamenti.items():
+        p = s.get(Paziente, superstite)
+        for campo, valore in valori.items():
+            setattr(p, campo, valore)
+    s.flush()
+    for superstite in completamenti:
+        registra_paziente(s, s.get(Paziente, superstite), "modificato")
+
+    incrementa(s, "pazienti", "appuntamenti", "lista_attesa", "notifiche")
+    # le richieste in lista d'attesa in memoria puntano ancora ai doppioni
+    al_commit(s, waitlist_engine.invalida)
+    al_rollback(s, waitlist_engine.invalida)
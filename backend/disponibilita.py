@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from datetime import date, datetime, time, timedelta
+from typing import Any, Hashable, Iterable, Iterator
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+
+from .models import Appuntamento, DisponibilitaMedico, StatoAppuntamento
+
+# Calcoli su intervalli di tempo [inizio, fine) per disponibilità e conflitti.
+# Le query leggono in un colpo solo tutto l'intervallo richiesto; i controlli
+# per singolo slot avvengono poi in memoria (liste ordinate + bisect).
+
+Intervallo = tuple[datetime, datetime]
+
+# Granularità delle griglie libero/occupato (heatmap)
+SLOT_MINUTI = 5
+SLOT_GIORNO = 24 * 60 // SLOT_MINUTI
+
+# Passo degli orari proposti (es. alternative a uno slot occupato)
+PASSO_MINUTI = 5
+
+# Orario studio usato per le sale e per i medici senza disponibilità settimanali configurate
+ORARIO_STUDIO = ("08:00", "20:00")
+
+
+def hm_to_min(hm: str) -> int:
+    """'09:30' -> 570"""
+    h, m = map(int, hm.split(":"))
+    return h * 60 + m
+
+
+def unisci(intervalli: list[Intervallo]) -> list[Intervallo]:
+    """Ordina e fonde gli intervalli sovrapposti o adiacenti."""
+    out: list[Intervallo] = []
+    for a, b in sorted(intervalli):
+        if out and a <= out[-1][1]:
+            if b > out[-1][1]:
+                out[-1] = (out[-1][0], b)
+        else:
+            out.append((a, b))
+    return out
+
+
+def sottrai(intervallo: Intervallo, occupati: list[Intervallo]) -> list[Intervallo]:
+    """Parti libere di `intervallo` togliendo gli intervalli occupati."""
+    liberi: list[Intervallo] = []
+    cur, fine = intervallo
+    for a, b in sorted(occupati):
+        if b <= cur or a >= fine:
+            continue
+        if a > cur:
+            liberi.append((cur, a))
+        cur = max(cur, b)
+        if cur >= fine:
+            break
+    if cur < fine:
+        liberi.append((cur, fine))
+    return liberi
+
+
+def sovrapposto(uniti: list[Intervallo], inizio: datetime, fine: datetime) -> bool:
+    """True se [inizio, fine) tocca uno degli intervalli (lista già passata da `unisci`)."""
+    i = bisect_left(uniti, (inizio, inizio))
+    if i > 0 and uniti[i - 1][1] > inizio:
+        return True
+    return i < len(uniti) and uniti[i][0] < fine
+
+
+def occupati(
+    s: Session, medici: set[str], sale: set[int], da: datetime, a: datetime
+) -> tuple[dict[str, list[Intervallo]], dict[int, list[Intervallo]]]:
+    """Intervalli occupati (appuntamenti non annullati) per medico e per sala in [da, a), con una sola query."""
+    occ_medico: dict[str, list[Intervallo]] = {m: [] for m in medici}
+    occ_sala: dict[int, list[Intervallo]] = {sl: [] for sl in sale}
+    if not medici and not sale:
+        return occ_medico, occ_sala
+
+    rows = s.execute(
+        select(Appuntamento.medico_id, Appuntamento.sala_id, Appuntamento.inizio, Appuntamento.fine).where(
+            and_(
+                Appuntamento.stato != StatoAppuntamento.ANNULLATO,
+                Appuntamento.inizio < a,
+                Appuntamento.fine > da,
+                or_(Appuntamento.medico_id.in_(medici), Appuntamento.sala_id.in_(sale)),
+            )
+        )
+    ).all()
+
+    for r in rows:
+        if r.medico_id in occ_medico:
+            occ_medico[r.medico_id].append((r.inizio, r.fine))
+        if r.sala_id in occ_sala:
+            occ_sala[r.sala_id].append((r.inizio, r.fine))
+    return occ_medico, occ_sala
+
+
+def finestre_settimanali(s: Session, medici: set[str] | None = None) -> dict[str, dict[int, list[tuple[int, int]]]]:
+    """
+    Disponibilità settimanali in minuti dalla mezzanotte: {medico_id: {giorno_settimana: [(540, 780), ...]}}.
+    medici None = tutti. I medici senza righe in disponibilita_medici non compaiono (nessun vincolo di orario).
+    """
+    out: dict[str, dict[int, list[tuple[int, int]]]] = {}
+    q = select(
+        DisponibilitaMedico.medico_id,
+        DisponibilitaMedico.giorno_settimana,
+        DisponibilitaMedico.ora_inizio,
+        DisponibilitaMedico.ora_fine,
+    )
+    if medici is not None:
+        q = q.where(DisponibilitaMedico.medico_id.in_(medici))
+    rows = s.execute(q).all()
+    for r in rows:
+        out.setdefault(r.medico_id, {}).setdefault(r.giorno_settimana, []).append(
+            (hm_to_min(r.ora_inizio), hm_to_min(r.ora_fine))
+        )
+    return out
+
+
+def interseca(a: list[Intervallo], b: list[Intervallo]) -> list[Intervallo]:
+    """Intersezione di due liste di intervalli ordinati e senza sovrapposizioni."""
+    out: list[Intervallo] = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        inizio, fine = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if inizio < fine:
+            out.append((inizio, fine))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def _arrotonda(t: datetime) -> datetime:
+    """Arrotonda per eccesso al passo PASSO_MINUTI."""
+    resto = (t.minute % PASSO_MINUTI) * 60 + t.second
+    if resto == 0 and t.microsecond == 0:
+        return t
+    return t.replace(second=0, microsecond=0) + timedelta(minutes=PASSO_MINUTI - t.minute % PASSO_MINUTI)
+
+
+def prossimo_libero(uniti: list[Intervallo], da: datetime, durata: timedelta, limite: datetime) -> datetime | None:
+    """
+    Primo inizio >= da (al passo PASSO_MINUTI) in cui [inizio, inizio + durata) non tocca gli intervalli
+    (lista già unita) e finisce entro `limite`; None se non c'è.
+    """
+    t = _arrotonda(da)
+    i = bisect_left(uniti, (t, t))
+    if i > 0 and uniti[i - 1][1] > t:
+        t = _arrotonda(uniti[i - 1][1])
+    while i < len(uniti) and uniti[i][0] < t + durata:
+        if uniti[i][1] > t:
+            t = _arrotonda(uniti[i][1])
+        i += 1
+    return t if t + durata <= limite else None
+
+
+def inizi_liberi(
+    finestre: Iterable[Intervallo],
+    occupato_medico: list[Intervallo],
+    occupato_sale: dict[int, list[Intervallo]],
+    durata: timedelta,
+) -> Iterator[tuple[datetime, int]]:
+    """
+    Iteratore (lazy, in ordine di tempo) degli inizi in cui il medico è libero dentro le sue finestre
+    e almeno una sala è libera per tutta la durata: ritorna (inizio, sala_id), con la sala che si libera prima.
+    Gli inizi successivi non si sovrappongono (il prossimo parte dalla fine della visita precedente).
+    Le liste di occupazione delle sale devono essere già unite.
+    """
+    for finestra in finestre:
+        for inizio_libero, fine_libera in sottrai(finestra, occupato_medico):
+            t = inizio_libero
+            while True:
+                candidati = [
+                    (inizio, sala_id)
+                    for sala_id, uniti in occupato_sale.items()
+                    if (inizio := prossimo_libero(uniti, t, durata, fine_libera)) is not None
+                ]
+                if not candidati:
+                    break
+                inizio, sala_id = min(candidati)
+                yield inizio, sala_id
+                t = inizio + durata
+
+
+def alternative_vicine(
+    liberi: list[Intervallo], desiderato: datetime, durata: timedelta, k: int = 3
+) -> list[datetime]:
+    """
+    Fino a k inizi alternativi più vicini a `desiderato`, presi dagli intervalli liberi
+    (uno per intervallo: il punto più vicino dove la visita ci sta).
+    """
+    candidati: list[datetime] = []
+    for a, b in liberi:
+        ultimo = b - durata
+        primo = _arrotonda(a)
+        if primo > ultimo:
+            continue
+        t = min(max(desiderato, primo), ultimo)
+        t = _arrotonda(t)
+        if t > ultimo:
+            t -= timedelta(minutes=PASSO_MINUTI)
+        if t >= primo:
+            candidati.append(t)
+    candidati.sort(key=lambda t: abs(t - desiderato))
+    return candidati[:k]
+
+
+def _maschera(np: Any, intervalli: list[list[Intervallo]], da: datetime, n: int, interni: bool) -> Any:
+    """
+    Maschera booleana (righe, n slot) degli intervalli, con array di differenze + somma cumulativa
+    (niente cicli per slot). interni=True: solo gli slot interamente coperti (finestre di lavoro);
+    False: ogni slot toccato (appuntamenti).
+    """
+    diff = np.zeros((len(intervalli), n + 1), dtype=np.int32)
+    for riga, iv in enumerate(intervalli):
+        if not iv:
+            continue
+        sec = np.array([((a - da).total_seconds(), (b - da).total_seconds()) for a, b in iv]) / (SLOT_MINUTI * 60)
+        if interni:
+            inizi, fini = np.ceil(sec[:, 0]), np.floor(sec[:, 1])
+        else:
+            inizi, fini = np.floor(sec[:, 0]), np.ceil(sec[:, 1])
+        inizi = np.clip(inizi, 0, n).astype(np.int64)
+        fini = np.clip(fini, 0, n).astype(np.int64)
+        validi = inizi < fini
+        np.add.at(diff[riga], inizi[validi], 1)
+        np.add.at(diff[riga], fini[validi], -1)
+    return np.cumsum(diff[:, :n], axis=1) > 0
+
+
+def griglia_libera(
+    finestre: dict[Hashable, list[Intervallo]],
+    impegni: dict[Hashable, list[Intervallo]],
+    da: date,
+    giorni: int,
+) -> tuple[list[Hashable], Any]:
+    """
+    Griglia libero/occupato a slot di SLOT_MINUTI per ogni risorsa (medico o sala), calcolata con
+    array booleani NumPy: libero = dentro una finestra di lavoro e fuori da ogni appuntamento.
+    Ritorna (chiavi, array bool con shape (risorse, giorni, SLOT_GIORNO)).
+    """
+    import numpy as np  # import lazy: serve solo alle heatmap
+
+    chiavi = list(finestre)
+    inizio = datetime.combine(da, time.min)
+    n = giorni * SLOT_GIORNO
+
+    lavoro = _maschera(np, [finestre[k] for k in chiavi], inizio, n, interni=True)
+    busy = _maschera(np, [impegni.get(k, []) for k in chiavi], inizio, n, interni=False)
+    return chiavi, (lavoro & ~busy).reshape(len(chiavi), giorni, SLOT_GIORNO)
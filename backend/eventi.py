@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import enum
+import json
+from datetime import date, datetime
+from typing import Any, Iterable, Mapping
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from .db import db_read_session
+from .models import Appuntamento, EventoModifica, Paziente
+
+# Change log per i sistemi esterni (fatturazione, gateway SMS): ogni modifica di appuntamenti e pazienti
+# aggiunge una riga a `eventi` nella stessa transazione, con la riga completa dopo la modifica.
+# Un consumatore legge GET /api/changes?since=<ultimo seq> e riparte dal `prossimo` ricevuto: costo
+# proporzionale alle modifiche (range scan sulla chiave primaria), non alla dimensione delle tabelle.
+# Le scritture in blocco (serie, assenze, completamento) inseriscono gli eventi con un solo executemany.
+# Unione di pazienti duplicati: il doppione ha un evento "eliminato" con `unito_in` = paziente superstite;
+# i suoi appuntamenti vanno riassegnati al superstite anche lato consumatore.
+
+APPUNTAMENTO = "appuntamento"
+PAZIENTE = "paziente"
+
+CAMPI = {
+    APPUNTAMENTO: (
+        "id", "paziente_id", "medico_id", "tipo_visita_id", "sala_id", "inizio", "fine", "stato", "note", "serie_id",
+    ),
+    PAZIENTE: ("id", "nome", "cognome", "data_nascita", "telefono", "email", "codice_fiscale"),
+}
+
+MAX_LIMIT = 5000
+
+
+def _valore(v: Any) -> Any:
+    if isinstance(v, enum.Enum):
+        return v.value
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    return v
+
+
+def registra_eventi(s: Session, entita: str, operazione: str, righe: Iterable[Mapping[str, Any]]) -> None:
+    """Aggiunge un evento per ogni riga (dict o Row con almeno i CAMPI dell'entità)."""
+    campi = CAMPI[entita]
+    valori = [
+        {
+            "entita": entita,
+            "entita_id": r["id"],
+            "operazione": operazione,
+            "dati": json.dumps({c: _valore(r.get(c)) for c in campi}),
+        }
+        for r in righe
+    ]
+    if valori:
+        s.execute(insert(EventoModifica), valori)
+
+
+def registra_appuntamento(s: Session, app: Appuntamento, operazione: str) -> None:
+    registra_eventi(s, APPUNTAMENTO, operazione, [{c: getattr(app, c) for c in CAMPI[APPUNTAMENTO]}])
+
+
+def registra_paziente(s: Session, p: Paziente, operazione: str) -> None:
+    registra_eventi(s, PAZIENTE, operazione, [{c: getattr(p, c) for c in CAMPI[PAZIENTE]}])
+
+
+def registra_unione(s: Session, doppione: Paziente, superstite_id: str) -> None:
+    """Paziente eliminato perché duplicato: i dati del doppione più `unito_in`."""
+    dati = {c: _valore(getattr(doppione, c)) for c in CAMPI[PAZIENTE]}
+    dati["unito_in"] = superstite_id
+    s.execute(
+        insert(EventoModifica).values(
+            entita=PAZIENTE, entita_id=doppione.id, operazione="eliminato", dati=json.dumps(dati)
+        )
+    )
+
+
+def modifiche_flat(since: int = 0, limit: int = 500, entita: str | None = None) -> dict[str, Any]:
+    """
+    Eventi con seq > since in ordine di seq. `prossimo` è il cursore per la chiamata successiva
+    (uguale a since se non ci sono eventi nuovi); `altri` indica che ci sono già altri eventi da leggere.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+    with db_read_session() as s:
+        q = select(
+            EventoModifica.seq,
+            EventoModifica.creato_il,
+            EventoModifica.entita,
+            EventoModifica.entita_id,
+            EventoModifica.operazione,
+            EventoModifica.dati,
+        ).where(EventoModifica.seq > since)
+        if entita is not None:
+            q = q.where(EventoModifica.entita == entita)
+        rows = s.execute(q.order_by(EventoModifica.seq).limit(limit + 1)).all()
+
+    altri = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "eventi": [
+            {
+                "seq": r.seq,
+                "creato_il": r.creato_il.isoformat(),
+                "entita": r.entita,
+                "entita_id": r.entita_id,
+                "operazione": r.operazione,
+                "dati": json.loads(r.dati),
+            }
+            for r in rows
+        ],
+        "prossimo": rows[-1].seq if rows else since,
+        "altri": altri,
+    }
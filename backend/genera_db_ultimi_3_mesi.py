@@ -6,6 +6,7 @@ from datetime import date, datetime, time, timedelta
 
 from sqlalchemy import delete, select
 
+from backend.archivio import appuntamenti_archivio, notifiche_archivio
 from backend.db import db_session
 from backend.models import (
     Appuntamento,
@@ -13,6 +14,7 @@ from backend.models import (
     CartellaClinica,
     ContattoEmergenza,
     DisponibilitaMedico,
+    EventoModifica,
     ListaAttesa,
     Medico,
     Notifica,
@@ -23,6 +25,7 @@ from backend.models import (
     TipoVisita,
 )
 from backend.services import init_db
+from backend.versioni import incrementa
 
 
 
@@ -119,6 +122,9 @@ def reset_db() -> None:
         s.execute(delete(CartellaClinica))
         s.execute(delete(Paziente))
         s.execute(delete(Medico))
+        s.execute(delete(notifiche_archivio))
+        s.execute(delete(appuntamenti_archivio))
+        s.execute(delete(EventoModifica))
 
 
 def seed_struttura() -> None:
@@ -427,6 +433,11 @@ def seed_notifiche_pendenti_demo() -> None:
                 )
 
 
+TABELLE_RIGENERATE = (
+    "medici", "pazienti", "sale_visita", "tipi_visita", "disponibilita", "appuntamenti", "lista_attesa", "notifiche",
+)
+
+
 def main(reset: bool = True) -> None:
     random.seed(RANDOM_SEED)
 
@@ -440,6 +451,10 @@ def main(reset: bool = True) -> None:
     genera_appuntamenti_ultimi_90_giorni()
     seed_notifiche_pendenti_demo()
 
+    # l'API eventualmente in esecuzione (anche con più worker) deve rileggere liste e cache
+    with db_session() as s:
+        incrementa(s, *TABELLE_RIGENERATE)
+
     print("OK: database popolato con dati realistici degli ultimi 90 giorni.")
 
 
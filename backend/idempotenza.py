@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+from fastapi import HTTPException, Response
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+from .db import engine
+from .models import ChiaveIdempotenza
+from .write_queue import esegui_scrittura
+
+# Header Idempotency-Key sui POST che creano dati (prenotazioni, pazienti).
+# Un client che ripete la richiesta (timeout, doppio clic) con la stessa chiave riceve la risposta della prima
+# esecuzione, senza ripassare dalla prenotazione. La chiave viene "prenotata" nella tabella chiavi_idempotenza
+# prima di eseguire l'operazione, quindi vale anche tra più worker: una ripetizione mentre la prima è ancora in
+# corso riceve 409. Le risposte recenti restano anche in una LRU in memoria (niente query per le ripetizioni).
+# L'operazione e il salvataggio della risposta sono nella stessa transazione: se il processo cade prima del
+# COMMIT non resta né la prenotazione né la risposta, e la ripetizione (scaduto IN_CORSO_SCADENZA) la riesegue.
+# Le operazioni fallite liberano la chiave: il client può riprovare.
+
+IDEMPOTENZA_ORE = int(os.getenv("IDEMPOTENZA_ORE", "24"))  # validità di una chiave
+IN_CORSO_SCADENZA = timedelta(seconds=120)  # oltre, una richiesta "in corso" è considerata persa (worker caduto)
+MAX_IN_MEMORIA = 10_000
+
+HEADER_RIPETUTA = "Idempotent-Replayed"
+
+_recenti: OrderedDict[str, tuple[str, datetime, Any]] = OrderedDict()  # chiave -> (impronta, creata_il, risposta)
+_lock = threading.Lock()
+
+
+def _impronta(corpo: Any) -> str:
+    return hashlib.sha256(json.dumps(corpo, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def esegui_idempotente(
+    chiave_client: str | None, ambito: str, corpo: Any, response: Response, fn: Callable[[Session], Any]
+) -> Any:
+    """
+    Esegue fn(s) una sola volta per (ambito, chiave_client) e ne ritorna la risposta anche alle ripetizioni.
+    fn scrive solo nella sessione ricevuta (use case _xxx(s, ...)): la risposta viene salvata nella stessa transazione.
+    ambito: endpoint ed eventuale utente (la stessa chiave di due utenti non collide); senza chiave esegue e basta.
+    """
+    if not chiave_client:
+        return esegui_scrittura(fn)
+
+    chiave = f"{ambito}:{chiave_client}"
+    impronta = _impronta(corpo)
+    adesso = datetime.utcnow()
+
+    with _lock:
+        salvata = _recenti.get(chiave)
+        if salvata is not None and salvata[1] < adesso - timedelta(hours=IDEMPOTENZA_ORE):
+            del _recenti[chiave]
+            salvata = None
+        if salvata is not None:
+            _recenti.move_to_end(chiave)
+    if salvata is None:
+        esistente = _prenota(chiave, impronta, adesso)
+        if esistente is not None:
+            if esistente.stato_http is None:
+                raise HTTPException(
+                    status_code=409,
+                    detail="Richiesta con questa Idempotency-Key ancora in corso",
+                    headers={"Retry-After": "1"},
+                )
+            salvata = (esistente.impronta, esistente.creata_il, json.loads(esistente.risposta))
+            _ricorda(chiave, salvata)
+
+    if salvata is not None:
+        if salvata[0] != impronta:
+            raise HTTPException(status_code=422, detail="Idempotency-Key già usata per una richiesta diversa")
+        response.headers[HEADER_RIPETUTA] = "true"
+        return salvata[2]
+
+    try:
+        risultato = esegui_scrittura(_esegui_e_completa, chiave, fn)
+    except BaseException:
+        _rilascia(chiave)
+        raise
+    _ricorda(chiave, (impronta, adesso, risultato))
+    return risultato
+
+
+def _ricorda(chiave: str, valore: tuple[str, datetime, Any]) -> None:
+    with _lock:
+        _recenti[chiave] = valore
+        _recenti.move_to_end(chiave)
+        if len(_recenti) > MAX_IN_MEMORIA:
+            _recenti.popitem(last=False)
+
+
+def _prenota(chiave: str, impronta: str, adesso: datetime):
+    """None se la chiave è ora di questa richiesta, altrimenti la riga esistente (in corso o completata)."""
+    with engine.begin() as conn:
+        # prima istruzione in scrittura: la transazione prende subito il lock (niente snapshot da aggiornare)
+        if conn.execute(
+            insert(ChiaveIdempotenza).prefix_with("OR IGNORE").values(chiave=chiave, impronta=impronta, creata_il=adesso)
+        ).rowcount:
+            return None
+
+        # riga scaduta, o richiesta "in corso" da troppo tempo: la riprendo
+        ripresa = conn.execute(
+            update(ChiaveIdempotenza)
+            .where(
+                ChiaveIdempotenza.chiave == chiave,
+                or_(
+                    ChiaveIdempotenza.creata_il < adesso - timedelta(hours=IDEMPOTENZA_ORE),
+                    and_(
+                        ChiaveIdempotenza.stato_http.is_(None),
+                        ChiaveIdempotenza.creata_il < adesso - IN_CORSO_SCADENZA,
+                    ),
+                ),
+            )
+            .values(impronta=impronta, creata_il=adesso, stato_http=None, risposta=None)
+        ).rowcount
+        if ripresa:
+            return None
+
+        return conn.execute(
+            select(
+                ChiaveIdempotenza.impronta,
+                ChiaveIdempotenza.stato_http,
+                ChiaveIdempotenza.risposta,
+                ChiaveIdempotenza.creata_il,
+            ).where(ChiaveIdempotenza.chiave == chiave)
+        ).one()
+
+
+def _esegui_e_completa(s: Session, chiave: str, fn: Callable[[Session], Any]) -> Any:
+    risultato = fn(s)
+    s.execute(
+        update(ChiaveIdempotenza)
+        .where(ChiaveIdempotenza.chiave == chiave)
+        .values(stato_http=200, risposta=json.dumps(risultato, default=str))
+        .execution_options(synchronize_session=False)
+    )
+    return risultato
+
+
+def _rilascia(chiave: str) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            delete(ChiaveIdempotenza).where(ChiaveIdempotenza.chiave == chiave, ChiaveIdempotenza.stato_http.is_(None))
+        )
+
+
+def pulisci_chiavi_scadute() -> int:
+    """Job: elimina le chiavi più vecchie di IDEMPOTENZA_ORE. Ritorna il numero di righe eliminate."""
+    soglia = datetime.utcnow() - timedelta(hours=IDEMPOTENZA_ORE)
+    with engine.begin() as conn:
+        return conn.execute(delete(ChiaveIdempotenza).where(ChiaveIdempotenza.creata_il < soglia)).rowcount
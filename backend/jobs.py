@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+from sqlalchemy import insert, or_, select, update
+
+from .archivio import archivia
+from .db import db_read_session, engine
+from .idempotenza import pulisci_chiavi_scadute
+from .manutenzione import backup_db, manutenzione_db
+from .models import StatoJob
+from .services import completa_appuntamenti_passati, genera_promemoria
+
+# Job periodici eseguiti nel processo API (task asyncio avviati dal lifespan di FastAPI).
+# Ogni job gira in un thread del threadpool per non bloccare l'event loop.
+# Con più worker (o più istanze) sullo stesso DB, il lease in stato_job fa sì che un solo worker
+# esegua ciascun job: chi lo detiene lo rinnova a ogni giro, gli altri riprovano ogni LEASE_MIN_SECONDI
+# (al più) e subentrano alla scadenza. Allo spegnimento il worker rilascia i propri lease.
+
+logger = logging.getLogger("studio_medico.jobs")
+
+# Identità di questo processo come titolare dei lease
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# Durata minima del lease (secondi): copre job con intervallo molto breve
+LEASE_MIN_SECONDI = 60
+
+# Intervalli dei job predefiniti (0 = job disattivato)
+PROMEMORIA_INTERVALLO_SECONDI = int(os.getenv("PROMEMORIA_INTERVALLO_SECONDI", "300"))
+COMPLETAMENTO_INTERVALLO_SECONDI = int(os.getenv("COMPLETAMENTO_INTERVALLO_SECONDI", "600"))
+ARCHIVIO_INTERVALLO_SECONDI = int(os.getenv("ARCHIVIO_INTERVALLO_SECONDI", "86400"))
+MANUTENZIONE_INTERVALLO_SECONDI = int(os.getenv("MANUTENZIONE_INTERVALLO_SECONDI", "86400"))
+BACKUP_INTERVALLO_SECONDI = int(os.getenv("BACKUP_INTERVALLO_SECONDI", "86400"))
+IDEMPOTENZA_PULIZIA_SECONDI = int(os.getenv("IDEMPOTENZA_PULIZIA_SECONDI", "3600"))
+
+
+@dataclass(frozen=True)
+class Job:
+    nome: str
+    intervallo_secondi: int
+    fn: Callable[[], int]  # ritorna il numero di elementi elaborati
+
+
+class JobRunner:
+    def __init__(self) -> None:
+        self._jobs: dict[str, Job] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def registra(self, nome: str, intervallo_secondi: int, fn: Callable[[], int]) -> None:
+        """Aggiunge un job periodico (ignorato se l'intervallo è 0)."""
+        if intervallo_secondi > 0:
+            self._jobs[nome] = Job(nome, intervallo_secondi, fn)
+
+    async def avvia(self) -> None:
+        self._tasks = [asyncio.create_task(self._ciclo(j), name=f"job:{j.nome}") for j in self._jobs.values()]
+
+    async def ferma(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await asyncio.to_thread(self._rilascia)
+        except Exception:
+            logger.exception("Rilascio dei lease fallito")
+
+    async def _ciclo(self, job: Job) -> None:
+        # all'avvio rispetto l'intervallo dall'ultima esecuzione (di qualunque worker): un riavvio non ripete
+        # subito archivio, manutenzione e backup (con la rotazione dei backup ne cancellerebbe di validi)
+        try:
+            await asyncio.sleep(await asyncio.to_thread(self._attesa_iniziale, job))
+        except Exception:
+            logger.exception("Job %s: lettura dell'ultima esecuzione fallita", job.nome)
+        while True:
+            eseguito = False
+            try:
+                eseguito = await asyncio.to_thread(self.esegui, job)
+            except Exception:
+                logger.exception("Job %s: errore del runner", job.nome)
+            # lease di un altro worker (anche di un processo terminato senza rilasciarlo): riprovo presto,
+            # così alla scadenza il job riparte senza aspettare un intero intervallo
+            await asyncio.sleep(job.intervallo_secondi if eseguito else min(job.intervallo_secondi, LEASE_MIN_SECONDI))
+
+    def esegui(self, job: Job) -> bool:
+        """Esegue il job se questo worker ottiene il lease; registra tempi, esito e checkpoint."""
+        if not self._acquisisci(job):
+            return False
+
+        avvio = datetime.utcnow()
+        t0 = time.perf_counter()
+        elaborati: int | None = None
+        errore: str | None = None
+        try:
+            elaborati = job.fn()
+        except Exception as e:
+            errore = f"{type(e).__name__}: {e}"
+            logger.exception("Job %s fallito", job.nome)
+        durata_ms = int((time.perf_counter() - t0) * 1000)
+
+        valori: dict[str, Any] = {
+            "ultimo_avvio": avvio,
+            "ultima_durata_ms": durata_ms,
+            "ultimo_esito": "ERRORE" if errore else "OK",
+            "ultimo_errore": errore,
+            "elaborati": elaborati,
+            "esecuzioni": StatoJob.esecuzioni + 1,
+        }
+        if errore is None:
+            valori["checkpoint"] = avvio
+        with engine.begin() as conn:
+            conn.execute(update(StatoJob).where(StatoJob.nome == job.nome).values(**valori))
+
+        if elaborati:
+            logger.info("Job %s: %d elementi in %d ms", job.nome, elaborati, durata_ms)
+        return True
+
+    @staticmethod
+    def _attesa_iniziale(job: Job) -> float:
+        """Secondi mancanti alla prossima esecuzione prevista (0 se il job non è mai stato eseguito)."""
+        with db_read_session() as s:
+            ultimo_avvio = s.scalar(select(StatoJob.ultimo_avvio).where(StatoJob.nome == job.nome))
+        if ultimo_avvio is None:
+            return 0.0
+        prossimo = ultimo_avvio + timedelta(seconds=job.intervallo_secondi)
+        return max(0.0, (prossimo - datetime.utcnow()).total_seconds())
+
+    @staticmethod
+    def _acquisisci(job: Job) -> bool:
+        """Lease atomico: riuscito se libero, scaduto o già di questo worker (un solo UPDATE condizionato)."""
+        ora = datetime.utcnow()
+        scadenza = ora + timedelta(seconds=max(job.intervallo_secondi, LEASE_MIN_SECONDI))
+        with engine.begin() as conn:
+            conn.execute(insert(StatoJob).prefix_with("OR IGNORE").values(nome=job.nome, esecuzioni=0))
+            return conn.execute(
+                update(StatoJob)
+                .where(
+                    StatoJob.nome == job.nome,
+                    or_(
+                        StatoJob.bloccato_fino.is_(None),
+                        StatoJob.bloccato_fino < ora,
+                        StatoJob.bloccato_da == WORKER_ID,
+                    ),
+                )
+                .values(bloccato_da=WORKER_ID, bloccato_fino=scadenza)
+            ).rowcount == 1
+
+    @staticmethod
+    def _rilascia() -> None:
+        """Libera i lease di questo worker: un altro worker (o il prossimo avvio) non aspetta la scadenza."""
+        with engine.begin() as conn:
+            conn.execute(
+                update(StatoJob).where(StatoJob.bloccato_da == WORKER_ID).values(bloccato_da=None, bloccato_fino=None)
+            )
+
+
+def crea_runner() -> JobRunner:
+    """Runner con i job predefiniti dell'API."""
+    runner = JobRunner()
+    runner.registra("promemoria", PROMEMORIA_INTERVALLO_SECONDI, genera_promemoria)
+    runner.registra("completa_appuntamenti", COMPLETAMENTO_INTERVALLO_SECONDI, completa_appuntamenti_passati)
+    runner.registra("archivio", ARCHIVIO_INTERVALLO_SECONDI, archivia)
+    runner.registra(
+        "manutenzione",
+        MANUTENZIONE_INTERVALLO_SECONDI,
+        lambda: sum(e.pagine_liberate for e in manutenzione_db()),
+    )
+    runner.registra("backup", BACKUP_INTERVALLO_SECONDI, lambda: len(backup_db()))
+    runner.registra("pulizia_idempotenza", IDEMPOTENZA_PULIZIA_SECONDI, pulisci_chiavi_scadute)
+    return runner
+
+
+def stato_jobs_flat() -> list[dict[str, Any]]:
+    with db_read_session() as s:
+        rows = s.scalars(select(StatoJob).order_by(StatoJob.nome)).all()
+        return [
+            {
+                "nome": r.nome,
+                "bloccato_da": r.bloccato_da,
+                "bloccato_fino": r.bloccato_fino.isoformat() if r.bloccato_fino else None,
+                "ultimo_avvio": r.ultimo_avvio.isoformat() if r.ultimo_avvio else None,
+                "ultima_durata_ms": r.ultima_durata_ms,
+                "ultimo_esito": r.ultimo_esito,
+                "ultimo_errore": r.ultimo_errore,
+                "elaborati": r.elaborati,
+                "esecuzioni": r.esecuzioni,
+                "checkpoint": r.checkpoint.isoformat() if r.checkpoint else None,
+            }
+            for r in rows
+        ]
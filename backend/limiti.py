@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import asyncio
+import ipaddress
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Protocol
+
+# Rate limiting e controllo di ammissione per gli endpoint non autenticati (login e prenotazione pubblica),
+# che costano molto (bcrypt, transazione di prenotazione): una raffica da un client o da un bot non deve
+# rallentare tutto lo studio.
+# - token bucket per IP e globale per endpoint: oltre il limite risposta immediata 429 con Retry-After
+# - tetto di richieste limitate in corso nel processo: oltre il tetto risposta immediata 503
+# Lo stato dei bucket è in memoria (O(1) per richiesta, LRU con un massimo di chiavi); con più worker
+# STUDIO_LIMITI_DB indica un file SQLite condiviso in cui i bucket si aggiornano con un solo UPSERT
+# (in un thread: il lock del file non blocca il loop) e i bucket tornati pieni vengono cancellati.
+# L'IP è quello del client, oppure l'header X-Forwarded-For se la richiesta arriva da un proxy fidato
+# (STUDIO_PROXY_FIDATI): il frontend Streamlit fa tutte le richieste dal proprio indirizzo e inoltra
+# così quello dell'utente, altrimenti tutto lo studio condividerebbe un solo bucket.
+
+logger = logging.getLogger("studio_medico.limiti")
+
+LIMITI_ATTIVI = os.getenv("STUDIO_LIMITI", "1") != "0"
+LIMITI_DB = os.getenv("STUDIO_LIMITI_DB")  # es. studio_medico_limiti.sqlite; assente = stato in memoria
+MAX_CONCORRENTI = int(os.getenv("STUDIO_MAX_CONCORRENTI", "8"))
+# Indirizzi (o reti) da cui X-Forwarded-For è attendibile: il server Streamlit, un reverse proxy
+PROXY_FIDATI = tuple(
+    ipaddress.ip_network(x.strip(), strict=False)
+    for x in os.getenv("STUDIO_PROXY_FIDATI", "127.0.0.1,::1").split(",")
+    if x.strip()
+)
+
+# Attesa massima sul lock del file condiviso: oltre, la richiesta usa i bucket in memoria
+LIMITI_DB_TIMEOUT = 0.05
+MAX_CHIAVI = 100_000
+PULIZIA_SECONDI = 60  # ogni quanto un processo cancella dal file condiviso i bucket tornati pieni
+
+
+@dataclass(frozen=True)
+class Secchio:
+    capacita: float   # richieste consentite a raffica
+    al_secondo: float  # gettoni ricaricati al secondo
+
+
+@dataclass(frozen=True)
+class Regola:
+    per_ip: Secchio
+    globale: Secchio
+
+
+# Endpoint limitati (metodo, path)
+REGOLE: dict[tuple[str, str], Regola] = {
+    ("POST", "/api/auth/login"): Regola(per_ip=Secchio(10, 10 / 60), globale=Secchio(50, 20)),
+    ("POST", "/api/auth/register"): Regola(per_ip=Secchio(5, 5 / 3600), globale=Secchio(20, 1)),
+    ("POST", "/api/public/prenotazioni"): Regola(per_ip=Secchio(5, 5 / 60), globale=Secchio(30, 10)),
+}
+
+
+class Gettoni(Protocol):
+    bloccante: bool  # preleva() può attendere un lock: va chiamata fuori dal loop asyncio
+
+    def preleva(self, chiave: str, secchio: Secchio) -> float:
+        """Consuma un gettone: 0 se consentito, altrimenti i secondi da attendere."""
+        ...
+
+
+class GettoniMemoria:
+    bloccante = False
+
+    def __init__(self, max_chiavi: int = MAX_CHIAVI) -> None:
+        self._stato: OrderedDict[str, tuple[float, float]] = OrderedDict()  # chiave -> (gettoni, istante)
+        self._max_chiavi = max_chiavi
+        self._lock = threading.Lock()
+
+    def preleva(self, chiave: str, secchio: Secchio) -> float:
+        ora = time.monotonic()
+        with self._lock:
+            gettoni, istante = self._stato.pop(chiave, (secchio.capacita, ora))
+            gettoni = min(secchio.capacita, gettoni + (ora - istante) * secchio.al_secondo)
+            attesa = 0.0
+            if gettoni >= 1:
+                gettoni -= 1
+            else:
+                attesa = (1 - gettoni) / secchio.al_secondo
+            self._stato[chiave] = (gettoni, ora)
+            if len(self._stato) > self._max_chiavi:
+                self._stato.popitem(last=False)  # la chiave usata meno di recente
+        return attesa
+
+
+class GettoniSQLite:
+    """Bucket condivisi tra processi: ogni prelievo è un solo UPSERT atomico (niente letture separate)."""
+
+    bloccante = True
+
+    _UPSERT = """
+        INSERT INTO gettoni (chiave, gettoni, istante, consentito) VALUES (:chiave, :capacita - 1, :ora, 1)
+        ON CONFLICT (chiave) DO UPDATE SET
+            gettoni = min(:capacita, gettoni + (:ora - istante) * :al_secondo)
+                      - (min(:capacita, gettoni + (:ora - istante) * :al_secondo) >= 1),
+            consentito = min(:capacita, gettoni + (:ora - istante) * :al_secondo) >= 1,
+            istante = :ora
+        RETURNING gettoni, consentito
+    """
+
+    def __init__(self, path: Path, riserva: Gettoni, ricarica_max: float) -> None:
+        self._path = path
+        self._riserva = riserva
+        self._ricarica_max = ricarica_max  # secondi dopo cui qualunque bucket è di nuovo pieno
+        self._locale = threading.local()
+        self._prossima_pulizia = 0.0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._locale, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=LIMITI_DB_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")  # stato effimero: dopo un crash al massimo si riparte pieni
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS gettoni "
+                "(chiave TEXT PRIMARY KEY, gettoni REAL NOT NULL, istante REAL NOT NULL, consentito INTEGER NOT NULL)"
+            )
+            self._locale.conn = conn
+        return conn
+
+    def preleva(self, chiave: str, secchio: Secchio) -> float:
+        ora = time.time()
+        try:
+            gettoni, consentito = self._conn().execute(
+                self._UPSERT,
+                {"chiave": chiave, "capacita": secchio.capacita, "al_secondo": secchio.al_secondo, "ora": ora},
+            ).fetchone()
+            if ora >= self._prossima_pulizia:
+                self._prossima_pulizia = ora + PULIZIA_SECONDI
+                # un bucket fermo da più di ricarica_max equivale a uno nuovo: la riga non serve più
+                self._conn().execute("DELETE FROM gettoni WHERE istante < ?", (ora - self._ricarica_max,))
+        except sqlite3.OperationalError:
+            logger.warning("Limiti: file condiviso occupato, uso i bucket in memoria")
+            return self._riserva.preleva(chiave, secchio)
+        return 0.0 if consentito else (1 - gettoni) / secchio.al_secondo
+
+
+def crea_gettoni(regole: dict[tuple[str, str], Regola] = REGOLE) -> Gettoni:
+    memoria = GettoniMemoria()
+    if not LIMITI_DB:
+        return memoria
+    ricarica_max = max(
+        (s.capacita / s.al_secondo for r in regole.values() for s in (r.per_ip, r.globale)), default=0.0
+    )
+    return GettoniSQLite(Path(LIMITI_DB), memoria, ricarica_max)
+
+
+def indirizzo_client(scope: dict[str, Any], proxy_fidati: tuple = PROXY_FIDATI) -> str:
+    """IP del client; dietro un proxy fidato l'ultimo indirizzo di X-Forwarded-For (quello aggiunto dal proxy)."""
+    ip = (scope.get("client") or ("?",))[0]
+    try:
+        fidato = any(ipaddress.ip_address(ip) in rete for rete in proxy_fidati)
+    except ValueError:
+        return ip
+    if fidato:
+        for nome, valore in scope.get("headers", ()):
+            if nome == b"x-forwarded-for":
+                inoltrato = valore.decode("latin-1").rsplit(",", 1)[-1].strip()
+                if inoltrato:
+                    return inoltrato
+    return ip
+
+
+class LimiteRichieste:
+    """Middleware ASGI: applica REGOLE e il tetto di concorrenza; le altre richieste passano senza costi."""
+
+    def __init__(
+        self,
+        app: Callable[..., Awaitable[None]],
+        regole: dict[tuple[str, str], Regola] | None = None,
+        gettoni: Gettoni | None = None,
+        max_concorrenti: int = MAX_CONCORRENTI,
+    ) -> None:
+        self.app = app
+        self.regole = REGOLE if regole is None else regole
+        self.gettoni = gettoni or crea_gettoni(self.regole)
+        self.max_concorrenti = max_concorrenti
+        self._in_corso = 0
+
+    async def __call__(self, scope: dict[str, Any], receive: Callable, send: Callable) -> None:
+        regola = self.regole.get((scope.get("method", ""), scope.get("path", ""))) if scope["type"] == "http" else None
+        if regola is None:
+            await self.app(scope, receive, send)
+            return
+
+        ip = indirizzo_client(scope)
+        percorso = scope["path"]
+        if self.gettoni.bloccante:
+            attesa = await asyncio.to_thread(self._preleva, ip, percorso, regola)
+        else:
+            attesa = self._preleva(ip, percorso, regola)
+        if attesa:
+            await _rifiuta(send, 429, "Troppe richieste, riprova più tardi", attesa)
+            return
+
+        if self._in_corso >= self.max_concorrenti:
+            await _rifiuta(send, 503, "Servizio occupato, riprova tra poco", 1)
+            return
+        self._in_corso += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._in_corso -= 1
+
+    def _preleva(self, ip: str, percorso: str, regola: Regola) -> float:
+        attesa = self.gettoni.preleva(f"ip:{ip}:{percorso}", regola.per_ip)
+        if not attesa:
+            attesa = self.gettoni.preleva(f"tutti:{percorso}", regola.globale)
+        return attesa
+
+
+async def _rifiuta(send: Callable, status: int, messaggio: str, attesa: float) -> None:
+    body = json.dumps({"detail": messaggio}).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(attesa))).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+from .db import ARCHIVIO_PATH, ARCHIVIO_SCHEMA, DB_PATH, engine
+
+# Manutenzione online dei database (principale e archivio), senza fermare l'API:
+# - PRAGMA optimize (ANALYZE completo solo la prima volta, quando mancano le statistiche)
+# - incremental vacuum a piccoli passi, ognuno in una transazione breve
+# - checkpoint del WAL (PASSIVE: non aspetta lettori e scrittori)
+# - backup a caldo con VACUUM INTO: una sola transazione di lettura sullo snapshot corrente, che in WAL
+#   non blocca le scritture (la backup API a passi ricomincia da capo a ogni COMMIT di un'altra connessione
+#   e con scritture frequenti non finisce mai); durata massima BACKUP_MAX_SECONDI
+# Il VACUUM completo (necessario una volta per passare i DB esistenti ad auto_vacuum INCREMENTAL) blocca
+# tutte le scritture per la sua durata: solo da CLI, mai dal job periodico.
+
+logger = logging.getLogger("studio_medico.manutenzione")
+
+SCHEMI = ("main", ARCHIVIO_SCHEMA)
+
+# Pagine liberate per transazione dall'incremental vacuum
+VACUUM_PAGINE = 256
+
+BACKUP_DIR = Path(os.getenv("STUDIO_BACKUP_DIR", str(DB_PATH.parent / "backup")))
+BACKUP_DA_TENERE = int(os.getenv("STUDIO_BACKUP_DA_TENERE", "7"))
+# Oltre questa durata il backup viene interrotto (il job registra l'errore e libera il lease)
+BACKUP_MAX_SECONDI = float(os.getenv("STUDIO_BACKUP_MAX_SECONDI", "600"))
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+@dataclass(frozen=True)
+class EsitoManutenzione:
+    schema: str
+    analizzato: bool           # True se è stato eseguito un ANALYZE completo
+    pagine_liberate: int
+    auto_vacuum_incrementale: bool
+    wal_checkpoint: tuple[int, int, int] | None  # (busy, pagine nel WAL, pagine riportate nel DB)
+
+
+def manutenzione_db(vacuum_completo: bool = False) -> list[EsitoManutenzione]:
+    """Statistiche, spazio libero e WAL di entrambi i database."""
+    return [_manutenzione_schema(schema, vacuum_completo) for schema in SCHEMI]
+
+
+def _manutenzione_schema(schema: str, vacuum_completo: bool) -> EsitoManutenzione:
+    with engine.connect() as conn:
+        senza_statistiche = not conn.exec_driver_sql(
+            f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'sqlite_stat1'"
+        ).first()
+        auto_vacuum = conn.exec_driver_sql(f"PRAGMA {schema}.auto_vacuum").scalar()
+    # transazione a parte che inizia scrivendo: in WAL una transazione che legge e poi scrive
+    # fallisce subito se nel frattempo un'altra connessione ha fatto COMMIT
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"ANALYZE {schema}" if senza_statistiche else f"PRAGMA {schema}.optimize")
+
+    raw = engine.raw_connection()
+    try:
+        db = raw.driver_connection
+        if vacuum_completo:
+            liberate = _freelist(db, schema)
+            db.execute(f"VACUUM {schema}")
+            auto_vacuum = db.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0]
+        elif auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+            liberate = _vacuum_incrementale(db, schema)
+        else:
+            logger.info("DB %s senza auto_vacuum incrementale: serve un VACUUM completo da CLI", schema)
+            liberate = 0
+        checkpoint = db.execute(f"PRAGMA {schema}.wal_checkpoint(PASSIVE)").fetchone()
+    finally:
+        raw.close()
+
+    return EsitoManutenzione(
+        schema=schema,
+        analizzato=senza_statistiche,
+        pagine_liberate=liberate,
+        auto_vacuum_incrementale=auto_vacuum == AUTO_VACUUM_INCREMENTAL,
+        wal_checkpoint=tuple(checkpoint) if checkpoint else None,
+    )
+
+
+def _freelist(db: sqlite3.Connection, schema: str) -> int:
+    return db.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+
+
+def _vacuum_incrementale(db: sqlite3.Connection, schema: str) -> int:
+    """Libera le pagine vuote a blocchi di VACUUM_PAGINE, una transazione breve per blocco."""
+    iniziali = restanti = _freelist(db, schema)
+    while restanti > 0:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # ogni riga del risultato è un passo del vacuum: va letto tutto perché venga eseguito
+            db.execute(f"PRAGMA {schema}.incremental_vacuum({VACUUM_PAGINE})").fetchall()
+            dopo = _freelist(db, schema)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if dopo >= restanti:
+            break
+        restanti = dopo
+    return iniziali - restanti
+
+
+def backup_db(destinazione: Path | None = None) -> list[Path]:
+    """
+    Backup a caldo di database e archivio nella cartella di destinazione (default BACKUP_DIR),
+    con nomi datati; tiene solo gli ultimi BACKUP_DA_TENERE backup di ciascun file.
+    """
+    cartella = destinazione or BACKUP_DIR
+    cartella.mkdir(parents=True, exist_ok=True)
+    marca = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    creati: list[Path] = []
+    for schema, sorgente in (("main", DB_PATH), (ARCHIVIO_SCHEMA, ARCHIVIO_PATH)):
+        file = cartella / f"{sorgente.stem}-{marca}{sorgente.suffix}"
+        _copia_online(schema, file)
+        creati.append(file)
+        _ruota(cartella, sorgente)
+    return creati
+
+
+def _copia_online(schema: str, file: Path) -> None:
+    # copia in un file temporaneo e rinomina: un backup interrotto non lascia mai un file valido a metà
+    parziale = file.with_name(file.name + ".parziale")
+    parziale.unlink(missing_ok=True)
+    raw = engine.raw_connection()
+    db = raw.driver_connection
+    scadenza = time.monotonic() + BACKUP_MAX_SECONDI
+    # il progress handler viene chiamato ogni N istruzioni della VM: un valore vero interrompe il VACUUM
+    db.set_progress_handler(lambda: time.monotonic() > scadenza, 10_000)
+    try:
+        db.execute(f"VACUUM {schema} INTO ?", (str(parziale),))
+        parziale.replace(file)
+    except sqlite3.OperationalError as e:
+        if time.monotonic() > scadenza:
+            raise TimeoutError(f"backup di {schema} interrotto dopo {BACKUP_MAX_SECONDI:.0f} s") from e
+        raise
+    finally:
+        db.set_progress_handler(None, 0)
+        raw.close()
+        parziale.unlink(missing_ok=True)
+
+
+def _ruota(cartella: Path, sorgente: Path) -> None:
+    backup = sorted(cartella.glob(f"{sorgente.stem}-*{sorgente.suffix}"))
+    for vecchio in backup[:-BACKUP_DA_TENERE] if BACKUP_DA_TENERE > 0 else []:
+        vecchio.unlink(missing_ok=True)
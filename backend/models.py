@@ -1,10 +1,12 @@
 from __future__ import annotations
 
 import enum
+import re
+import unicodedata
 import uuid
 from datetime import date, datetime
 
-from sqlalchemy import Boolean, Date, DateTime, Enum, ForeignKey, Integer, String, Text, UniqueConstraint
+from sqlalchemy import Boolean, Date, DateTime, Enum, ForeignKey, Index, Integer, String, Text, UniqueConstraint, event, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .db import Base
@@ -14,6 +16,30 @@ def new_uuid() -> str:
     return str(uuid.uuid4())
 
 
+def _normalizza(testo: str) -> str:
+    """'D'Angelo  Zoè' -> 'dangelozoe': senza accenti, maiuscole, spazi e punteggiatura."""
+    senza_accenti = unicodedata.normalize("NFKD", testo).encode("ascii", "ignore").decode()
+    return re.sub(r"[^0-9a-z]", "", senza_accenti.casefold())
+
+
+def stesso_nome(nome: str, cognome: str, altro_nome: str, altro_cognome: str) -> bool:
+    return _normalizza(nome) == _normalizza(altro_nome) and _normalizza(cognome) == _normalizza(altro_cognome)
+
+
+def chiavi_paziente(
+    nome: str, cognome: str, email: str | None, telefono: str | None
+) -> tuple[str | None, str | None]:
+    """
+    Chiavi di ricerca di un paziente: (cognome|nome|email, cognome|nome|telefono), il telefono solo cifre e senza
+    prefisso +39; salvate in pazienti.chiave_normalizzata e pazienti.chiave_telefono.
+    None senza email / telefono (il solo nome non basta a riconoscere una persona).
+    """
+    base = f"{_normalizza(cognome)}|{_normalizza(nome)}|"
+    chiave_email = base + email.strip().casefold() if email and email.strip() else None
+    cifre = re.sub(r"\D", "", re.sub(r"^\s*(\+|00)39", "", telefono)) if telefono else ""
+    return chiave_email, base + cifre if cifre else None
+
+
 class StatoAppuntamento(enum.Enum):
     PROGRAMMATO = "PROGRAMMATO"
     CONFERMATO = "CONFERMATO"
@@ -29,6 +55,11 @@ class TipoNotifica(enum.Enum):
     WAITLIST_PROMOSSA = "WAITLIST_PROMOSSA"
 
 
+class FrequenzaSerie(enum.Enum):
+    GIORNALIERA = "GIORNALIERA"
+    SETTIMANALE = "SETTIMANALE"
+
+
 class Medico(Base):
     __tablename__ = "medici"
 
@@ -64,6 +95,22 @@ class DisponibilitaMedico(Base):
 
     medico: Mapped["Medico"] = relationship(back_populates="disponibilita")
 
+class EccezioneCalendario(Base):
+    """
+    Giorni di indisponibilità (estremi inclusi):
+    - ferie/assenze di un medico (medico_id valorizzato)
+    - chiusure dello studio per tutti i medici (medico_id NULL), es. festività
+    """
+    __tablename__ = "eccezioni_calendario"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    medico_id: Mapped[str | None] = mapped_column(ForeignKey("medici.id"), nullable=True)
+    dal: Mapped[date] = mapped_column(Date, nullable=False)
+    al: Mapped[date] = mapped_column(Date, nullable=False)
+    motivo: Mapped[str | None] = mapped_column(String(200), nullable=True)
+    creata_il: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+
 class Paziente(Base):
     __tablename__ = "pazienti"
 
@@ -75,6 +122,10 @@ class Paziente(Base):
     email: Mapped[str | None] = mapped_column(String(120), nullable=True)
     codice_fiscale: Mapped[str | None] = mapped_column(String(16), nullable=True, unique=True)
 
+    # chiavi_paziente (aggiornate automaticamente): ricerca dei pazienti già registrati per email o per telefono
+    chiave_normalizzata: Mapped[str | None] = mapped_column(String(250), nullable=True, index=True)
+    chiave_telefono: Mapped[str | None] = mapped_column(String(250), nullable=True, index=True)
+
     contatti_emergenza: Mapped[list["ContattoEmergenza"]] = relationship(
         back_populates="paziente", cascade="all, delete-orphan"
     )
@@ -86,6 +137,12 @@ class Paziente(Base):
         return f"Paziente({self.nome} {self.cognome})"
 
 
+@event.listens_for(Paziente, "before_insert")
+@event.listens_for(Paziente, "before_update")
+def _aggiorna_chiave_paziente(_mapper, _conn, p: Paziente) -> None:
+    p.chiave_normalizzata, p.chiave_telefono = chiavi_paziente(p.nome, p.cognome, p.email, p.telefono)
+
+
 class ContattoEmergenza(Base):
     __tablename__ = "contatti_emergenza"
 
@@ -118,6 +175,21 @@ class TipoVisita(Base):
 
     appuntamenti: Mapped[list["Appuntamento"]] = relationship(back_populates="tipo_visita")
     waitlist: Mapped[list["ListaAttesa"]] = relationship(back_populates="tipo_visita")
+    requisiti: Mapped[list["RequisitoTipoVisita"]] = relationship(
+        back_populates="tipo_visita", cascade="all, delete-orphan"
+    )
+
+
+class RequisitoTipoVisita(Base):
+    """Attrezzatura necessaria per un tipo visita (stesso nome usato in attrezzature_sala, es. "ECG")."""
+    __tablename__ = "requisiti_tipo_visita"
+    __table_args__ = (UniqueConstraint("tipo_visita_id", "attrezzatura", name="uq_requisito_tipo_attrezzatura"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    tipo_visita_id: Mapped[int] = mapped_column(ForeignKey("tipi_visita.id"), nullable=False)
+    attrezzatura: Mapped[str] = mapped_column(String(120), nullable=False)
+
+    tipo_visita: Mapped["TipoVisita"] = relationship(back_populates="requisiti")
 
 
 class SalaVisita(Base):
@@ -146,9 +218,18 @@ class AttrezzaturaSala(Base):
 class Appuntamento(Base):
     __tablename__ = "appuntamenti"
     __table_args__ = (
-        # Evito doppie prenotazioni identiche (stesso medico + stessa sala + stesso orario)
-        UniqueConstraint("medico_id", "inizio", name="uq_app_medico_inizio"),
-        UniqueConstraint("sala_id", "inizio", name="uq_app_sala_inizio"),
+        # Evito doppie prenotazioni identiche (stesso medico + stessa sala + stesso orario).
+        # Indici parziali: uno slot annullato deve poter essere riassegnato (es. da lista d'attesa).
+        Index(
+            "uq_app_medico_inizio", "medico_id", "inizio",
+            unique=True, sqlite_where=text("stato != 'ANNULLATO'"),
+        ),
+        Index(
+            "uq_app_sala_inizio", "sala_id", "inizio",
+            unique=True, sqlite_where=text("stato != 'ANNULLATO'"),
+        ),
+        # Job promemoria: confermati in una finestra di date senza scansione della tabella
+        Index("ix_app_confermati_inizio", "inizio", sqlite_where=text("stato = 'CONFERMATO'")),
     )
 
     id: Mapped[str] = mapped_column(String(36), primary_key=True, default=new_uuid)
@@ -167,11 +248,40 @@ class Appuntamento(Base):
 
     note: Mapped[str | None] = mapped_column(Text, nullable=True)
 
+    # Appuntamento generato da una serie ricorrente (NULL per le prenotazioni singole)
+    serie_id: Mapped[str | None] = mapped_column(ForeignKey("serie_appuntamenti.id"), nullable=True)
+
     paziente: Mapped["Paziente"] = relationship(back_populates="appuntamenti")
     medico: Mapped["Medico"] = relationship(back_populates="appuntamenti")
     tipo_visita: Mapped["TipoVisita"] = relationship(back_populates="appuntamenti")
     sala: Mapped["SalaVisita"] = relationship(back_populates="appuntamenti")
     notifiche: Mapped[list["Notifica"]] = relationship(back_populates="appuntamento", cascade="all, delete-orphan")
+    serie: Mapped["SerieAppuntamenti | None"] = relationship(back_populates="appuntamenti")
+
+
+class SerieAppuntamenti(Base):
+    """
+    Serie ricorrente (es. fisioterapia settimanale per 12 settimane).
+    Regola: `occorrenze` appuntamenti a partire da `primo_inizio`, ogni `intervallo` giorni/settimane.
+    Le occorrenze prenotate sono normali righe di appuntamenti con serie_id valorizzato.
+    """
+    __tablename__ = "serie_appuntamenti"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=new_uuid)
+    paziente_id: Mapped[str] = mapped_column(ForeignKey("pazienti.id"), nullable=False)
+    medico_id: Mapped[str] = mapped_column(ForeignKey("medici.id"), nullable=False)
+    tipo_visita_id: Mapped[int] = mapped_column(ForeignKey("tipi_visita.id"), nullable=False)
+    sala_id: Mapped[int] = mapped_column(ForeignKey("sale_visita.id"), nullable=False)
+
+    primo_inizio: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    frequenza: Mapped[FrequenzaSerie] = mapped_column(Enum(FrequenzaSerie), nullable=False)
+    intervallo: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
+    occorrenze: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    creata_il: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    note: Mapped[str | None] = mapped_column(Text, nullable=True)
+
+    appuntamenti: Mapped[list["Appuntamento"]] = relationship(back_populates="serie")
 
 
 class ListaAttesa(Base):
@@ -193,6 +303,13 @@ class ListaAttesa(Base):
 
 class Notifica(Base):
     __tablename__ = "notifiche"
+    __table_args__ = (
+        # Al massimo un promemoria per appuntamento: il job può girare spesso con INSERT OR IGNORE
+        Index(
+            "uq_notifica_promemoria_app", "appuntamento_id",
+            unique=True, sqlite_where=text("tipo = 'PROMEMORIA' AND appuntamento_id IS NOT NULL"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     tipo: Mapped[TipoNotifica] = mapped_column(Enum(TipoNotifica), nullable=False)
@@ -212,4 +329,80 @@ class Notifica(Base):
         nullable=True,
     )
 
-    paziente = relationship("Paziente")
\ No newline at end of file
+    paziente = relationship("Paziente")
+
+
+class MetaVersione(Base):
+    """
+    Versioni salvate nel DB (es. "seed") per saltare all'avvio il lavoro già fatto, e altri valori interi
+    di servizio (soglia dell'archivio, vedi archivio.py).
+    La versione dello schema è invece in PRAGMA user_version (lettura senza tabelle).
+    """
+    __tablename__ = "meta_versioni"
+
+    chiave: Mapped[str] = mapped_column(String(40), primary_key=True)
+    valore: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class StatoJob(Base):
+    """
+    Stato dei job periodici dell'API: lock (lease) tra worker, tempi dell'ultima esecuzione e checkpoint.
+    Il worker che ha il lease lo rinnova a ogni esecuzione; se si ferma, un altro lo prende alla scadenza.
+    """
+    __tablename__ = "stato_job"
+
+    nome: Mapped[str] = mapped_column(String(60), primary_key=True)
+    bloccato_da: Mapped[str | None] = mapped_column(String(120), nullable=True)
+    bloccato_fino: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    ultimo_avvio: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    ultima_durata_ms: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    ultimo_esito: Mapped[str | None] = mapped_column(String(10), nullable=True)  # OK / ERRORE
+    ultimo_errore: Mapped[str | None] = mapped_column(Text, nullable=True)
+    elaborati: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    esecuzioni: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+    # inizio dell'ultima esecuzione riuscita (UTC), passato al job alla volta successiva
+    checkpoint: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+
+class VersioneTabella(Base):
+    """
+    Contatori di modifica per tabella condivisi tra processi (vedi versioni.py): incrementati nella stessa
+    transazione delle scritture, permettono a ogni worker di accorgersi delle modifiche fatte dagli altri.
+    """
+    __tablename__ = "versioni_tabelle"
+
+    tabella: Mapped[str] = mapped_column(String(60), primary_key=True)
+    versione: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class ChiaveIdempotenza(Base):
+    """
+    Richieste POST già eseguite con un header Idempotency-Key: una ripetizione (stessa chiave) riceve la risposta
+    salvata invece di rieseguire l'operazione. stato_http NULL = richiesta ancora in corso.
+    """
+    __tablename__ = "chiavi_idempotenza"
+
+    chiave: Mapped[str] = mapped_column(String(300), primary_key=True)  # endpoint + utente + chiave del client
+    impronta: Mapped[str] = mapped_column(String(64), nullable=False)  # sha256 del corpo della richiesta
+    stato_http: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    risposta: Mapped[str | None] = mapped_column(Text, nullable=True)  # JSON
+    creata_il: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class EventoModifica(Base):
+    """
+    Registro append-only delle modifiche a appuntamenti e pazienti, per la sincronizzazione incrementale dei
+    sistemi esterni (GET /api/changes?since=). Scritto nella stessa transazione della modifica.
+    AUTOINCREMENT: seq non viene mai riusato; con un solo scrittore alla volta l'ordine di seq è quello di commit.
+    """
+    __tablename__ = "eventi"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    creato_il: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    entita: Mapped[str] = mapped_column(String(20), nullable=False)  # appuntamento / paziente
+    entita_id: Mapped[str] = mapped_column(String(36), nullable=False)
+    operazione: Mapped[str] = mapped_column(String(20), nullable=False)  # creato, modificato, annullato, ...
+    dati: Mapped[str] = mapped_column(Text, nullable=False)  # JSON: la riga dopo la modifica
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import threading
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, AsyncIterator, Callable
+
+from fastapi import Request
+from sqlalchemy.orm import Session
+
+from .db import al_commit
+from .models import Appuntamento, Notifica, Paziente, SalaVisita, TipoVisita
+from .versioni import registra_invalidazione
+
+# Pub/sub in processo per le pagine Agenda e Notifiche (endpoint SSE /api/stream/...).
+# Le scritture pubblicano gli eventi con al_commit: un evento parte solo se la transazione va a buon fine,
+# e un SAVEPOINT annullato scarta i propri. Gli eventi contengono la riga già nel formato delle liste
+# (/api/agenda, /api/notifiche/pendenti), così il client la applica senza riscaricare la lista.
+# Le scritture in blocco (assenze, completamento, promemoria) pubblicano un solo evento "ricarica".
+# Ogni canale tiene gli ultimi STORIA_EVENTI eventi: un client che si riconnette con Last-Event-ID riceve
+# quelli persi; se sono troppo vecchi (o il server è ripartito) riceve "ricarica".
+# Con più worker uvicorn le scritture degli altri processi arrivano come "ricarica" (vedi versioni.py).
+
+CANALE_AGENDA = "agenda"
+CANALE_NOTIFICHE = "notifiche"
+
+STORIA_EVENTI = 500
+CODA_MAX = 1000          # eventi in attesa per client lento; oltre, il client riceve "ricarica"
+HEARTBEAT_SECONDI = 15   # commento SSE periodico: tiene aperta la connessione attraverso i proxy
+
+# Gli id degli eventi iniziano con l'id di questo avvio: un Last-Event-ID di un altro avvio non è valido
+_AVVIO = uuid.uuid4().hex[:8]
+
+RICARICA = {"azione": "ricarica"}
+
+
+@dataclass(frozen=True)
+class Evento:
+    seq: int
+    dati: dict[str, Any]
+
+    @property
+    def id(self) -> str:
+        return f"{_AVVIO}-{self.seq}"
+
+
+class Iscrizione:
+    """Coda asyncio di un client SSE; gli eventi arrivano dai thread di scrittura."""
+
+    def __init__(self, canale: str, filtro: Callable[[dict[str, Any]], bool]) -> None:
+        self.canale = canale
+        self.filtro = filtro
+        self.coda: asyncio.Queue[Evento] = asyncio.Queue(CODA_MAX)
+        self.persa = False
+        self._loop = asyncio.get_running_loop()
+
+    def consegna(self, evento: Evento) -> None:
+        self._loop.call_soon_threadsafe(self._metti, evento)
+
+    def _metti(self, evento: Evento) -> None:
+        try:
+            self.coda.put_nowait(evento)
+        except asyncio.QueueFull:
+            self.persa = True
+
+
+class Broker:
+    def __init__(self, storia: int = STORIA_EVENTI) -> None:
+        self._seq = itertools.count(1)
+        self._storia: dict[str, deque[Evento]] = {}
+        self._scartato: dict[str, int] = {}  # ultimo seq uscito dalla storia del canale
+        self._iscritti: dict[str, set[Iscrizione]] = {}
+        self._max_storia = storia
+        self._lock = threading.Lock()
+
+    def pubblica(self, canale: str, dati: dict[str, Any]) -> None:
+        with self._lock:
+            evento = Evento(next(self._seq), dati)
+            storia = self._storia.setdefault(canale, deque())
+            storia.append(evento)
+            if len(storia) > self._max_storia:
+                self._scartato[canale] = storia.popleft().seq
+            iscritti = list(self._iscritti.get(canale, ()))
+        for i in iscritti:
+            if dati is RICARICA or i.filtro(dati):
+                i.consegna(evento)
+
+    def iscrivi(self, iscrizione: Iscrizione, ultimo_id: str | None) -> list[Evento] | None:
+        """Registra il client; ritorna gli eventi persi dopo ultimo_id, None se non recuperabili."""
+        with self._lock:
+            self._iscritti.setdefault(iscrizione.canale, set()).add(iscrizione)
+            if ultimo_id is None:
+                return []
+            avvio, _, seq = ultimo_id.partition("-")
+            if avvio != _AVVIO or not seq.isdigit() or int(seq) < self._scartato.get(iscrizione.canale, 0):
+                return None
+            return [
+                e
+                for e in self._storia.get(iscrizione.canale, ())
+                if e.seq > int(seq) and (e.dati is RICARICA or iscrizione.filtro(e.dati))
+            ]
+
+    def disiscrivi(self, iscrizione: Iscrizione) -> None:
+        with self._lock:
+            self._iscritti.get(iscrizione.canale, set()).discard(iscrizione)
+
+
+broker = Broker()
+# modifiche fatte da altri processi: non conosco le righe, i client rileggono la lista
+registra_invalidazione(partial(broker.pubblica, CANALE_AGENDA, RICARICA), "appuntamenti")
+registra_invalidazione(partial(broker.pubblica, CANALE_NOTIFICHE, RICARICA), "notifiche")
+
+
+def pubblica(s: Session, canale: str, dati: dict[str, Any]) -> None:
+    """Pubblica dati sul canale dopo il COMMIT della transazione corrente."""
+    al_commit(s, partial(broker.pubblica, canale, dati))
+
+
+def pubblica_ricarica(s: Session, *canali: str) -> None:
+    for canale in canali:
+        pubblica(s, canale, RICARICA)
+
+
+def pubblica_appuntamento(s: Session, app: Appuntamento) -> None:
+    """Riga dell'agenda (stesso formato di /api/agenda, più id, medico e giorno) dopo una modifica."""
+    sala = s.get(SalaVisita, app.sala_id)
+    tipo = s.get(TipoVisita, app.tipo_visita_id)
+    pubblica(
+        s,
+        CANALE_AGENDA,
+        {
+            "azione": "appuntamento",
+            "id": app.id,
+            "medico_id": app.medico_id,
+            "giorno": app.inizio.date().isoformat(),
+            "inizio": app.inizio.strftime("%H:%M"),
+            "fine": app.fine.strftime("%H:%M"),
+            "stato": app.stato.value,
+            "note": app.note,
+            "sala": sala.nome if sala else None,
+            "tipo_visita": tipo.nome if tipo else None,
+        },
+    )
+
+
+def pubblica_notifica(s: Session, n: Notifica) -> None:
+    """Nuova notifica pendente (stesso formato di /api/notifiche/pendenti). n deve avere già l'id (flush)."""
+    paziente_id = n.paziente_id
+    if paziente_id is None and n.appuntamento_id is not None:
+        app = s.get(Appuntamento, n.appuntamento_id)
+        paziente_id = app.paziente_id if app else None
+    p = s.get(Paziente, paziente_id) if paziente_id else None
+    pubblica(
+        s,
+        CANALE_NOTIFICHE,
+        {
+            "azione": "creata",
+            "id": n.id,
+            "tipo": n.tipo.value,
+            "creata_il": n.creata_il.isoformat(),
+            "messaggio": n.messaggio,
+            "appuntamento_id": n.appuntamento_id,
+            "paziente_id": n.paziente_id,
+            "paziente_nome": p.nome if p else None,
+            "paziente_cognome": p.cognome if p else None,
+            "paziente": f"{p.cognome} {p.nome}" if p else None,
+        },
+    )
+
+
+def aggiungi_notifica(s: Session, n: Notifica) -> Notifica:
+    """Inserisce la notifica e la pubblica sul canale notifiche."""
+    s.add(n)
+    s.flush()
+    pubblica_notifica(s, n)
+    return n
+
+
+def _formatta(evento: Evento) -> bytes:
+    return f"id: {evento.id}\ndata: {json.dumps(evento.dati, default=str)}\n\n".encode()
+
+
+async def flusso_sse(
+    request: Request, canale: str, filtro: Callable[[dict[str, Any]], bool], ultimo_id: str | None
+) -> AsyncIterator[bytes]:
+    """Corpo di una risposta text/event-stream: eventi persi (Last-Event-ID), poi quelli nuovi."""
+    iscrizione = Iscrizione(canale, filtro)
+    arretrati = broker.iscrivi(iscrizione, ultimo_id)
+    try:
+        yield b"retry: 3000\n\n"
+        if arretrati is None:
+            yield f"data: {json.dumps(RICARICA)}\n\n".encode()
+        else:
+            for e in arretrati:
+                yield _formatta(e)
+
+        while True:
+            try:
+                evento = await asyncio.wait_for(iscrizione.coda.get(), HEARTBEAT_SECONDI)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield b": ping\n\n"
+                continue
+
+            if iscrizione.persa:
+                # client troppo lento: gli eventi in coda non bastano più, deve rileggere la lista
+                while not iscrizione.coda.empty():
+                    evento = iscrizione.coda.get_nowait()
+                iscrizione.persa = False
+                yield f"id: {evento.id}\ndata: {json.dumps(RICARICA)}\n\n".encode()
+                continue
+            yield _formatta(evento)
+    finally:
+        broker.disiscrivi(iscrizione)
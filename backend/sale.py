@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .disponibilita import ORARIO_STUDIO, hm_to_min, occupati, sovrapposto, unisci
+from .models import AttrezzaturaSala, RequisitoTipoVisita, SalaVisita
+from .versioni import versioni
+
+# Assegnazione automatica delle sale.
+# Le attrezzature sono codificate come bit (una posizione per nome): ogni sala attiva ha il bitset di ciò
+# che contiene, ogni tipo visita quello di ciò che richiede; una sala è adatta se (sala & richiesto) == richiesto.
+# I bitset si ricalcolano solo quando cambiano i contatori di "sale_visita" o "tipi_visita"
+# (chi modifica sale, attrezzature o requisiti deve chiamare incrementa su quelle tabelle).
+
+TABELLE_CATALOGO = ("sale_visita", "tipi_visita")
+
+
+@dataclass(frozen=True)
+class CatalogoSale:
+    bit: dict[str, int]        # attrezzatura -> maschera a un bit
+    sale: dict[int, int]       # sala attiva -> bitset attrezzature presenti
+    requisiti: dict[int, int]  # tipo visita -> bitset attrezzature richieste
+
+    def adatta(self, sala_id: int, tipo_visita_id: int) -> bool:
+        richiesto = self.requisiti.get(tipo_visita_id, 0)
+        return sala_id in self.sale and self.sale[sala_id] & richiesto == richiesto
+
+    def adatte(self, tipo_visita_id: int) -> list[int]:
+        richiesto = self.requisiti.get(tipo_visita_id, 0)
+        return [sl for sl, presenti in self.sale.items() if presenti & richiesto == richiesto]
+
+
+_catalogo: tuple[tuple[int, ...], CatalogoSale] | None = None
+_lock = threading.Lock()
+
+
+def catalogo_sale(s: Session) -> CatalogoSale:
+    """Bitset di sale e tipi visita (ricalcolati solo se le tabelle sono cambiate)."""
+    global _catalogo
+    ver = versioni(*TABELLE_CATALOGO)
+    with _lock:
+        if _catalogo is not None and _catalogo[0] == ver:
+            return _catalogo[1]
+
+    bit: dict[str, int] = {}
+
+    def _maschera(nome: str) -> int:
+        return bit.setdefault(nome, 1 << len(bit))
+
+    sale = {sl: 0 for sl in s.scalars(select(SalaVisita.id).where(SalaVisita.attiva.is_(True)).order_by(SalaVisita.id))}
+    for sala_id, nome in s.execute(select(AttrezzaturaSala.sala_id, AttrezzaturaSala.nome)):
+        if sala_id in sale:
+            sale[sala_id] |= _maschera(nome)
+
+    requisiti: dict[int, int] = {}
+    for tipo_visita_id, nome in s.execute(select(RequisitoTipoVisita.tipo_visita_id, RequisitoTipoVisita.attrezzatura)):
+        requisiti[tipo_visita_id] = requisiti.get(tipo_visita_id, 0) | _maschera(nome)
+
+    cat = CatalogoSale(bit, sale, requisiti)
+    with _lock:
+        _catalogo = (ver, cat)
+    return cat
+
+
+def scegli_sala(s: Session, tipo_visita_id: int, inizio: datetime, fine: datetime) -> int | None:
+    """
+    Sala libera e attrezzata per il tipo visita in [inizio, fine), None se non ce n'è.
+    Politica anti-frammentazione (best fit): tra le sale possibili preferisce quella in cui la visita
+    lascia meno tempo libero inutilizzabile attorno a sé (attaccata ad altre visite o al bordo dell'orario);
+    a parità, la sala con meno attrezzature, per lasciare libere quelle più attrezzate.
+    """
+    cat = catalogo_sale(s)
+    candidate = cat.adatte(tipo_visita_id)
+    if not candidate:
+        return None
+
+    giorno = inizio.date()
+    mezzanotte = datetime.combine(giorno, time.min)
+    apertura = mezzanotte + timedelta(minutes=hm_to_min(ORARIO_STUDIO[0]))
+    chiusura = mezzanotte + timedelta(minutes=hm_to_min(ORARIO_STUDIO[1]))
+    if not (apertura <= inizio and fine <= chiusura):
+        apertura, chiusura = mezzanotte, mezzanotte + timedelta(days=1)
+
+    _, occ_sala = occupati(s, set(), set(candidate), apertura, chiusura)
+
+    scelta: tuple[timedelta, int, int] | None = None
+    for sala_id in candidate:
+        uniti = unisci(occ_sala[sala_id])
+        if sovrapposto(uniti, inizio, fine):
+            continue
+        prima = max([b for a, b in uniti if b <= inizio], default=apertura)
+        dopo = min([a for a, b in uniti if a >= fine], default=chiusura)
+        chiave = ((inizio - prima) + (dopo - fine), cat.sale[sala_id].bit_count(), sala_id)
+        if scelta is None or chiave < scelta:
+            scelta = chiave
+    return scelta[2] if scelta else None
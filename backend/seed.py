@@ -1,59 +1,108 @@
 from __future__ import annotations
 
-from sqlalchemy import select
+from sqlalchemy import and_, exists, insert, literal, select
 
 from .db import db_session
-from .models import AttrezzaturaSala, Medico, SalaVisita, TipoVisita
+from .models import AttrezzaturaSala, Medico, MetaVersione, RequisitoTipoVisita, SalaVisita, TipoVisita, new_uuid
+
+# Da incrementare quando cambiano i dati qui sotto: all'avvio il seed viene saltato
+# se il DB ha già questa versione (una sola SELECT).
+SEED_VERSION = 2
+
+TIPI_VISITA = [
+    ("Visita Generale", 30),
+    ("Controllo", 20),
+    ("Visita Specialistica", 45),
+    ("ECG", 25),
+    ("Ecografia", 35),
+]
+
+SALE = ["Sala 1", "Sala 2"]
+
+MEDICI = [
+    ("Mario", "Rossi", "Medicina Generale", "m.rossi@studio.local"),
+    ("Laura", "Bianchi", "Cardiologia", "l.bianchi@studio.local"),
+]
+
+# Attrezzature (semplice esempio)
+ATTREZZATURE = [
+    ("Sala 1", "ECG"),
+    ("Sala 2", "Ecoscopio"),
+]
+
+# Attrezzature richieste dai tipi visita (la sala viene scelta tra quelle che le hanno tutte)
+REQUISITI = [
+    ("ECG", "ECG"),
+    ("Ecografia", "Ecoscopio"),
+]
 
 
 def seed_base() -> None:
     """
-    Popola dati minimi (idempotente):
+    Popola dati minimi (idempotente, con poche istruzioni set-based):
     - medici
     - sale
     - tipi visita
     - attrezzature sale
+    - attrezzature richieste dai tipi visita
     """
     with db_session() as s:
-        # Tipi visita
-        tipi = [
-            ("Visita Generale", 30),
-            ("Controllo", 20),
-            ("Visita Specialistica", 45),
-        ]
-        for nome, durata in tipi:
-            if s.execute(select(TipoVisita).where(TipoVisita.nome == nome)).scalar_one_or_none() is None:
-                s.add(TipoVisita(nome=nome, durata_minuti=durata))
-
-        # Sale
-        sale = ["Sala 1", "Sala 2"]
-        for nome in sale:
-            if s.execute(select(SalaVisita).where(SalaVisita.nome == nome)).scalar_one_or_none() is None:
-                s.add(SalaVisita(nome=nome, attiva=True))
-
-        # Medici
-        medici = [
-            ("Mario", "Rossi", "Medicina Generale", "m.rossi@studio.local"),
-            ("Laura", "Bianchi", "Cardiologia", "l.bianchi@studio.local"),
-        ]
-        for nome, cognome, spec, email in medici:
-            exists = s.execute(
-                select(Medico).where(Medico.nome == nome, Medico.cognome == cognome, Medico.specializzazione == spec)
-            ).scalar_one_or_none()
-            if exists is None:
-                s.add(Medico(nome=nome, cognome=cognome, specializzazione=spec, email=email))
-
-        s.flush()
-
-        # Attrezzature (semplice esempio)
-        sala1 = s.execute(select(SalaVisita).where(SalaVisita.nome == "Sala 1")).scalar_one()
-        sala2 = s.execute(select(SalaVisita).where(SalaVisita.nome == "Sala 2")).scalar_one()
-
-        def add_tool(sala_id: int, tool: str) -> None:
-            if s.execute(
-                select(AttrezzaturaSala).where(AttrezzaturaSala.sala_id == sala_id, AttrezzaturaSala.nome == tool)
-            ).scalar_one_or_none() is None:
-                s.add(AttrezzaturaSala(sala_id=sala_id, nome=tool))
-
-        add_tool(sala1.id, "ECG")
-        add_tool(sala2.id, "Ecoscopio")
+        v = s.get(MetaVersione, "seed")
+        if v is not None and v.valore >= SEED_VERSION:
+            return
+
+        # Tipi visita e sale hanno il nome univoco: INSERT OR IGNORE
+        s.execute(
+            insert(TipoVisita).prefix_with("OR IGNORE"),
+            [{"nome": nome, "durata_minuti": durata} for nome, durata in TIPI_VISITA],
+        )
+        s.execute(
+            insert(SalaVisita).prefix_with("OR IGNORE"),
+            [{"nome": nome, "attiva": True} for nome in SALE],
+        )
+
+        # Medici: nessun vincolo univoco, INSERT ... SELECT ... WHERE NOT EXISTS
+        for nome, cognome, spec, email in MEDICI:
+            s.execute(
+                insert(Medico).from_select(
+                    ["id", "nome", "cognome", "specializzazione", "email", "attivo"],
+                    select(
+                        literal(new_uuid()),
+                        literal(nome),
+                        literal(cognome),
+                        literal(spec),
+                        literal(email),
+                        literal(True),
+                    ).where(
+                        ~exists().where(
+                            and_(Medico.nome == nome, Medico.cognome == cognome, Medico.specializzazione == spec)
+                        )
+                    ),
+                )
+            )
+
+        for sala, tool in ATTREZZATURE:
+            s.execute(
+                insert(AttrezzaturaSala).from_select(
+                    ["sala_id", "nome"],
+                    select(SalaVisita.id, literal(tool)).where(
+                        SalaVisita.nome == sala,
+                        ~exists().where(and_(AttrezzaturaSala.sala_id == SalaVisita.id, AttrezzaturaSala.nome == tool)),
+                    ),
+                )
+            )
+
+        for tipo, tool in REQUISITI:
+            s.execute(
+                insert(RequisitoTipoVisita).from_select(
+                    ["tipo_visita_id", "attrezzatura"],
+                    select(TipoVisita.id, literal(tool)).where(
+                        TipoVisita.nome == tipo,
+                        ~exists().where(
+                            and_(RequisitoTipoVisita.tipo_visita_id == TipoVisita.id, RequisitoTipoVisita.attrezzatura == tool)
+                        ),
+                    ),
+                )
+            )
+
+        s.merge(MetaVersione(chiave="seed", valore=SEED_VERSION))
@@ -1,32 +1,169 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from datetime import date, datetime, timedelta
-from typing import Any
-
-from sqlalchemy import and_, select, func
+import heapq
+import os
+from bisect import insort
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+from typing import Any, Iterator
+
+from sqlalchemy import and_, bindparam, delete, insert, literal, literal_column, or_, select, func, update
 from sqlalchemy.sql import func
 
-from .db import Base, db_session, engine
+from .archivio import appuntamenti_dal, appuntamenti_paziente, crea_archivio
+from .calendario import calendario
+from .db import ARCHIVIO_SCHEMA, Base, db_read_session, db_session, engine
+from .eventi import APPUNTAMENTO, PAZIENTE, registra_appuntamento, registra_eventi, registra_paziente
+from .disponibilita import (
+    SLOT_MINUTI,
+    alternative_vicine,
+    griglia_libera,
+    inizi_liberi,
+    occupati,
+    sottrai,
+    sovrapposto,
+    unisci,
+)
 from .models import (
     Appuntamento,
+    DisponibilitaMedico,
+    EccezioneCalendario,
+    FrequenzaSerie,
     ListaAttesa,
     Medico,
     Notifica,
     Paziente,
     SalaVisita,
+    SerieAppuntamenti,
     StatoAppuntamento,
     TipoNotifica,
     TipoVisita,
+    chiavi_paziente,
+    new_uuid,
+    stesso_nome,
 )
+from .pubsub import (
+    CANALE_AGENDA,
+    CANALE_NOTIFICHE,
+    aggiungi_notifica,
+    pubblica,
+    pubblica_appuntamento,
+    pubblica_ricarica,
+)
+from .sale import catalogo_sale, scegli_sala
+from .versioni import incrementa
+from .waitlist import IntervalloLibero, waitlist_engine
+from .write_queue import esegui_scrittura
 
 
 
 # Bootstrap DB
 
+# Da incrementare a ogni modifica di schema (nuove tabelle/indici o migrazioni in init_db)
+SCHEMA_VERSION = 14
+
+
 def init_db() -> None:
-    """Crea le tabelle se non esistono."""
+    """
+    Crea le tabelle se non esistono.
+    Percorso veloce: se PRAGMA user_version (del DB e dell'archivio) è già alla versione corrente non fa nulla
+    (niente riflessione di tutte le tabelle a ogni avvio di API o CLI).
+    """
+    with engine.connect() as conn:
+        if min(
+            conn.exec_driver_sql("PRAGMA user_version").scalar(),
+            conn.exec_driver_sql(f"PRAGMA {ARCHIVIO_SCHEMA}.user_version").scalar(),
+        ) >= SCHEMA_VERSION:
+            return
+
+    from . import auth_models  # noqa: F401  (registra la tabella utenti nel metadata)
+
+    _aggiungi_colonne_mancanti()
+    _migra_vincoli_appuntamenti()
     Base.metadata.create_all(bind=engine)
+    _crea_indici_mancanti()
+    _calcola_chiavi_pazienti()
+    crea_archivio()
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.exec_driver_sql(f"PRAGMA {ARCHIVIO_SCHEMA}.user_version = {SCHEMA_VERSION}")
+
+
+# Colonne aggiunte dopo la creazione delle tabelle: (tabella, colonna, DDL della colonna)
+COLONNE_AGGIUNTE = [
+    ("appuntamenti", "serie_id", "serie_id VARCHAR(36) REFERENCES serie_appuntamenti(id)"),
+    ("pazienti", "chiave_normalizzata", "chiave_normalizzata VARCHAR(250)"),
+    ("pazienti", "chiave_telefono", "chiave_telefono VARCHAR(250)"),
+]
+
+
+def _aggiungi_colonne_mancanti() -> None:
+    """DB esistenti: ALTER TABLE ... ADD COLUMN per le colonne nuove (le tabelle nuove le crea create_all)."""
+    with engine.begin() as conn:
+        for tabella, colonna, ddl in COLONNE_AGGIUNTE:
+            esistenti = {r[1] for r in conn.exec_driver_sql(f"PRAGMA table_info({tabella})")}
+            if esistenti and colonna not in esistenti:
+                conn.exec_driver_sql(f"ALTER TABLE {tabella} ADD COLUMN {ddl}")
+
+
+def _crea_indici_mancanti() -> None:
+    """create_all non aggiunge indici a tabelle già esistenti: li crea qui (IF NOT EXISTS)."""
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def _calcola_chiavi_pazienti() -> None:
+    """
+    Pazienti creati prima delle colonne chiave_*: le calcola (le righe nuove le ricevono all'INSERT).
+    Prima di chiave_telefono chi non aveva email aveva la chiave del telefono in chiave_normalizzata: ricalcolo
+    entrambe per tutti i pazienti con un telefono e senza chiave_telefono.
+    """
+    with engine.begin() as conn:
+        rows = conn.execute(
+            select(Paziente.id, Paziente.nome, Paziente.cognome, Paziente.email, Paziente.telefono).where(
+                or_(
+                    Paziente.chiave_normalizzata.is_(None),
+                    and_(Paziente.chiave_telefono.is_(None), Paziente.telefono.is_not(None)),
+                )
+            )
+        ).all()
+        valori = []
+        for r in rows:
+            chiave_email, chiave_telefono = chiavi_paziente(r.nome, r.cognome, r.email, r.telefono)
+            valori.append({"pid": r.id, "chiave": chiave_email, "chiave_tel": chiave_telefono})
+        if valori:
+            conn.execute(
+                update(Paziente)
+                .where(Paziente.id == bindparam("pid"))
+                .values(chiave_normalizzata=bindparam("chiave"), chiave_telefono=bindparam("chiave_tel")),
+                valori,
+            )
+
+
+def _migra_vincoli_appuntamenti() -> None:
+    """
+    DB creati con le vecchie UNIQUE(medico_id, inizio) / UNIQUE(sala_id, inizio) su tutta la tabella:
+    ricrea `appuntamenti` con gli indici parziali (esclusi gli ANNULLATO), mantenendo i dati.
+    """
+    with engine.begin() as conn:
+        ddl = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'appuntamenti'"
+        ).scalar()
+        if not ddl or "CONSTRAINT uq_app_medico_inizio UNIQUE" not in ddl:
+            return
+
+        colonne = ", ".join(c.name for c in Appuntamento.__table__.columns)
+        # legacy_alter_table: il RENAME non deve riscrivere le FK di notifiche verso la tabella temporanea
+        conn.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+        conn.exec_driver_sql("ALTER TABLE appuntamenti RENAME TO _appuntamenti_old")
+        Appuntamento.__table__.create(conn)
+        conn.exec_driver_sql(f"INSERT INTO appuntamenti ({colonne}) SELECT {colonne} FROM _appuntamenti_old")
+        conn.exec_driver_sql("DROP TABLE _appuntamenti_old")
+        conn.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
 
 
 
@@ -38,17 +175,126 @@ class EsitoPrenotazione:
     appuntamento_id: str | None
     messo_in_waitlist: bool
     messaggio: str
+    sala_id: int | None = None
+
+
+@dataclass(frozen=True)
+class ConflittoSerie:
+    inizio: datetime
+    motivo: str
+    alternative: tuple[datetime, ...]
+
+
+@dataclass(frozen=True)
+class EsitoSerie:
+    ok: bool
+    serie_id: str | None
+    prenotati: list[str]
+    conflitti: list[ConflittoSerie]
+    messaggio: str
+
+
+@dataclass(frozen=True)
+class EsitoAssenza:
+    annullati: int
+    riassegnati_da_waitlist: int
 
 
 
 # CRUD base
 
-def crea_paziente(nome: str, cognome: str, email: str | None = None, telefono: str | None = None) -> str:
-    with db_session() as s:
-        p = Paziente(nome=nome.strip(), cognome=cognome.strip(), email=email, telefono=telefono)
-        s.add(p)
-        s.flush()
-        return p.id
+def crea_paziente(
+    nome: str, cognome: str, email: str | None = None, telefono: str | None = None, codice_fiscale: str | None = None
+) -> str:
+    return esegui_scrittura(_crea_paziente, nome, cognome, email, telefono, codice_fiscale)
+
+
+def _crea_paziente(
+    s,
+    nome: str,
+    cognome: str,
+    email: str | None = None,
+    telefono: str | None = None,
+    codice_fiscale: str | None = None,
+) -> str:
+    p = Paziente(
+        nome=nome.strip(),
+        cognome=cognome.strip(),
+        email=email,
+        telefono=telefono,
+        codice_fiscale=codice_fiscale.strip().upper() if codice_fiscale else None,
+    )
+    s.add(p)
+    s.flush()
+    incrementa(s, "pazienti")
+    registra_paziente(s, p, "creato")
+    return p.id
+
+
+def trova_o_crea_paziente(
+    nome: str, cognome: str, email: str | None = None, telefono: str | None = None, codice_fiscale: str | None = None
+) -> tuple[str, bool]:
+    """
+    Paziente già registrato (per codice fiscale con lo stesso nome, altrimenti per cognome + nome + email o telefono
+    normalizzati), oppure nuovo paziente. Ritorna (paziente_id, creato).
+    """
+    return esegui_scrittura(_trova_o_crea_paziente, nome, cognome, email, telefono, codice_fiscale)
+
+
+def _trova_o_crea_paziente(
+    s,
+    nome: str,
+    cognome: str,
+    email: str | None = None,
+    telefono: str | None = None,
+    codice_fiscale: str | None = None,
+    completa_cf: bool = True,
+) -> tuple[str, bool]:
+    # completa_cf=False per i chiamanti non autenticati: nome + email non bastano a scrivere un codice fiscale
+    # sulla scheda di un paziente esistente
+    cf = codice_fiscale.strip().upper() if codice_fiscale and codice_fiscale.strip() else None
+    if cf is not None:
+        p = s.execute(select(Paziente.id, Paziente.nome, Paziente.cognome).where(Paziente.codice_fiscale == cf)).first()
+        if p is not None:
+            if stesso_nome(nome, cognome, p.nome, p.cognome):
+                return p.id, False
+            # codice fiscale di un paziente con un altro nome: conoscere un codice fiscale non basta a prenotare
+            # a nome di un altro. Lo ignoro (nessun errore: non rivela chi è paziente), il personale verificherà
+            cf = None
+
+    pid = _trova_paziente(s, nome, cognome, email, telefono, cf)
+    if pid is None:
+        return _crea_paziente(s, nome, cognome, email, telefono, cf), True
+    if cf is not None and completa_cf:
+        # riconosciuto per nome e contatto: completo il codice fiscale se mancava
+        aggiornato = s.execute(
+            update(Paziente)
+            .where(Paziente.id == pid, Paziente.codice_fiscale.is_(None))
+            .values(codice_fiscale=cf)
+            .returning(*Paziente.__table__.c)
+        ).mappings().first()
+        if aggiornato is not None:
+            incrementa(s, "pazienti")
+            registra_eventi(s, PAZIENTE, "modificato", [aggiornato])
+    return pid, False
+
+
+def _trova_paziente(
+    s, nome: str, cognome: str, email: str | None, telefono: str | None, cf: str | None
+) -> str | None:
+    # lookup sugli indici chiave_normalizzata / chiave_telefono; a parità il paziente registrato per primo
+    chiave_email, chiave_telefono = chiavi_paziente(nome, cognome, email, telefono)
+    condizioni = []
+    if chiave_email is not None:
+        condizioni.append(Paziente.chiave_normalizzata == chiave_email)
+    if chiave_telefono is not None:
+        condizioni.append(Paziente.chiave_telefono == chiave_telefono)
+    if not condizioni:
+        return None
+    q = select(Paziente.id).where(or_(*condizioni))
+    if cf is not None:
+        q = q.where(Paziente.codice_fiscale.is_(None))  # un codice fiscale diverso è un'altra persona
+    return s.scalar(q.order_by(literal_column("pazienti.rowid")).limit(1))
 
 
 def crea_medico(nome: str, cognome: str, specializzazione: str, email: str | None = None) -> str:
@@ -56,6 +302,7 @@ def crea_medico(nome: str, cognome: str, specializzazione: str, email: str | Non
         m = Medico(nome=nome.strip(), cognome=cognome.strip(), specializzazione=specializzazione.strip(), email=email)
         s.add(m)
         s.flush()
+        incrementa(s, "medici")
         return m.id
 
 
@@ -106,36 +353,40 @@ def agenda_giornaliera_flat(medico_id: str, giorno: date) -> list[dict]:
     """
     Versione 'flat' (safe per Streamlit/API): ritorna dict serializzabili.
     Evita lazy-load e DetachedInstanceError.
+    Copre anche gli appuntamenti archiviati (agenda di giorni passati, prima della soglia dell'archivio).
     """
     start_day = datetime.combine(giorno, datetime.min.time())
     end_day = start_day + timedelta(days=1)
 
-    with db_session() as s:
+    with db_read_session() as s:
+        a = appuntamenti_dal(s, start_day)
         q = (
             select(
-                Appuntamento.inizio,
-                Appuntamento.fine,
-                Appuntamento.stato,
-                Appuntamento.note,
+                a.c.id,
+                a.c.inizio,
+                a.c.fine,
+                a.c.stato,
+                a.c.note,
                 SalaVisita.nome.label("sala_nome"),
                 TipoVisita.nome.label("tipo_nome"),
             )
-            .join(SalaVisita, SalaVisita.id == Appuntamento.sala_id)
-            .join(TipoVisita, TipoVisita.id == Appuntamento.tipo_visita_id)
+            .join(SalaVisita, SalaVisita.id == a.c.sala_id)
+            .join(TipoVisita, TipoVisita.id == a.c.tipo_visita_id)
             .where(
                 and_(
-                    Appuntamento.medico_id == medico_id,
-                    Appuntamento.inizio >= start_day,
-                    Appuntamento.inizio < end_day,
-                    Appuntamento.stato != StatoAppuntamento.ANNULLATO,
+                    a.c.medico_id == medico_id,
+                    a.c.inizio >= start_day,
+                    a.c.inizio < end_day,
+                    a.c.stato != StatoAppuntamento.ANNULLATO,
                 )
             )
-            .order_by(Appuntamento.inizio.asc())
+            .order_by(a.c.inizio.asc())
         )
 
         rows = s.execute(q).all()
         return [
             {
+                "id": r.id,
                 "inizio": r.inizio.strftime("%H:%M"),
                 "fine": r.fine.strftime("%H:%M"),
                 "stato": r.stato.value,
@@ -147,13 +398,83 @@ def agenda_giornaliera_flat(medico_id: str, giorno: date) -> list[dict]:
         ]
 
 
+def storico_paziente_flat(paziente_id: str, limit: int | None = None, offset: int = 0) -> list[dict[str, Any]] | None:
+    """Appuntamenti del paziente, dal più recente, inclusi quelli archiviati (None se il paziente non esiste)."""
+    with db_read_session() as s:
+        if s.get(Paziente, paziente_id) is None:
+            return None
+        a = appuntamenti_paziente(s, paziente_id)
+        q = (
+            select(
+                a.c.id,
+                a.c.inizio,
+                a.c.fine,
+                a.c.stato,
+                a.c.note,
+                Medico.cognome.label("medico_cognome"),
+                SalaVisita.nome.label("sala_nome"),
+                TipoVisita.nome.label("tipo_nome"),
+            )
+            .join(Medico, Medico.id == a.c.medico_id)
+            .join(SalaVisita, SalaVisita.id == a.c.sala_id)
+            .join(TipoVisita, TipoVisita.id == a.c.tipo_visita_id)
+            .where(a.c.paziente_id == paziente_id)
+            .order_by(a.c.inizio.desc())
+            .limit(limit)
+            .offset(offset)
+        )
+        return [
+            {
+                "id": r.id,
+                "inizio": r.inizio.isoformat(),
+                "fine": r.fine.isoformat(),
+                "stato": r.stato.value,
+                "note": r.note,
+                "medico": r.medico_cognome,
+                "sala": r.sala_nome,
+                "tipo_visita": r.tipo_nome,
+            }
+            for r in s.execute(q)
+        ]
+
+
+def esporta_appuntamenti(dal: datetime, al: datetime) -> Iterator[dict[str, Any]]:
+    """Export degli appuntamenti con inizio in [dal, al), inclusi quelli archiviati, in ordine di inizio (streaming)."""
+    with db_read_session() as s:
+        a = appuntamenti_dal(s, dal)
+        q = (
+            select(
+                a.c.id,
+                a.c.inizio,
+                a.c.fine,
+                a.c.stato,
+                a.c.paziente_id,
+                a.c.medico_id,
+                TipoVisita.nome.label("tipo_visita"),
+                SalaVisita.nome.label("sala"),
+                a.c.serie_id,
+                a.c.note,
+            )
+            .join(SalaVisita, SalaVisita.id == a.c.sala_id)
+            .join(TipoVisita, TipoVisita.id == a.c.tipo_visita_id)
+            .where(and_(a.c.inizio >= dal, a.c.inizio < al))
+            .order_by(a.c.inizio.asc())
+        )
+        for r in s.execute(q.execution_options(yield_per=1000)):
+            riga = r._asdict()
+            riga["inizio"] = r.inizio.isoformat()
+            riga["fine"] = r.fine.isoformat()
+            riga["stato"] = r.stato.value
+            yield riga
+
+
 
 # Disponibilità
 
 def _slot_libero(s, medico_id: str, sala_id: int, start: datetime, end: datetime) -> bool:
     """
-    Regola semplice: nessuna sovrapposizione con appuntamenti non annullati.
-    (Versione realistica: verifiche turni medico, buffer, ferie, ecc.)
+    Nessuna sovrapposizione con appuntamenti non annullati del medico o della sala.
+    (Orari, ferie e chiusure sono verificati prima sul calendario compilato.)
     """
     overlap = (
         select(Appuntamento.id)
@@ -173,13 +494,241 @@ def _slot_libero(s, medico_id: str, sala_id: int, start: datetime, end: datetime
 
 
 
+def heatmap_disponibilita(
+    da: date,
+    giorni: int = 7,
+    medico_id: str | None = None,
+    includi_sale: bool = False,
+    includi_slot: bool = False,
+) -> dict[str, Any] | None:
+    """
+    Capacità libera di medici (e opzionalmente sale) su `giorni` giorni a partire da `da`.
+    - medici: orari del calendario (orario studio se non configurati, niente nei giorni di ferie/chiusura)
+      meno gli appuntamenti
+    - sale attive: orario studio (meno le chiusure dello studio) meno gli appuntamenti
+    Per ogni risorsa e giorno: minuti liberi per ora (24 valori) e, con includi_slot, la griglia a
+    slot di SLOT_MINUTI come stringa di '1' (libero) / '0' (occupato).
+    Ritorna None se il medico richiesto non esiste.
+    """
+    inizio = datetime.combine(da, time.min)
+    fine = inizio + timedelta(days=giorni)
+
+    with db_read_session() as s:
+        q = select(Medico.id)
+        q = q.where(Medico.id == medico_id) if medico_id else q.where(Medico.attivo.is_(True))
+        medici = list(s.scalars(q.order_by(Medico.cognome, Medico.nome)))
+        if medico_id and not medici:
+            return None
+
+        sale: list[int] = []
+        if includi_sale:
+            sale = list(s.scalars(select(SalaVisita.id).where(SalaVisita.attiva.is_(True)).order_by(SalaVisita.nome)))
+        occ_medico, occ_sala = occupati(s, set(medici), set(sale), inizio, fine)
+
+        date_periodo = [da + timedelta(days=g) for g in range(giorni)]
+        finestre_medici = {
+            m: [f for g in date_periodo for f in calendario.finestre_giorno(s, m, g)] for m in medici
+        }
+        orario_studio = [f for g in date_periodo for f in calendario.finestre_giorno(s, None, g)]
+
+    def _risorse(finestre: dict, impegni: dict) -> list[dict[str, Any]]:
+        if not finestre:
+            return []
+        chiavi, libero = griglia_libera(finestre, impegni, da, giorni)
+        minuti_ora = (libero.reshape(len(chiavi), giorni, 24, -1).sum(axis=3) * SLOT_MINUTI).tolist()
+        out = []
+        for i, k in enumerate(chiavi):
+            r: dict[str, Any] = {"id": k, "minuti_liberi_per_ora": minuti_ora[i]}
+            if includi_slot:
+                r["slot"] = [(riga.astype("u1") + ord("0")).tobytes().decode() for riga in libero[i]]
+            out.append(r)
+        return out
+
+    return {
+        "da": da.isoformat(),
+        "giorni": giorni,
+        "slot_minuti": SLOT_MINUTI,
+        "medici": _risorse(finestre_medici, occ_medico),
+        "sale": _risorse({sl: orario_studio for sl in sale}, occ_sala),
+    }
+
+
+
+def prime_disponibilita(
+    specializzazione: str,
+    tipo_visita_id: int,
+    dal: datetime,
+    k: int = 5,
+    giorni: int = 30,
+) -> list[dict[str, Any]] | None:
+    """
+    Le prime k opzioni (medico, sala, inizio) tra tutti i medici attivi di una specializzazione,
+    entro `giorni` giorni da `dal`.
+    - una sola query per gli appuntamenti di quei medici e delle sale attrezzate per il tipo visita
+    - per ogni medico un iteratore lazy degli intervalli liberi (calendario meno appuntamenti,
+      con una sala libera), fusi con un merge a k vie su heap: si calcola solo ciò che serve
+    Ritorna None se il tipo visita non esiste.
+    """
+    fine_periodo = datetime.combine(dal.date(), time.min) + timedelta(days=giorni)
+
+    with db_read_session() as s:
+        tv = s.get(TipoVisita, tipo_visita_id)
+        if tv is None:
+            return None
+        durata = timedelta(minutes=tv.durata_minuti)
+
+        medici = {
+            r.id: f"{r.cognome} {r.nome}"
+            for r in s.execute(
+                select(Medico.id, Medico.nome, Medico.cognome).where(
+                    and_(
+                        Medico.attivo.is_(True),
+                        func.lower(Medico.specializzazione) == specializzazione.strip().lower(),
+                    )
+                )
+            )
+        }
+        adatte = catalogo_sale(s).adatte(tipo_visita_id)
+        sale = dict(s.execute(select(SalaVisita.id, SalaVisita.nome).where(SalaVisita.id.in_(adatte))).tuples().all())
+        if not medici or not sale:
+            return []
+
+        occ_medico, occ_sala = occupati(s, set(medici), set(sale), dal, fine_periodo)
+        occ_sala = {sl: unisci(iv) for sl, iv in occ_sala.items()}
+
+        def _finestre(medico_id: str) -> Iterator[tuple[datetime, datetime]]:
+            giorno = dal.date()
+            while giorno < fine_periodo.date():
+                for a, b in calendario.finestre_giorno(s, medico_id, giorno):
+                    if b > dal:
+                        yield max(a, dal), b
+                giorno += timedelta(days=1)
+
+        def _opzioni(medico_id: str) -> Iterator[tuple[datetime, str, int]]:
+            for inizio, sala_id in inizi_liberi(_finestre(medico_id), occ_medico[medico_id], occ_sala, durata):
+                yield inizio, medico_id, sala_id
+
+        prime = list(islice(heapq.merge(*(_opzioni(m) for m in sorted(medici))), k))
+
+    return [
+        {
+            "medico_id": medico_id,
+            "medico": medici[medico_id],
+            "sala_id": sala_id,
+            "sala": sale[sala_id],
+            "inizio": inizio.isoformat(),
+            "fine": (inizio + durata).isoformat(),
+        }
+        for inizio, medico_id, sala_id in prime
+    ]
+
+
+
+# Calendario medici (orari settimanali ed eccezioni)
+
+def _calendario_modificato(s) -> None:
+    calendario.segna_modifica(s)
+    incrementa(s, "disponibilita")
+
+
+def imposta_orari_medico(medico_id: str, fasce: list[tuple[int, str, str]]) -> bool:
+    """
+    Sostituisce gli orari settimanali del medico: fasce (giorno_settimana, "HH:MM", "HH:MM").
+    Lista vuota = vale l'orario studio. Ritorna False se il medico non esiste.
+    """
+    return esegui_scrittura(_imposta_orari_medico, medico_id, fasce)
+
+
+def _imposta_orari_medico(s, medico_id: str, fasce: list[tuple[int, str, str]]) -> bool:
+    if s.get(Medico, medico_id) is None:
+        return False
+
+    s.execute(delete(DisponibilitaMedico).where(DisponibilitaMedico.medico_id == medico_id))
+    if fasce:
+        s.execute(
+            insert(DisponibilitaMedico),
+            [{"medico_id": medico_id, "giorno_settimana": g, "ora_inizio": a, "ora_fine": b} for g, a, b in fasce],
+        )
+    _calendario_modificato(s)
+    return True
+
+
+def aggiungi_eccezione(dal: date, al: date, medico_id: str | None = None, motivo: str | None = None) -> int | None:
+    """
+    Registra giorni di indisponibilità (estremi inclusi): ferie del medico o, con medico_id None,
+    chiusura dello studio. Ritorna l'id dell'eccezione, None se il medico non esiste.
+    """
+    return esegui_scrittura(_aggiungi_eccezione, dal, al, medico_id, motivo)
+
+
+def _aggiungi_eccezione(s, dal: date, al: date, medico_id: str | None = None, motivo: str | None = None) -> int | None:
+    if medico_id is not None and s.get(Medico, medico_id) is None:
+        return None
+
+    e = EccezioneCalendario(medico_id=medico_id, dal=dal, al=al, motivo=motivo)
+    s.add(e)
+    s.flush()
+    _calendario_modificato(s)
+    return e.id
+
+
+def rimuovi_eccezione(eccezione_id: int) -> bool:
+    return esegui_scrittura(_rimuovi_eccezione, eccezione_id)
+
+
+def _rimuovi_eccezione(s, eccezione_id: int) -> bool:
+    if s.execute(delete(EccezioneCalendario).where(EccezioneCalendario.id == eccezione_id)).rowcount != 1:
+        return False
+    _calendario_modificato(s)
+    return True
+
+
+def calendario_medico_flat(medico_id: str) -> dict[str, Any] | None:
+    """Orari settimanali e eccezioni non ancora concluse (del medico e di chiusura studio)."""
+    with db_read_session() as s:
+        if s.get(Medico, medico_id) is None:
+            return None
+
+        orari = s.execute(
+            select(DisponibilitaMedico.giorno_settimana, DisponibilitaMedico.ora_inizio, DisponibilitaMedico.ora_fine)
+            .where(DisponibilitaMedico.medico_id == medico_id)
+            .order_by(DisponibilitaMedico.giorno_settimana, DisponibilitaMedico.ora_inizio)
+        ).all()
+        eccezioni = s.execute(
+            select(EccezioneCalendario)
+            .where(
+                and_(
+                    (EccezioneCalendario.medico_id == medico_id) | EccezioneCalendario.medico_id.is_(None),
+                    EccezioneCalendario.al >= date.today(),
+                )
+            )
+            .order_by(EccezioneCalendario.dal)
+        ).scalars().all()
+
+        return {
+            "medico_id": medico_id,
+            "orari": [{"giorno_settimana": r.giorno_settimana, "ora_inizio": r.ora_inizio, "ora_fine": r.ora_fine} for r in orari],
+            "eccezioni": [
+                {
+                    "id": e.id,
+                    "medico_id": e.medico_id,
+                    "dal": e.dal.isoformat(),
+                    "al": e.al.isoformat(),
+                    "motivo": e.motivo,
+                }
+                for e in eccezioni
+            ],
+        }
+
+
+
 # Prenotazione (use case core)
 
 def prenota_appuntamento(
     paziente_id: str,
     medico_id: str,
     tipo_visita_id: int,
-    sala_id: int,
+    sala_id: int | None,
     start: datetime,
     note: str | None = None,
     inserisci_waitlist_se_pieno: bool = True,
@@ -187,6 +736,8 @@ def prenota_appuntamento(
     """
     Use case: Prenotare appuntamento.
     - Calcola la durata dal tipo visita
+    - Verifica il calendario del medico (orari settimanali, ferie, chiusure)
+    - Senza sala_id sceglie una sala libera con le attrezzature richieste dal tipo visita
     - Verifica disponibilità medico+sala
     - Se pieno: opzionale inserimento in lista d'attesa
     - Genera notifiche (conferma o waitlist)
@@ -194,60 +745,238 @@ def prenota_appuntamento(
     NOTE: Per visualizzare nome/cognome del paziente nelle notifiche,
     Notifica deve avere una colonna `paziente_id` (nullable).
     """
-    with db_session() as s:
-        tv = s.get(TipoVisita, tipo_visita_id)
-        if not tv:
-            return EsitoPrenotazione(False, None, False, "Tipo visita non valido.")
+    return esegui_scrittura(
+        _prenota_appuntamento,
+        paziente_id,
+        medico_id,
+        tipo_visita_id,
+        sala_id,
+        start,
+        note,
+        inserisci_waitlist_se_pieno,
+    )
+
+
+def _prenota_appuntamento(
+    s,
+    paziente_id: str,
+    medico_id: str,
+    tipo_visita_id: int,
+    sala_id: int | None,
+    start: datetime,
+    note: str | None = None,
+    inserisci_waitlist_se_pieno: bool = True,
+) -> EsitoPrenotazione:
+    tv = s.get(TipoVisita, tipo_visita_id)
+    if not tv:
+        return EsitoPrenotazione(False, None, False, "Tipo visita non valido.")
 
-        end = start + timedelta(minutes=tv.durata_minuti)
+    end = start + timedelta(minutes=tv.durata_minuti)
 
-        if not _slot_libero(s, medico_id=medico_id, sala_id=sala_id, start=start, end=end):
-            if not inserisci_waitlist_se_pieno:
-                return EsitoPrenotazione(False, None, False, "Slot non disponibile (medico o sala occupati).")
+    if not calendario.disponibile(s, medico_id, start, end):
+        return EsitoPrenotazione(False, None, False, "Medico non disponibile in questo orario (fuori orario, ferie o chiusura).")
 
-            wl = ListaAttesa(
-                paziente_id=paziente_id,
-                medico_id=medico_id,
-                tipo_visita_id=tipo_visita_id,
-                priorita=5,
-                note=f"Richiesta per {start.isoformat()} (slot non disponibile).",
-            )
-            s.add(wl)
-
-            # Notifica con riferimento al paziente (se la colonna esiste nel model/DB)
-            s.add(
-                Notifica(
-                    tipo=TipoNotifica.PROMEMORIA,
-                    messaggio="Sei stato inserito in lista d'attesa: ti avviseremo quando si libera uno slot.",
-                    appuntamento_id=None,
-                    paziente_id=paziente_id,
-                )
-            )
-            return EsitoPrenotazione(True, None, True, "Slot pieno: paziente inserito in lista d'attesa.")
+    if sala_id is not None and not catalogo_sale(s).adatta(sala_id, tipo_visita_id):
+        return EsitoPrenotazione(False, None, False, "Sala non attiva o senza le attrezzature richieste dal tipo visita.")
+
+    libero = _slot_libero(s, medico_id=medico_id, sala_id=sala_id, start=start, end=end)
+    if libero and sala_id is None:
+        sala_id = scegli_sala(s, tipo_visita_id, start, end)
+        libero = sala_id is not None
 
-        app = Appuntamento(
+    if not libero:
+        if not inserisci_waitlist_se_pieno:
+            return EsitoPrenotazione(False, None, False, "Slot non disponibile (medico o sala occupati).")
+
+        wl = ListaAttesa(
             paziente_id=paziente_id,
             medico_id=medico_id,
             tipo_visita_id=tipo_visita_id,
-            sala_id=sala_id,
-            inizio=start,
-            fine=end,
-            stato=StatoAppuntamento.CONFERMATO,
-            note=note,
+            priorita=5,
+            note=f"Richiesta per {start.isoformat()} (slot non disponibile).",
         )
-        s.add(app)
+        s.add(wl)
         s.flush()
+        waitlist_engine.aggiungi(s, wl, tv.durata_minuti)
+        incrementa(s, "lista_attesa", "notifiche")
 
-        s.add(
+        # Notifica con riferimento al paziente (se la colonna esiste nel model/DB)
+        aggiungi_notifica(
+            s,
             Notifica(
-                tipo=TipoNotifica.CONFERMA,
-                messaggio=f"Appuntamento confermato per {start.strftime('%d/%m/%Y %H:%M')}.",
-                appuntamento_id=app.id,
+                tipo=TipoNotifica.PROMEMORIA,
+                messaggio="Sei stato inserito in lista d'attesa: ti avviseremo quando si libera uno slot.",
+                appuntamento_id=None,
                 paziente_id=paziente_id,
-            )
+            ),
         )
+        return EsitoPrenotazione(True, None, True, "Slot pieno: paziente inserito in lista d'attesa.")
+
+    app = Appuntamento(
+        paziente_id=paziente_id,
+        medico_id=medico_id,
+        tipo_visita_id=tipo_visita_id,
+        sala_id=sala_id,
+        inizio=start,
+        fine=end,
+        stato=StatoAppuntamento.CONFERMATO,
+        note=note,
+    )
+    s.add(app)
+    s.flush()
+    incrementa(s, "appuntamenti", "notifiche")
+    registra_appuntamento(s, app, "creato")
+    pubblica_appuntamento(s, app)
+
+    aggiungi_notifica(
+        s,
+        Notifica(
+            tipo=TipoNotifica.CONFERMA,
+            messaggio=f"Appuntamento confermato per {start.strftime('%d/%m/%Y %H:%M')}.",
+            appuntamento_id=app.id,
+            paziente_id=paziente_id,
+        ),
+    )
+
+    return EsitoPrenotazione(True, app.id, False, "Appuntamento confermato.", sala_id)
+
+
+def prenota_serie(
+    paziente_id: str,
+    medico_id: str,
+    tipo_visita_id: int,
+    sala_id: int,
+    primo_inizio: datetime,
+    occorrenze: int,
+    frequenza: FrequenzaSerie = FrequenzaSerie.SETTIMANALE,
+    intervallo: int = 1,
+    note: str | None = None,
+) -> EsitoSerie:
+    """
+    Use case: Prenotare una serie ricorrente (es. ogni settimana per 12 settimane).
+    - espande la regola di ricorrenza
+    - una sola query per gli appuntamenti di medico e sala in tutto il periodo, poi controllo in memoria
+      di ogni occorrenza (sovrapposizioni + calendario del medico: orari, ferie, chiusure)
+    - inserisce in blocco le occorrenze libere, con una notifica di conferma per la serie
+    - per le occorrenze in conflitto propone gli orari liberi più vicini nello stesso giorno
+    """
+    return esegui_scrittura(
+        _prenota_serie,
+        paziente_id,
+        medico_id,
+        tipo_visita_id,
+        sala_id,
+        primo_inizio,
+        occorrenze,
+        frequenza,
+        intervallo,
+        note,
+    )
+
 
-        return EsitoPrenotazione(True, app.id, False, "Appuntamento confermato.")
+def _occorrenze_serie(primo_inizio: datetime, frequenza: FrequenzaSerie, intervallo: int, occorrenze: int) -> list[datetime]:
+    passo = timedelta(days=intervallo) if frequenza == FrequenzaSerie.GIORNALIERA else timedelta(weeks=intervallo)
+    return [primo_inizio + k * passo for k in range(occorrenze)]
+
+
+def _prenota_serie(
+    s,
+    paziente_id: str,
+    medico_id: str,
+    tipo_visita_id: int,
+    sala_id: int,
+    primo_inizio: datetime,
+    occorrenze: int,
+    frequenza: FrequenzaSerie = FrequenzaSerie.SETTIMANALE,
+    intervallo: int = 1,
+    note: str | None = None,
+) -> EsitoSerie:
+    tv = s.get(TipoVisita, tipo_visita_id)
+    if not tv:
+        return EsitoSerie(False, None, [], [], "Tipo visita non valido.")
+
+    if not catalogo_sale(s).adatta(sala_id, tipo_visita_id):
+        return EsitoSerie(False, None, [], [], "Sala non attiva o senza le attrezzature richieste dal tipo visita.")
+
+    durata = timedelta(minutes=tv.durata_minuti)
+    inizi = _occorrenze_serie(primo_inizio, frequenza, intervallo, occorrenze)
+
+    # giorni interi: servono anche per cercare le alternative attorno alle occorrenze in conflitto
+    da = datetime.combine(inizi[0].date(), time.min)
+    a = datetime.combine(inizi[-1].date(), time.min) + timedelta(days=1)
+    occ_medico, occ_sala = occupati(s, {medico_id}, {sala_id}, da, a)
+    occupato = unisci(occ_medico[medico_id] + occ_sala[sala_id])
+
+    liberi: list[tuple[datetime, datetime]] = []
+    conflitti: list[ConflittoSerie] = []
+    for inizio in inizi:
+        fine = inizio + durata
+        if not calendario.disponibile(s, medico_id, inizio, fine):
+            motivo = "Medico non disponibile (fuori orario, ferie o chiusura)."
+        elif sovrapposto(occupato, inizio, fine):
+            motivo = "Slot non disponibile (medico o sala occupati)."
+        else:
+            liberi.append((inizio, fine))
+            insort(occupato, (inizio, fine))  # resta ordinata e senza sovrapposizioni
+            continue
+
+        tratti = [t for f in calendario.finestre_giorno(s, medico_id, inizio.date()) for t in sottrai(f, occupato)]
+        conflitti.append(ConflittoSerie(inizio, motivo, tuple(alternative_vicine(tratti, inizio, durata))))
+
+    if not liberi:
+        return EsitoSerie(False, None, [], conflitti, "Nessuna occorrenza della serie è disponibile.")
+
+    serie = SerieAppuntamenti(
+        paziente_id=paziente_id,
+        medico_id=medico_id,
+        tipo_visita_id=tipo_visita_id,
+        sala_id=sala_id,
+        primo_inizio=primo_inizio,
+        frequenza=frequenza,
+        intervallo=intervallo,
+        occorrenze=occorrenze,
+        note=note,
+    )
+    s.add(serie)
+    s.flush()
+
+    righe = [
+        {
+            "id": new_uuid(),
+            "paziente_id": paziente_id,
+            "medico_id": medico_id,
+            "tipo_visita_id": tipo_visita_id,
+            "sala_id": sala_id,
+            "inizio": inizio,
+            "fine": fine,
+            "stato": StatoAppuntamento.CONFERMATO,
+            "note": note,
+            "serie_id": serie.id,
+        }
+        for inizio, fine in liberi
+    ]
+    s.execute(insert(Appuntamento), righe)
+    registra_eventi(s, APPUNTAMENTO, "creato", righe)
+
+    messaggio = (
+        f"Serie di {len(righe)} appuntamenti confermata: dal {liberi[0][0].strftime('%d/%m/%Y %H:%M')} "
+        f"al {liberi[-1][0].strftime('%d/%m/%Y %H:%M')}."
+    )
+    if conflitti:
+        messaggio += f" {len(conflitti)} date non disponibili da riprogrammare."
+    aggiungi_notifica(
+        s,
+        Notifica(
+            tipo=TipoNotifica.CONFERMA,
+            messaggio=messaggio,
+            appuntamento_id=righe[0]["id"],
+            paziente_id=paziente_id,
+        ),
+    )
+    incrementa(s, "appuntamenti", "notifiche")
+    pubblica_ricarica(s, CANALE_AGENDA)
+
+    return EsitoSerie(True, serie.id, [r["id"] for r in righe], conflitti, messaggio)
 
 
 def annulla_appuntamento(appuntamento_id: str, motivo: str | None = None) -> bool:
@@ -257,79 +986,174 @@ def annulla_appuntamento(appuntamento_id: str, motivo: str | None = None) -> boo
     - genera notifica annullamento
     - prova a promuovere un paziente dalla lista d'attesa (se disponibile)
     """
-    with db_session() as s:
-        app = s.get(Appuntamento, appuntamento_id)
-        if not app or app.stato == StatoAppuntamento.ANNULLATO:
-            return False
+    return esegui_scrittura(_annulla_appuntamento, appuntamento_id, motivo)
 
-        app.stato = StatoAppuntamento.ANNULLATO
 
-        s.add(
-            Notifica(
-                tipo=TipoNotifica.ANNULLAMENTO,
-                messaggio=f"Appuntamento annullato. Motivo: {motivo or 'n/d'}",
-                appuntamento_id=app.id,
-                paziente_id=app.paziente_id,
-            )
-        )
+def _annulla_appuntamento(s, appuntamento_id: str, motivo: str | None = None) -> bool:
+    app = s.get(Appuntamento, appuntamento_id)
+    if not app or app.stato == StatoAppuntamento.ANNULLATO:
+        return False
 
-        _promuovi_da_waitlist(
-            s,
-            medico_id=app.medico_id,
-            tipo_visita_id=app.tipo_visita_id,
-            start=app.inizio,
-            sala_id=app.sala_id,
+    app.stato = StatoAppuntamento.ANNULLATO
+    s.flush()  # autoflush disattivato: lo slot deve risultare libero alle query successive
+    incrementa(s, "appuntamenti", "notifiche")
+    registra_appuntamento(s, app, "annullato")
+    pubblica_appuntamento(s, app)
+    for notifica_id in _elimina_promemoria(s, [app.id]):
+        pubblica(s, CANALE_NOTIFICHE, {"azione": "eliminata", "id": notifica_id})
+
+    aggiungi_notifica(
+        s,
+        Notifica(
+            tipo=TipoNotifica.ANNULLAMENTO,
+            messaggio=f"Appuntamento annullato. Motivo: {motivo or 'n/d'}",
+            appuntamento_id=app.id,
+            paziente_id=app.paziente_id,
+        ),
+    )
+
+    _promuovi_da_waitlist(s, [IntervalloLibero(app.medico_id, app.sala_id, app.inizio, app.fine)])
+    return True
+
+
+def _elimina_promemoria(s, appuntamenti) -> list[int]:
+    """
+    Elimina i promemoria non ancora inviati degli appuntamenti (lista di id o SELECT di id) annullati:
+    il paziente non deve ricevere "Promemoria: appuntamento il ..." per una visita che non c'è più.
+    """
+    return s.scalars(
+        delete(Notifica)
+        .where(
+            Notifica.tipo == TipoNotifica.PROMEMORIA,
+            Notifica.inviata_il.is_(None),
+            Notifica.appuntamento_id.in_(appuntamenti),
         )
-        return True
+        .returning(Notifica.id)
+        .execution_options(synchronize_session=False)
+    ).all()
 
 
-def _promuovi_da_waitlist(s, medico_id: str, tipo_visita_id: int, start: datetime, sala_id: int) -> None:
+def registra_assenza_medico(medico_id: str, dal: datetime, al: datetime, motivo: str | None = None) -> EsitoAssenza | None:
     """
-    Quando si libera uno slot, prova a prenotare automaticamente il primo in lista d'attesa
-    (priorità più alta = numero più basso, a parità: più vecchio).
+    Use case: Assenza medico (malattia, imprevisti).
+    - annulla in blocco gli appuntamenti attivi del medico con inizio in [dal, al)
+    - genera le notifiche di annullamento con un solo INSERT ... SELECT
+    - riassegna una sola volta le sale liberate agli altri medici con pazienti in lista d'attesa
+    Ritorna None se il medico non esiste.
     """
-    tv = s.get(TipoVisita, tipo_visita_id)
-    if not tv:
-        return
+    return esegui_scrittura(_registra_assenza_medico, medico_id, dal, al, motivo)
 
-    end = start + timedelta(minutes=tv.durata_minuti)
-    if not _slot_libero(s, medico_id=medico_id, sala_id=sala_id, start=start, end=end):
-        return
 
-    q = (
-        select(ListaAttesa)
-        .where(and_(ListaAttesa.medico_id == medico_id, ListaAttesa.tipo_visita_id == tipo_visita_id))
-        .order_by(ListaAttesa.priorita.asc(), ListaAttesa.inserita_il.asc())
-        .limit(1)
-    )
-    wl = s.scalars(q).first()
-    if not wl:
-        return
+def _registra_assenza_medico(s, medico_id: str, dal: datetime, al: datetime, motivo: str | None = None) -> EsitoAssenza | None:
+    if s.get(Medico, medico_id) is None:
+        return None
 
-    app = Appuntamento(
-        paziente_id=wl.paziente_id,
-        medico_id=medico_id,
-        tipo_visita_id=tipo_visita_id,
-        sala_id=sala_id,
-        inizio=start,
-        fine=end,
-        stato=StatoAppuntamento.CONFERMATO,
-        note="Generato automaticamente da lista d'attesa.",
+    attivi = and_(
+        Appuntamento.medico_id == medico_id,
+        Appuntamento.inizio >= dal,
+        Appuntamento.inizio < al,
+        Appuntamento.stato.in_([StatoAppuntamento.PROGRAMMATO, StatoAppuntamento.CONFERMATO]),
     )
-    s.add(app)
-    s.flush()
 
-    s.add(
-        Notifica(
-            tipo=TipoNotifica.WAITLIST_PROMOSSA,
-            messaggio=f"Si è liberato uno slot: appuntamento assegnato per {start.strftime('%d/%m/%Y %H:%M')}.",
-            appuntamento_id=app.id,
-            paziente_id=wl.paziente_id,
+    liberati = s.execute(select(Appuntamento.sala_id, Appuntamento.inizio, Appuntamento.fine).where(attivi)).all()
+    if not liberati:
+        return EsitoAssenza(0, 0)
+
+    s.execute(
+        insert(Notifica).from_select(
+            ["tipo", "messaggio", "creata_il", "appuntamento_id", "paziente_id"],
+            select(
+                literal(TipoNotifica.ANNULLAMENTO, Notifica.__table__.c.tipo.type),
+                literal(f"Appuntamento annullato. Motivo: {motivo or 'n/d'}"),
+                literal(datetime.utcnow()),
+                Appuntamento.id,
+                Appuntamento.paziente_id,
+            ).where(attivi),
         )
     )
+    _elimina_promemoria(s, select(Appuntamento.id).where(attivi))  # la ricarica del canale notifiche li toglie dalla UI
+    annullati = s.execute(
+        update(Appuntamento)
+        .where(attivi)
+        .values(stato=StatoAppuntamento.ANNULLATO)
+        .returning(*Appuntamento.__table__.c)
+        .execution_options(synchronize_session=False)
+    ).mappings().all()
+    incrementa(s, "appuntamenti", "notifiche")
+    registra_eventi(s, APPUNTAMENTO, "annullato", annullati)
+    pubblica_ricarica(s, CANALE_AGENDA, CANALE_NOTIFICHE)
+
+    # Il medico è assente: le sale liberate vanno agli altri medici con richieste in attesa.
+    # Un'assenza registrata a posteriori (dal nel passato) annulla gli appuntamenti ma non libera il passato
+    ora = datetime.now()
+    altri = waitlist_engine.medici_in_attesa(s) - {medico_id}
+    intervalli = [
+        IntervalloLibero(m, r.sala_id, max(r.inizio, ora), r.fine)
+        for r in liberati
+        if r.fine > ora
+        for m in sorted(altri)
+    ]
+    riassegnati = _promuovi_da_waitlist(s, intervalli)
+
+    return EsitoAssenza(len(liberati), len(riassegnati))
+
+
+def _promuovi_da_waitlist(s, intervalli: list[IntervalloLibero]) -> list[str]:
+    """
+    Quando si liberano uno o più intervalli, li riempie con le richieste in lista d'attesa
+    (priorità più alta = numero più basso, a parità: più vecchio), anche con visite più brevi
+    e di tipo diverso da quella annullata. Tutto nella transazione corrente.
+    """
+    creati = waitlist_engine.riempi(s, intervalli)
+    for app_id in creati:
+        app = s.get(Appuntamento, app_id)
+        registra_appuntamento(s, app, "creato")
+        pubblica_appuntamento(s, app)
+    return creati
+
 
-    # rimuove la richiesta dalla lista d'attesa
-    s.delete(wl)
+
+# Job di manutenzione degli stati
+
+COMPLETAMENTO_BATCH = 5000
+
+
+def completa_appuntamenti_passati(ora: datetime | None = None, batch: int = COMPLETAMENTO_BATCH) -> int:
+    """
+    Job: porta a COMPLETATO gli appuntamenti PROGRAMMATI/CONFERMATI già terminati (fine <= ora).
+    UPDATE set-based a blocchi di `batch` righe, ognuno in una transazione breve (il lock di scrittura
+    non blocca a lungo le prenotazioni). Ritorna il numero di appuntamenti aggiornati.
+    """
+    ora = ora or datetime.now()
+    totale = 0
+    for stato in (StatoAppuntamento.CONFERMATO, StatoAppuntamento.PROGRAMMATO):
+        while True:
+            n = esegui_scrittura(_completa_appuntamenti_passati, stato, ora, batch)
+            totale += n
+            if n < batch:
+                break
+    return totale
+
+
+def _completa_appuntamenti_passati(s, stato: StatoAppuntamento, ora: datetime, batch: int) -> int:
+    # inizio < ora è implicato da fine <= ora, ma permette di usare l'indice parziale sui confermati
+    scaduti = (
+        select(Appuntamento.id)
+        .where(and_(Appuntamento.stato == stato, Appuntamento.inizio < ora, Appuntamento.fine <= ora))
+        .limit(batch)
+    )
+    completati = s.execute(
+        update(Appuntamento)
+        .where(Appuntamento.id.in_(scaduti))
+        .values(stato=StatoAppuntamento.COMPLETATO)
+        .returning(*Appuntamento.__table__.c)
+        .execution_options(synchronize_session=False)
+    ).mappings().all()
+    if completati:
+        incrementa(s, "appuntamenti")
+        registra_eventi(s, APPUNTAMENTO, "completato", completati)
+        pubblica_ricarica(s, CANALE_AGENDA)
+    return len(completati)
 
 
 
@@ -343,14 +1167,14 @@ def estrai_notifiche_pendenti(limit: int = 50) -> list[Notifica]:
 
 from typing import Any
 
-def notifiche_pendenti_flat(limit: int = 200) -> list[dict[str, Any]]:
+def notifiche_pendenti_flat(limit: int = 200, offset: int = 0) -> list[dict[str, Any]]:
     """
     Notifiche pendenti in formato serializzabile con paziente.
     Ricava il paziente tramite:
       - Notifica.paziente_id (se presente)
       - altrimenti Notifica.appuntamento_id -> Appuntamento.paziente_id
     """
-    with db_session() as s:
+    with db_read_session() as s:
         q = (
             select(
                 Notifica.id,
@@ -369,8 +1193,9 @@ def notifiche_pendenti_flat(limit: int = 200) -> list[dict[str, Any]]:
                 Paziente.id == func.coalesce(Notifica.paziente_id, Appuntamento.paziente_id),
             )
             .where(Notifica.inviata_il.is_(None))
-            .order_by(Notifica.creata_il.asc())
+            .order_by(Notifica.creata_il.asc(), Notifica.id.asc())
             .limit(limit)
+            .offset(offset)
         )
 
         rows = s.execute(q).all()
@@ -396,19 +1221,70 @@ def notifiche_pendenti_flat(limit: int = 200) -> list[dict[str, Any]]:
         return out
 
 def marca_notifica_inviata(notifica_id: int) -> bool:
-    with db_session() as s:
-        n = s.get(Notifica, notifica_id)
-        if not n or n.inviata_il is not None:
-            return False
-        n.inviata_il = datetime.utcnow()
-        return True
+    return esegui_scrittura(_marca_notifica_inviata, notifica_id)
+
+
+def _marca_notifica_inviata(s, notifica_id: int) -> bool:
+    n = s.get(Notifica, notifica_id)
+    if not n or n.inviata_il is not None:
+        return False
+    n.inviata_il = datetime.utcnow()
+    incrementa(s, "notifiche")
+    pubblica(s, CANALE_NOTIFICHE, {"azione": "inviata", "id": notifica_id})
+    return True
+
+
+# Promemoria: appuntamenti confermati che iniziano entro queste ore ricevono un PROMEMORIA
+PROMEMORIA_ORE_ANTICIPO = int(os.getenv("PROMEMORIA_ORE_ANTICIPO", "24"))
+
+
+def genera_promemoria(ora: datetime | None = None, ore_anticipo: int = PROMEMORIA_ORE_ANTICIPO) -> int:
+    """
+    Job promemoria (CLI o task periodico dell'API): crea una notifica PROMEMORIA per ogni appuntamento
+    CONFERMATO con inizio in [ora, ora + ore_anticipo).
+    Un solo INSERT OR IGNORE ... SELECT: l'indice univoco parziale su notifiche (un promemoria per
+    appuntamento) scarta quelli già creati, quindi il job è idempotente e può girare ogni pochi minuti.
+    Ritorna il numero di promemoria creati.
+    """
+    return esegui_scrittura(_genera_promemoria, ora, ore_anticipo)
+
+
+def _genera_promemoria(s, ora: datetime | None = None, ore_anticipo: int = PROMEMORIA_ORE_ANTICIPO) -> int:
+    da = ora or datetime.now()
+    a = da + timedelta(hours=ore_anticipo)
+
+    creati = s.execute(
+        insert(Notifica)
+        .prefix_with("OR IGNORE")
+        .from_select(
+            ["tipo", "messaggio", "creata_il", "appuntamento_id", "paziente_id"],
+            select(
+                literal(TipoNotifica.PROMEMORIA, Notifica.__table__.c.tipo.type),
+                literal("Promemoria: appuntamento il ") + func.strftime("%d/%m/%Y alle %H:%M", Appuntamento.inizio) + literal("."),
+                literal(datetime.utcnow()),
+                Appuntamento.id,
+                Appuntamento.paziente_id,
+            ).where(
+                and_(
+                    Appuntamento.stato == StatoAppuntamento.CONFERMATO,
+                    Appuntamento.inizio >= da,
+                    Appuntamento.inizio < a,
+                )
+            ),
+        )
+    ).rowcount
+
+    if creati:
+        incrementa(s, "notifiche")
+        pubblica_ricarica(s, CANALE_NOTIFICHE)
+    return creati
 
 
 
 # Lookup "flat" (safe per Streamlit/API)
 
 def lista_medici_flat() -> list[dict]:
-    with db_session() as s:
+    with db_read_session() as s:
         rows = s.execute(
             select(Medico.id, Medico.nome, Medico.cognome, Medico.specializzazione)
             .where(Medico.attivo.is_(True))
@@ -420,9 +1296,12 @@ def lista_medici_flat() -> list[dict]:
         ]
 
 
-def lista_pazienti_flat() -> list[dict]:
-    """Lista pazienti in formato serializzabile (safe per Streamlit), includendo telefono."""
-    with db_session() as s:
+def lista_pazienti_flat(limit: int | None = None, offset: int = 0) -> list[dict]:
+    """
+    Lista pazienti in formato serializzabile (safe per Streamlit), includendo telefono.
+    Con `limit` ritorna una sola pagina (paginazione lato server).
+    """
+    with db_read_session() as s:
         rows = s.execute(
             select(
                 Paziente.id,
@@ -430,7 +1309,10 @@ def lista_pazienti_flat() -> list[dict]:
                 Paziente.cognome,
                 Paziente.email,
                 Paziente.telefono,
-            ).order_by(Paziente.cognome, Paziente.nome)
+            )
+            .order_by(Paziente.cognome, Paziente.nome, Paziente.id)
+            .limit(limit)
+            .offset(offset)
         ).all()
 
         return [
@@ -446,7 +1328,7 @@ def lista_pazienti_flat() -> list[dict]:
 
 
 def lista_sale_flat() -> list[dict]:
-    with db_session() as s:
+    with db_read_session() as s:
         rows = s.execute(
             select(SalaVisita.id, SalaVisita.nome)
             .where(SalaVisita.attiva.is_(True))
@@ -456,6 +1338,6 @@ def lista_sale_flat() -> list[dict]:
 
 
 def lista_tipi_visita_flat() -> list[dict]:
-    with db_session() as s:
+    with db_read_session() as s:
         rows = s.execute(select(TipoVisita.id, TipoVisita.nome, TipoVisita.durata_minuti).order_by(TipoVisita.nome)).all()
         return [{"id": r.id, "nome": r.nome, "durata_minuti": r.durata_minuti} for r in rows]
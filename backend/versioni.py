@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Callable
+from functools import partial
+
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .db import DB_PATH, SessionLocal, al_commit
+from .models import VersioneTabella
+
+# Contatori di modifica per tabella, mantenuti dal livello servizi.
+# Ogni use case che scrive incrementa i contatori delle tabelle toccate (dopo il COMMIT):
+# - versioni(): contatori locali del processo, chiave delle cache in memoria (es. catalogo sale)
+# - versioni_condivise(): valori salvati in versioni_tabelle, uguali in tutti i processi e tra i riavvii;
+#   le API li usano per calcolare gli ETag senza eseguire query sulle tabelle né serializzare
+#
+# Bus di invalidazione tra processi (più worker uvicorn/gunicorn, CLI, job sullo stesso DB):
+# - incrementa() aggiorna anche la tabella versioni_tabelle, con un solo UPSERT subito prima del COMMIT
+#   della transazione che scrive (stessa transazione: niente modifiche senza versione e viceversa)
+# - sincronizza() confronta PRAGMA data_version di una connessione dedicata (cambia solo quando un'altra
+#   connessione ha fatto COMMIT, pochi microsecondi): solo allora rilegge versioni_tabelle, avanza i
+#   contatori locali delle tabelle cambiate altrove e chiama le invalidazioni registrate solo per quelle
+# - le modifiche fatte da questo processo aggiornano già le cache in memoria: non le invalidano di nuovo
+# sincronizza() viene chiamata dalle cache prima di usare i propri dati e, nell'API, periodicamente.
+
+logger = logging.getLogger("studio_medico.versioni")
+
+# Intervallo del controllo periodico nell'API (le cache controllano comunque prima di ogni uso)
+SINCRONIZZAZIONE_SECONDI = float(os.getenv("STUDIO_SINCRONIZZAZIONE_SECONDI", "1"))
+
+_versioni: dict[str, int] = {}
+_lock = threading.Lock()
+
+_db_visti: dict[str, int] = {}  # versioni in versioni_tabelle già note a questo processo
+_invalidazioni: dict[str, list[Callable[[], None]]] = {}
+_bus_lock = threading.Lock()
+_bus_conn: sqlite3.Connection | None = None
+_data_version: int | None = None
+
+
+def _incrementa_ora(tabelle: tuple[str, ...]) -> None:
+    with _lock:
+        for t in tabelle:
+            _versioni[t] = _versioni.get(t, 0) + 1
+
+
+def incrementa(s: Session, *tabelle: str) -> None:
+    """Registra la modifica delle tabelle: i contatori avanzano quando la transazione fa COMMIT."""
+    al_commit(s, lambda: _incrementa_ora(tabelle))
+    s.info.setdefault("versioni_da_salvare", set()).update(tabelle)
+
+
+def versioni(*tabelle: str) -> tuple[int, ...]:
+    sincronizza()
+    with _lock:
+        return tuple(_versioni.get(t, 0) for t in tabelle)
+
+
+def versioni_condivise(*tabelle: str) -> tuple[int, ...]:
+    """Versioni in versioni_tabelle (0 = tabella mai modificata), aggiornate con le modifiche degli altri processi."""
+    sincronizza()
+    with _lock:
+        return tuple(_db_visti.get(t, 0) for t in tabelle)
+
+
+def registra_invalidazione(fn: Callable[[], None], *tabelle: str) -> None:
+    """fn viene chiamata quando un altro processo modifica una delle tabelle."""
+    for t in tabelle:
+        _invalidazioni.setdefault(t, []).append(fn)
+
+
+@event.listens_for(SessionLocal, "before_commit")
+def _salva_versioni(s: Session) -> None:
+    if s.in_nested_transaction():
+        return
+    tabelle = s.info.pop("versioni_da_salvare", None)
+    if not tabelle:
+        return
+    stmt = sqlite_insert(VersioneTabella).values([{"tabella": t, "versione": 1} for t in sorted(tabelle)])
+    righe = s.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[VersioneTabella.tabella], set_={"versione": VersioneTabella.versione + 1}
+        ).returning(VersioneTabella.tabella, VersioneTabella.versione)
+    ).all()
+    al_commit(s, partial(_segna_proprie, dict(righe)))
+
+
+def _segna_proprie(nuove: dict[str, int]) -> None:
+    # versione + 1 rispetto all'ultima vista: l'unica modifica è la nostra. Altrimenti nel frattempo ha scritto
+    # anche un altro processo: la lascio da scoprire a sincronizza(), che invalida le cache
+    with _lock:
+        for t, v in nuove.items():
+            if _db_visti.get(t, 0) == v - 1:
+                _db_visti[t] = v
+
+
+def _connessione() -> sqlite3.Connection:
+    global _bus_conn
+    if _bus_conn is None:
+        _bus_conn = sqlite3.connect(
+            f"{DB_PATH.as_uri()}?mode=ro", uri=True, check_same_thread=False, isolation_level=None
+        )
+    return _bus_conn
+
+
+def sincronizza() -> None:
+    """Applica le modifiche fatte da altri processi (una PRAGMA se non è cambiato nulla)."""
+    global _data_version
+    with _bus_lock:
+        try:
+            conn = _connessione()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == _data_version:
+                return
+            righe = conn.execute("SELECT tabella, versione FROM versioni_tabelle").fetchall()
+        except sqlite3.OperationalError:
+            return  # DB o tabella non ancora creati
+        _data_version = data_version
+
+        cambiate: list[str] = []
+        with _lock:
+            for t, v in righe:
+                if _db_visti.get(t) != v:
+                    _db_visti[t] = v
+                    _versioni[t] = _versioni.get(t, 0) + 1
+                    cambiate.append(t)
+
+    # fuori dai lock: le invalidazioni prendono i lock delle rispettive cache
+    eseguite: set[Callable[[], None]] = set()
+    for t in cambiate:
+        for fn in _invalidazioni.get(t, ()):
+            if fn not in eseguite:
+                eseguite.add(fn)
+                fn()
+
+
+async def sincronizza_periodicamente(intervallo: float) -> None:
+    """Task dell'API: porta le modifiche degli altri worker anche a chi non riceve richieste (es. stream SSE)."""
+    while True:
+        try:
+            await asyncio.to_thread(sincronizza)
+        except Exception:
+            logger.exception("Sincronizzazione versioni fallita")
+        await asyncio.sleep(intervallo)
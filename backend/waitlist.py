@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import heapq
+import threading
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from .calendario import calendario
+from .db import al_rollback
+from .disponibilita import Intervallo, _arrotonda, interseca, occupati, sottrai
+from .models import Appuntamento, ListaAttesa, Notifica, StatoAppuntamento, TipoNotifica, TipoVisita
+from .pubsub import aggiungi_notifica
+from .sale import catalogo_sale
+from .versioni import incrementa, registra_invalidazione, sincronizza
+
+# Motore lista d'attesa.
+# Tiene in memoria, per ogni medico, un heap di richieste ordinate per (priorita, inserita_il):
+# quando si libera un intervallo lo riempie con le richieste (di qualunque tipo visita) che ci stanno,
+# anche più d'una se l'intervallo è lungo, senza rileggere ogni volta la tabella lista_attesa.
+
+
+@dataclass(frozen=True, order=True)
+class RichiestaAttesa:
+    priorita: int
+    inserita_il: datetime
+    id: int
+    paziente_id: str = field(compare=False)
+    tipo_visita_id: int = field(compare=False)
+    durata_minuti: int = field(compare=False)
+
+
+@dataclass(frozen=True)
+class IntervalloLibero:
+    """Intervallo [inizio, fine) liberato per un medico in una sala."""
+    medico_id: str
+    sala_id: int
+    inizio: datetime
+    fine: datetime
+
+
+class WaitlistEngine:
+    """
+    Heap per medico caricati in modo lazy alla prima richiesta.
+    Le modifiche in memoria sono immediate; se la transazione fallisce la cache viene invalidata
+    e ricaricata alla chiamata successiva, come quando un altro processo modifica la lista d'attesa.
+    """
+
+    def __init__(self) -> None:
+        self._heaps: dict[str, list[RichiestaAttesa]] | None = None
+        self._lock = threading.RLock()
+
+    def invalida(self) -> None:
+        with self._lock:
+            self._heaps = None
+
+    def _carica(self, s: Session) -> dict[str, list[RichiestaAttesa]]:
+        sincronizza()
+        if self._heaps is not None:
+            return self._heaps
+
+        rows = s.execute(
+            select(
+                ListaAttesa.id,
+                ListaAttesa.medico_id,
+                ListaAttesa.paziente_id,
+                ListaAttesa.tipo_visita_id,
+                ListaAttesa.priorita,
+                ListaAttesa.inserita_il,
+                TipoVisita.durata_minuti,
+            ).join(TipoVisita, TipoVisita.id == ListaAttesa.tipo_visita_id)
+        ).all()
+
+        heaps: dict[str, list[RichiestaAttesa]] = {}
+        for r in rows:
+            heaps.setdefault(r.medico_id, []).append(
+                RichiestaAttesa(r.priorita, r.inserita_il, r.id, r.paziente_id, r.tipo_visita_id, r.durata_minuti)
+            )
+        for h in heaps.values():
+            heapq.heapify(h)
+
+        self._heaps = heaps
+        return heaps
+
+    def medici_in_attesa(self, s: Session) -> set[str]:
+        with self._lock:
+            return {m for m, h in self._carica(s).items() if h}
+
+    def aggiungi(self, s: Session, wl: ListaAttesa, durata_minuti: int) -> None:
+        """Registra una nuova richiesta (già aggiunta alla sessione e con id assegnato)."""
+        al_rollback(s, self.invalida)
+        sincronizza()
+        with self._lock:
+            if self._heaps is None:
+                self._carica(s)  # il caricamento vede già la riga appena inserita
+                return
+            heapq.heappush(
+                self._heaps.setdefault(wl.medico_id, []),
+                RichiestaAttesa(wl.priorita, wl.inserita_il, wl.id, wl.paziente_id, wl.tipo_visita_id, durata_minuti),
+            )
+
+    def riempi(self, s: Session, intervalli: list[IntervalloLibero]) -> list[str]:
+        """
+        Riempie gli intervalli liberati con le richieste in attesa, nella transazione corrente.
+        - una sola query per gli appuntamenti attivi che toccano gli intervalli (medico o sala)
+        - per ogni tratto libero: dall'inizio, la richiesta con priorità migliore che ci sta per durata
+          (un intervallo lungo può ospitare più visite brevi)
+        - solo il futuro: gli intervalli iniziano al più presto adesso (arrotondato al passo della griglia)
+        Ritorna gli id degli appuntamenti creati.
+        """
+        ora = _arrotonda(datetime.now())
+        intervalli = [replace(i, inizio=max(i.inizio, ora)) for i in intervalli if i.fine > ora]
+        if not intervalli:
+            return []
+
+        with self._lock:
+            heaps = self._carica(s)
+            intervalli = [i for i in intervalli if heaps.get(i.medico_id)]
+            if not intervalli:
+                return []
+
+            occ_medico, occ_sala = self._occupati(s, intervalli)
+            cat = catalogo_sale(s)
+            creati: list[str] = []
+            al_rollback(s, self.invalida)
+
+            for gap in sorted(intervalli, key=lambda i: i.inizio):
+                heap = heaps.get(gap.medico_id)
+                if not heap:
+                    continue
+
+                occupato = occ_medico.setdefault(gap.medico_id, []) + occ_sala.setdefault(gap.sala_id, [])
+                # solo richieste il cui tipo visita trova nella sala le attrezzature necessarie
+                candidati = [r for r in sorted(heap) if cat.adatta(gap.sala_id, r.tipo_visita_id)]
+                presi: set[int] = set()
+
+                # solo nelle fasce di lavoro del medico (rilevante quando la sala passa a un altro medico)
+                lavoro = calendario.finestre_giorno(s, gap.medico_id, gap.inizio.date())
+                for inizio_libero, fine_libero in interseca(sottrai((gap.inizio, gap.fine), occupato), lavoro):
+                    cursore = inizio_libero
+                    for r in candidati:
+                        if r.id in presi:
+                            continue
+                        fine = cursore + timedelta(minutes=r.durata_minuti)
+                        if fine > fine_libero:
+                            continue
+
+                        presi.add(r.id)
+                        app_id = self._assegna(s, r, gap, cursore, fine)
+                        if app_id is None:
+                            continue  # richiesta già evasa altrove: scartata
+
+                        creati.append(app_id)
+                        occ_medico[gap.medico_id].append((cursore, fine))
+                        occ_sala[gap.sala_id].append((cursore, fine))
+                        cursore = fine
+
+                if presi:
+                    heap[:] = [r for r in heap if r.id not in presi]
+                    heapq.heapify(heap)
+
+        return creati
+
+    @staticmethod
+    def _occupati(
+        s: Session, intervalli: list[IntervalloLibero]
+    ) -> tuple[dict[str, list[Intervallo]], dict[int, list[Intervallo]]]:
+        return occupati(
+            s,
+            {i.medico_id for i in intervalli},
+            {i.sala_id for i in intervalli},
+            min(i.inizio for i in intervalli),
+            max(i.fine for i in intervalli),
+        )
+
+    @staticmethod
+    def _assegna(s: Session, r: RichiestaAttesa, gap: IntervalloLibero, inizio: datetime, fine: datetime) -> str | None:
+        # rimuove la richiesta dalla lista d'attesa (rowcount 0 = già promossa da un altro processo)
+        if s.execute(delete(ListaAttesa).where(ListaAttesa.id == r.id)).rowcount != 1:
+            return None
+        incrementa(s, "lista_attesa", "appuntamenti", "notifiche")
+
+        app = Appuntamento(
+            paziente_id=r.paziente_id,
+            medico_id=gap.medico_id,
+            tipo_visita_id=r.tipo_visita_id,
+            sala_id=gap.sala_id,
+            inizio=inizio,
+            fine=fine,
+            stato=StatoAppuntamento.CONFERMATO,
+            note="Generato automaticamente da lista d'attesa.",
+        )
+        s.add(app)
+        s.flush()
+
+        aggiungi_notifica(
+            s,
+            Notifica(
+                tipo=TipoNotifica.WAITLIST_PROMOSSA,
+                messaggio=f"Si è liberato uno slot: appuntamento assegnato per {inizio.strftime('%d/%m/%Y %H:%M')}.",
+                appuntamento_id=app.id,
+                paziente_id=r.paziente_id,
+            ),
+        )
+        return app.id
+
+
+waitlist_engine = WaitlistEngine()
+registra_invalidazione(waitlist_engine.invalida, "lista_attesa")
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal, annulla_callback, db_session, segna_callback
+
+# Coda di scrittura "group commit" (opzionale).
+# SQLite ammette un solo writer alla volta: invece di un commit (e un fsync) per richiesta,
+# un unico thread writer raccoglie le operazioni arrivate negli ultimi millisecondi
+# e le esegue in una sola transazione, ognuna dentro il proprio SAVEPOINT.
+#
+# Abilitazione: variabile d'ambiente STUDIO_WRITE_QUEUE=1 oppure avvia_write_queue().
+
+WRITE_QUEUE_ENABLED = os.getenv("STUDIO_WRITE_QUEUE", "0") == "1"
+WRITE_QUEUE_INTERVALLO_MS = int(os.getenv("STUDIO_WRITE_QUEUE_MS", "5"))
+WRITE_QUEUE_MAX_BATCH = int(os.getenv("STUDIO_WRITE_QUEUE_MAX_BATCH", "256"))
+
+Operazione = Callable[..., Any]
+
+
+@dataclass
+class _Richiesta:
+    fn: Operazione
+    args: tuple
+    kwargs: dict
+    future: Future = field(default_factory=Future)
+
+
+class GroupCommitQueue:
+    """
+    Writer singolo che coalizza le operazioni di scrittura.
+    - ogni operazione riceve la sessione come primo argomento: fn(s, *args, **kwargs)
+    - ogni operazione gira in un SAVEPOINT: se fallisce viene annullata solo lei
+    - i risultati vengono consegnati (Future) solo dopo il COMMIT del batch
+    """
+
+    def __init__(self, intervallo_ms: int = WRITE_QUEUE_INTERVALLO_MS, max_batch: int = WRITE_QUEUE_MAX_BATCH) -> None:
+        self.intervallo_s = max(intervallo_ms, 0) / 1000.0
+        self.max_batch = max(max_batch, 1)
+        self._coda: queue.Queue[_Richiesta | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def avvia(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="write-queue", daemon=True)
+            self._thread.start()
+
+    def ferma(self, timeout: float | None = 5.0) -> None:
+        with self._lock:
+            if not self._thread:
+                return
+            self._coda.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, fn: Operazione, *args: Any, **kwargs: Any) -> Future:
+        """Accoda un'operazione e ritorna il Future con il suo risultato individuale."""
+        self.avvia()
+        r = _Richiesta(fn, args, kwargs)
+        self._coda.put(r)
+        return r.future
+
+    # Loop writer
+
+    def _loop(self) -> None:
+        while True:
+            primo = self._coda.get()
+            if primo is None:
+                return
+
+            batch = [primo]
+            stop = self._raccogli(batch)
+            self._esegui_batch(batch)
+            if stop:
+                return
+
+    def _raccogli(self, batch: list[_Richiesta]) -> bool:
+        """Raccoglie altre richieste per al massimo `intervallo_s` (o fino a max_batch)."""
+        if self.intervallo_s <= 0:
+            return False
+
+        scadenza = time.monotonic() + self.intervallo_s
+        while len(batch) < self.max_batch:
+            resto = scadenza - time.monotonic()
+            if resto <= 0:
+                break
+            try:
+                r = self._coda.get(timeout=resto)
+            except queue.Empty:
+                break
+            if r is None:
+                return True
+            batch.append(r)
+        return False
+
+    def _esegui_batch(self, batch: list[_Richiesta]) -> None:
+        riuscite: list[tuple[_Richiesta, Any]] = []
+        s: Session = SessionLocal()
+        try:
+            for r in batch:
+                if not r.future.set_running_or_notify_cancel():
+                    continue
+                segno = segna_callback(s)
+                try:
+                    with s.begin_nested():
+                        risultato = r.fn(s, *r.args, **r.kwargs)
+                except Exception as e:  # l'errore resta confinato alla singola operazione
+                    annulla_callback(s, segno)
+                    r.future.set_exception(e)
+                else:
+                    riuscite.append((r, risultato))
+
+            s.commit()
+        except Exception as e:
+            s.rollback()
+            for r, _ in riuscite:
+                r.future.set_exception(e)
+            return
+        finally:
+            s.close()
+
+        for r, risultato in riuscite:
+            r.future.set_result(risultato)
+
+
+_write_queue: GroupCommitQueue | None = None
+_write_queue_lock = threading.Lock()
+
+
+def get_write_queue() -> GroupCommitQueue:
+    global _write_queue
+    with _write_queue_lock:
+        if _write_queue is None:
+            _write_queue = GroupCommitQueue()
+        return _write_queue
+
+
+def avvia_write_queue() -> None:
+    """Abilita la coda di scrittura per tutto il processo."""
+    global WRITE_QUEUE_ENABLED
+    WRITE_QUEUE_ENABLED = True
+    get_write_queue().avvia()
+
+
+def ferma_write_queue() -> None:
+    global WRITE_QUEUE_ENABLED
+    WRITE_QUEUE_ENABLED = False
+    if _write_queue is not None:
+        _write_queue.ferma()
+
+
+def esegui_scrittura(fn: Operazione, *args: Any, **kwargs: Any) -> Any:
+    """
+    Esegue un'operazione di scrittura fn(s, ...):
+    - con la coda attiva: la accoda e attende il risultato (group commit)
+    - altrimenti: sessione dedicata con commit immediato (comportamento classico)
+    """
+    if WRITE_QUEUE_ENABLED:
+        return get_write_queue().submit(fn, *args, **kwargs).result()
+
+    with db_session() as s:
+        return fn(s, *args, **kwargs)
@@ -1,16 +1,26 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import json
 import os
-from datetime import date, datetime, timezone
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
 
 st.set_page_config(page_title="Studio Medico", layout="wide")
 
 API_BASE = os.getenv("API_BASE", "http://127.0.0.1:8000")
+CACHE_TTL_SECONDS = int(os.getenv("UI_CACHE_TTL", "30"))
+CACHE_GRAZIA_SECONDS = int(os.getenv("UI_CACHE_GRAZIA", "600"))  # rivalidazione con ETag dopo la scadenza
+CACHE_MAX_VOCI = int(os.getenv("UI_CACHE_MAX_VOCI", "2000"))
 
 
 
@@ -52,44 +62,319 @@ def jwt_username(token: str) -> str:
 
 
 # HTTP client (con JWT)
-
-def api_get(path: str, token: str | None = None, params: dict | None = None) -> dict | list:
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    r = requests.get(f"{API_BASE}{path}", headers=headers, params=params, timeout=10)
-
+# Sessione HTTP condivisa (keep-alive, pool di connessioni) e cache delle risposte GET:
+# ogni rerun riusa le connessioni aperte e le risposte ancora valide.
+
+@st.cache_resource
+def http_session() -> requests.Session:
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+@st.cache_resource
+def http_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="api")
+
+
+class CacheRisposte:
+    """
+    Cache GET condivisa tra le sessioni Streamlit, separata per token (ogni utente vede i propri dati).
+    - scadenza dopo CACHE_TTL_SECONDS; una voce scaduta con ETag viene rivalidata (304 = nessun download)
+      per altri CACHE_GRAZIA_SECONDS, poi viene eliminata
+    - al più CACHE_MAX_VOCI voci (LRU); le voci dei token scaduti vengono eliminate
+    - invalidata dopo le scritture fatte dalla UI (api_post)
+    """
+
+    def __init__(self, ttl: int, grazia: int = CACHE_GRAZIA_SECONDS, max_voci: int = CACHE_MAX_VOCI) -> None:
+        self.ttl = ttl
+        self.grazia = grazia
+        self.max_voci = max_voci
+        self._dati: OrderedDict[tuple, tuple[float, dict | list, str | None]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._prossima_pulizia = 0.0
+
+    @staticmethod
+    def chiave(path: str, token: str | None, params: dict | None) -> tuple:
+        return token, path, tuple(sorted((params or {}).items()))
+
+    def voce(self, chiave: tuple) -> tuple[bool, dict | list | None, str | None]:
+        """(ancora valida, valore, etag) anche per voci scadute ma ancora rivalidabili."""
+        ora = time.monotonic()
+        with self._lock:
+            voce = self._dati.get(chiave)
+            if voce is None:
+                return False, None, None
+            if voce[0] + self.grazia < ora:
+                del self._dati[chiave]
+                return False, None, None
+            self._dati.move_to_end(chiave)
+            return voce[0] >= ora, voce[1], voce[2]
+
+    def scrivi(self, chiave: tuple, valore: dict | list, etag: str | None = None) -> None:
+        ora = time.monotonic()
+        with self._lock:
+            self._dati[chiave] = (ora + self.ttl, valore, etag)
+            self._dati.move_to_end(chiave)
+            while len(self._dati) > self.max_voci:
+                self._dati.popitem(last=False)  # la voce usata meno di recente
+            if ora >= self._prossima_pulizia:
+                self._prossima_pulizia = ora + self.ttl
+                self._pulisci(ora)
+
+    def _pulisci(self, ora: float) -> None:
+        # ogni login crea un nuovo token e ogni pagina/filtro una nuova chiave: senza pulizia la cache cresce sempre
+        token_scaduti = {t for t in {k[0] for k in self._dati} if t is not None and jwt_is_expired(t)}
+        for k in [k for k, v in self._dati.items() if v[0] + self.grazia < ora or k[0] in token_scaduti]:
+            del self._dati[k]
+
+    def invalida(self, token: str | None) -> None:
+        with self._lock:
+            for k in [k for k in self._dati if k[0] == token]:
+                del self._dati[k]
+
+
+@st.cache_resource
+def cache_risposte() -> CacheRisposte:
+    return CacheRisposte(CACHE_TTL_SECONDS)
+
+
+def _headers(token: str | None) -> dict:
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+
+def _headers_client() -> dict:
+    # l'API limita login e prenotazioni per IP: inoltro quello dell'utente, non quello di questo server
+    ip = st.context.ip_address
+    return {"X-Forwarded-For": ip} if ip else {}
+
+
+class TroppeRichieste(Exception):
+    """429/503 dai limiti dell'API."""
+
+
+def _controlla_limiti(r: requests.Response) -> None:
+    if r.status_code in (429, 503):
+        attesa = r.headers.get("Retry-After", "qualche")
+        raise TroppeRichieste(f"Troppe richieste in questo momento: riprova tra {attesa} secondi.")
+
+
+def _esito(r: requests.Response) -> dict | list:
     if r.status_code == 401:
         raise PermissionError("401 Unauthorized (token non valido/scaduto oppure backend riavviato).")
 
+    _controlla_limiti(r)
     r.raise_for_status()
     return r.json()
 
 
-def api_post(path: str, payload: dict, token: str | None = None) -> dict:
-    headers = {"Content-Type": "application/json"}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    r = requests.post(f"{API_BASE}{path}", headers=headers, json=payload, timeout=10)
+def _get(sessione: requests.Session, cache: CacheRisposte, path: str, token: str | None, params: dict | None) -> dict | list:
+    chiave = cache.chiave(path, token, params)
+    valida, cached, etag = cache.voce(chiave)
+    if valida:
+        return cached
 
-    if r.status_code == 401:
-        raise PermissionError("401 Unauthorized (token non valido/scaduto oppure backend riavviato).")
+    headers = _headers(token)
+    if etag:
+        headers["If-None-Match"] = etag
+
+    r = sessione.get(f"{API_BASE}{path}", headers=headers, params=params, timeout=10)
+    if r.status_code == 304 and cached is not None:
+        cache.scrivi(chiave, cached, etag)
+        return cached
+
+    dati = _esito(r)
+    cache.scrivi(chiave, dati, r.headers.get("ETag"))
+    return dati
+
+
+def api_get(path: str, token: str | None = None, params: dict | None = None) -> dict | list:
+    return _get(http_session(), cache_risposte(), path, token, params)
+
+
+def api_get_many(richieste: dict[str, tuple[str, str | None, dict | None]]) -> dict[str, dict | list | Exception]:
+    """
+    Esegue in parallelo GET indipendenti: {nome: (path, token, params)} -> {nome: risposta oppure eccezione}.
+    Le risposte già in cache non generano richieste.
+    """
+    # risorse condivise risolte nel thread dello script (i worker non hanno il contesto Streamlit)
+    sessione, cache, executor = http_session(), cache_risposte(), http_executor()
+    futures = {
+        nome: executor.submit(_get, sessione, cache, path, token, params)
+        for nome, (path, token, params) in richieste.items()
+    }
+
+    out: dict[str, dict | list | Exception] = {}
+    for nome, f in futures.items():
+        try:
+            out[nome] = f.result()
+        except Exception as e:
+            out[nome] = e
+    return out
 
-    r.raise_for_status()
-    return r.json()
+
+def _idempotency_key(path: str, payload: dict) -> str:
+    # stessa chiave finché la richiesta non va a buon fine: un nuovo clic dopo un timeout non duplica la prenotazione
+    sessione = st.session_state.setdefault("idem_sessione", uuid.uuid4().hex)
+    seq = st.session_state.setdefault("idem_seq", 0)
+    corpo = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(f"{sessione}:{seq}:{path}:{corpo}".encode()).hexdigest()
+
+
+def api_post(path: str, payload: dict, token: str | None = None) -> dict:
+    headers = {
+        "Content-Type": "application/json",
+        "Idempotency-Key": _idempotency_key(path, payload),
+        **_headers(token),
+        **_headers_client(),
+    }
+    r = http_session().post(f"{API_BASE}{path}", headers=headers, json=payload, timeout=10)
+    dati = _esito(r)
+    st.session_state["idem_seq"] += 1
+
+    # la scrittura rende vecchie le liste in cache di questo utente (e i dati pubblici)
+    cache = cache_risposte()
+    cache.invalida(token)
+    cache.invalida(None)
+    return dati
 
 
 def api_login(username: str, password: str) -> str:
     # OAuth2PasswordRequestForm => x-www-form-urlencoded
-    r = requests.post(
+    r = http_session().post(
         f"{API_BASE}/api/auth/login",
         data={"username": username, "password": password},
+        headers=_headers_client(),
         timeout=10,
     )
+    _controlla_limiti(r)
     r.raise_for_status()
     return r.json()["access_token"]
 
 
+# Liste aggiornate in tempo reale (SSE /api/stream/...)
+# Un thread di background per lista scarica la lista una volta, poi applica le modifiche ricevute dallo stream:
+# i rerun della pagina leggono dalla memoria, senza richieste HTTP. Un evento "ricarica" (modifiche in blocco,
+# eventi persi) fa rileggere la lista. Il thread si ferma dopo LIVE_INATTIVITA secondi senza letture.
+
+LIVE_AGGIORNAMENTO = float(os.getenv("UI_LIVE_SECONDI", "2"))
+LIVE_INATTIVITA = 300
+
+
+class ListaLive:
+    def __init__(self, sessione: requests.Session, path: str, stream: str, token: str, params: dict, applica) -> None:
+        self.sessione = sessione
+        self.path, self.stream, self.token, self.params = path, stream, token, params
+        self.applica = applica  # (righe, evento) -> False se serve rileggere la lista
+        self.righe: list[dict] | None = None
+        self.errore: Exception | None = None
+        self.attiva = True
+        self._lock = threading.Lock()
+        self._ultimo_uso = time.monotonic()
+        threading.Thread(target=self._ascolta, daemon=True, name=f"live{path}").start()
+
+    def leggi(self) -> list[dict] | None:
+        self._ultimo_uso = time.monotonic()
+        with self._lock:
+            if self.errore is not None and self.righe is None:
+                raise self.errore
+            return None if self.righe is None else list(self.righe)
+
+    def _carica(self) -> None:
+        r = self.sessione.get(f"{API_BASE}{self.path}", headers=_headers(self.token), params=self.params, timeout=10)
+        righe = _esito(r)
+        with self._lock:
+            self.righe, self.errore = righe, None
+
+    def _ascolta(self) -> None:
+        ultimo_id = None
+        while time.monotonic() - self._ultimo_uso < LIVE_INATTIVITA:
+            try:
+                headers = _headers(self.token)
+                if ultimo_id:
+                    headers["Last-Event-ID"] = ultimo_id
+                # lo stream si apre prima di leggere la lista: nessuna modifica va persa nel mezzo
+                with requests.get(
+                    f"{API_BASE}{self.stream}", headers=headers, params=self.params, stream=True, timeout=(5, 60)
+                ) as r:
+                    _esito_stream(r)
+                    if ultimo_id is None:
+                        self._carica()
+                    for riga in r.iter_lines(decode_unicode=True):
+                        if riga.startswith("id: "):
+                            ultimo_id = riga[4:]
+                        elif riga.startswith("data: "):
+                            self._applica(json.loads(riga[6:]))
+                        if time.monotonic() - self._ultimo_uso >= LIVE_INATTIVITA:
+                            break
+            except PermissionError as e:
+                with self._lock:
+                    self.errore = e
+                break
+            except Exception as e:
+                with self._lock:
+                    self.errore = e
+                time.sleep(3)
+        self.attiva = False
+
+    def _applica(self, evento: dict) -> None:
+        if evento["azione"] != "ricarica":
+            with self._lock:
+                if self.righe is not None and self.applica(self.righe, evento):
+                    return
+        self._carica()
+
+
+def _esito_stream(r: requests.Response) -> None:
+    if r.status_code == 401:
+        raise PermissionError("401 Unauthorized (token non valido/scaduto oppure backend riavviato).")
+    r.raise_for_status()
+
+
+@st.cache_resource
+def liste_live() -> dict[tuple, ListaLive]:
+    return {}
+
+
+def lista_live(path: str, stream: str, token: str, params: dict, applica) -> list[dict] | None:
+    """Righe correnti della lista (None finché non è stata scaricata la prima volta)."""
+    registro = liste_live()
+    chiave = (path, token, tuple(sorted(params.items())))
+    lista = registro.get(chiave)
+    if lista is None or not lista.attiva:
+        for k in [k for k, v in registro.items() if not v.attiva]:
+            del registro[k]
+        # sessione risolta nel thread dello script (il thread di ascolto non ha il contesto Streamlit)
+        lista = registro[chiave] = ListaLive(http_session(), path, stream, token, params, applica)
+    return lista.leggi()
+
+
+def applica_agenda(righe: list[dict], evento: dict) -> bool:
+    righe[:] = [r for r in righe if r.get("id") != evento["id"]]
+    if evento["stato"] != "ANNULLATO":
+        righe.append({k: v for k, v in evento.items() if k not in ("azione", "medico_id", "giorno")})
+        righe.sort(key=lambda r: r["inizio"])
+    return True
+
+
+def applica_notifiche(righe: list[dict], evento: dict, offset: int = 0) -> bool:
+    """Pagina di notifiche pendenti (più vecchie prima): le nuove vanno in fondo all'ultima pagina."""
+    if evento["azione"] == "creata":
+        if len(righe) < PAGE_SIZE:
+            righe.append({k: v for k, v in evento.items() if k != "azione"})
+        return True
+    if evento["azione"] in ("inviata", "eliminata"):
+        piena = len(righe) >= PAGE_SIZE
+        n = len(righe)
+        righe[:] = [r for r in righe if r["id"] != evento["id"]]
+        if len(righe) < n:
+            return not piena  # su una pagina piena entra una riga della pagina successiva: va riletta
+        return offset == 0  # non era in pagina: se era in una pagina precedente le righe scorrono
+    return False
+
+
 def is_logged_in() -> bool:
     token = st.session_state.get("token")
     return bool(token) and isinstance(token, str) and len(token) > 0
@@ -154,41 +439,121 @@ with st.sidebar:
 
 
 
-# UI
-
-st.title("Sistema Studio Medico (API REST + JWT + Streamlit)")
-
-tab1, tab2, tab3, tab4 = st.tabs(["Prenotazioni", "Agenda Medico", "Pazienti", "Notifiche"])
-
-
-
 # Dati base (pubblici)
 
-@st.cache_data(ttl=10)
 def load_medici() -> list[dict]:
     return api_get("/api/medici")  # public
 
 
-@st.cache_data(ttl=10)
 def load_sale() -> list[dict]:
     return api_get("/api/sale")  # public
 
 
-@st.cache_data(ttl=10)
 def load_tipi() -> list[dict]:
     return api_get("/api/tipi-visita")  # public
 
 
+def _dato(dati: dict[str, dict | list | Exception], nome: str) -> dict | list:
+    """Risultato di api_get_many: rilancia l'eventuale errore della singola richiesta."""
+    valore = dati[nome]
+    if isinstance(valore, Exception):
+        raise valore
+    return valore
+
+
+
+# Liste paginate lato server (una sola tabella, solo la pagina richiesta)
+
+PAGE_SIZE = int(os.getenv("UI_PAGE_SIZE", "50"))
+
 
-# TAB 1 - Prenotazioni
+@st.fragment
+def tabella_paginata(
+    path: str,
+    token: str,
+    key: str,
+    colonne: list[str],
+    vuoto: str,
+    errore: str,
+) -> None:
+    # fragment: cambiare pagina riesegue solo questa tabella, non l'intera pagina
+    pagina = st.number_input("Pagina", min_value=1, value=1, step=1, key=f"{key}_pagina")
+
+    try:
+        righe = api_get(path, token=token, params={"limit": PAGE_SIZE, "offset": (pagina - 1) * PAGE_SIZE})
+    except PermissionError as e:
+        st.session_state["auth_error"] = str(e)
+        st.error("Sessione non valida. Premi Logout e rifai login.")
+        return
+    except Exception as e:
+        st.error(f"{errore}: {e}")
+        return
+
+    if not righe:
+        st.info(vuoto)
+        return
+
+    st.dataframe(righe, column_order=colonne, hide_index=True)
+    if len(righe) == PAGE_SIZE:
+        st.caption("Altri risultati nella pagina successiva.")
+
+
+
+# Pagina Prenotazioni
+
+GIORNI_SETTIMANA = ["lun", "mar", "mer", "gio", "ven", "sab", "dom"]
+ORE_HEATMAP = range(8, 20)
+
+
+def mostra_heatmap(medico: dict | None, giorno: date) -> None:
+    """Minuti liberi per ora del medico nella settimana del giorno scelto (GET /api/disponibilita/heatmap)."""
+    if not medico:
+        return
+    try:
+        dati = api_get("/api/disponibilita/heatmap", params={"settimana": giorno.isoformat(), "medico_id": medico["id"]})
+    except Exception as e:
+        st.error(f"Errore caricamento disponibilità: {e}")
+        return
+
+    lunedi = date.fromisoformat(dati["da"])
+    per_ora = dati["medici"][0]["minuti_liberi_per_ora"] if dati["medici"] else []
+    tabella: dict[str, list] = {
+        "Giorno": [
+            f"{GIORNI_SETTIMANA[g]} {(lunedi + timedelta(days=g)).strftime('%d/%m')}" for g in range(len(per_ora))
+        ]
+    }
+    for h in ORE_HEATMAP:
+        tabella[f"{h:02d}"] = [giorno_ore[h] for giorno_ore in per_ora]
+
+    st.caption("Minuti liberi per fascia oraria")
+    st.dataframe(
+        tabella,
+        hide_index=True,
+        column_config={
+            f"{h:02d}": st.column_config.ProgressColumn(f"{h:02d}", min_value=0, max_value=60, format="%d")
+            for h in ORE_HEATMAP
+        },
+    )
 
-with tab1:
+
+def pagina_prenotazioni() -> None:
     st.subheader("Prenota appuntamento")
 
+    token = st.session_state.get("token")
+    logged = is_logged_in() and not jwt_is_expired(token)
+
+    # richieste indipendenti in parallelo (i pazienti servono solo in modalità interna)
+    richieste: dict[str, tuple[str, str | None, dict | None]] = {
+        "medici": ("/api/medici", None, None),
+        "sale": ("/api/sale", None, None),
+        "tipi": ("/api/tipi-visita", None, None),
+    }
+    if logged:
+        richieste["pazienti"] = ("/api/pazienti", token, None)
+    dati = api_get_many(richieste)
+
     try:
-        medici = load_medici()
-        sale = load_sale()
-        tipi = load_tipi()
+        medici, sale, tipi = (_dato(dati, k) for k in ("medici", "sale", "tipi"))
     except Exception as e:
         st.error(f"API non raggiungibile o errore: {e}")
         st.stop()
@@ -204,8 +569,8 @@ with tab1:
         )
         sala = st.selectbox(
             "Sala",
-            options=sale,
-            format_func=lambda s: s["nome"],
+            options=[None, *sale],
+            format_func=lambda s: "Automatica (sala libera e attrezzata)" if s is None else s["nome"],
             key="pren_sala",
         )
 
@@ -227,9 +592,10 @@ with tab1:
         note = st.text_area("Note (opzionale)", height=100, key="pren_note")
         waitlist = st.checkbox("Se pieno, inserisci in lista d'attesa", value=True, key="pren_waitlist")
 
-    st.divider()
+    with st.expander("Disponibilità della settimana"):
+        mostra_heatmap(medico, start_date)
 
-    token = st.session_state.get("token")
+    st.divider()
 
     if not is_logged_in():
         st.info("Prenotazione pubblica (senza login): inserisci i dati del paziente.")
@@ -239,6 +605,7 @@ with tab1:
         cognome = c2.text_input("Cognome paziente", key="pub_cognome")
         email = st.text_input("Email (opzionale)", key="pub_email")
         tel = st.text_input("Telefono (opzionale)", key="pub_tel")
+        cf = st.text_input("Codice fiscale (opzionale)", key="pub_cf", max_chars=16)
 
         if st.button("Conferma prenotazione (pubblica)", key="pren_pub_submit"):
             if not nome.strip() or not cognome.strip():
@@ -248,7 +615,7 @@ with tab1:
                 payload = {
                     "medico_id": medico["id"],
                     "tipo_visita_id": tipo["id"],
-                    "sala_id": sala["id"],
+                    "sala_id": sala["id"] if sala else None,
                     "start": start_dt.isoformat(),
                     "note": note or None,
                     "inserisci_waitlist_se_pieno": waitlist,
@@ -256,6 +623,7 @@ with tab1:
                     "cognome": cognome.strip(),
                     "email": email.strip() or None,
                     "telefono": tel.strip() or None,
+                    "codice_fiscale": cf.strip() or None,
                 }
                 try:
                     res = api_post("/api/public/prenotazioni", payload)
@@ -275,7 +643,7 @@ with tab1:
             st.error("Sessione scaduta. Premi Logout e rifai login.")
         else:
             try:
-                pazienti = api_get("/api/pazienti", token=token)
+                pazienti = _dato(dati, "pazienti")
             except PermissionError as e:
                 st.session_state["auth_error"] = str(e)
                 st.error("Sessione non valida. Premi Logout e rifai login.")
@@ -298,7 +666,7 @@ with tab1:
                     "paziente_id": paziente["id"],
                     "medico_id": medico["id"],
                     "tipo_visita_id": tipo["id"],
-                    "sala_id": sala["id"],
+                    "sala_id": sala["id"] if sala else None,
                     "start": start_dt.isoformat(),
                     "note": note or None,
                     "inserisci_waitlist_se_pieno": waitlist,
@@ -319,123 +687,176 @@ with tab1:
 
 
 
-# TAB 2 - Agenda medico (PROTETTO)
+# Pagina Agenda medico (PROTETTO)
 
-with tab2:
+def pagina_agenda() -> None:
     st.subheader("Agenda giornaliera (sezione riservata)")
 
     token = require_auth()
-    if token:
-        medici = load_medici()
+    if not token:
+        return
 
-        medico_agenda = st.selectbox(
-            "Medico",
-            options=medici,
-            format_func=lambda m: f"{m['cognome']} {m['nome']} ({m['specializzazione']})",
-            key="agenda_medico",
-        )
-        giorno = st.date_input("Giorno", value=date.today(), key="agenda_giorno")
+    medici = load_medici()
 
-        try:
-            items = api_get(
-                "/api/agenda",
-                token=token,
-                params={"medico_id": medico_agenda["id"], "giorno": giorno.isoformat()},
+    medico_agenda = st.selectbox(
+        "Medico",
+        options=medici,
+        format_func=lambda m: f"{m['cognome']} {m['nome']} ({m['specializzazione']})",
+        key="agenda_medico",
+    )
+    giorno = st.date_input("Giorno", value=date.today(), key="agenda_giorno")
+
+    agenda_live(token, medico_agenda["id"], giorno)
+
+
+@st.fragment(run_every=LIVE_AGGIORNAMENTO)
+def agenda_live(token: str, medico_id: str, giorno: date) -> None:
+    # fragment: si ridisegna da solo leggendo la lista tenuta aggiornata dallo stream
+    try:
+        items = lista_live(
+            "/api/agenda",
+            "/api/stream/agenda",
+            token,
+            {"medico_id": medico_id, "giorno": giorno.isoformat()},
+            applica_agenda,
+        )
+        if items is None:
+            st.caption("Caricamento agenda...")
+        elif not items:
+            st.info("Nessun appuntamento per questo giorno.")
+        else:
+            st.dataframe(
+                items,
+                column_order=["inizio", "fine", "tipo_visita", "sala", "stato", "note"],
+                hide_index=True,
             )
-            if not items:
-                st.info("Nessun appuntamento per questo giorno.")
-            else:
-                for a in items:
-                    st.write(
-                        f"- **{a['inizio']} - {a['fine']}** | "
-                        f"Tipo: {a['tipo_visita']} | Sala: {a['sala']} | Stato: {a['stato']} | Note: {a['note'] or '-'}"
-                    )
-        except PermissionError as e:
-            st.session_state["auth_error"] = str(e)
-            st.error("Sessione non valida. Premi Logout e rifai login.")
-        except Exception as e:
-            st.error(f"Errore agenda: {e}")
+    except PermissionError as e:
+        st.session_state["auth_error"] = str(e)
+        st.error("Sessione non valida. Premi Logout e rifai login.")
+    except Exception as e:
+        st.error(f"Errore agenda: {e}")
 
 
 
-# TAB 3 - Pazienti (PROTETTO)
+# Pagina Pazienti (PROTETTO)
 
-with tab3:
+def pagina_pazienti() -> None:
     st.subheader("Gestione pazienti (sezione riservata)")
 
     token = require_auth()
-    if token:
-        with st.expander("Crea nuovo paziente"):
-            c1, c2 = st.columns(2)
-            nome = c1.text_input("Nome", key="paz_nome")
-            cognome = c2.text_input("Cognome", key="paz_cognome")
-            email = st.text_input("Email (opzionale)", key="paz_email")
-            tel = st.text_input("Telefono (opzionale)", key="paz_tel")
-
-            if st.button("Crea paziente", key="paz_submit"):
-                if not nome.strip() or not cognome.strip():
-                    st.error("Nome e cognome sono obbligatori.")
-                else:
-                    try:
-                        res = api_post(
-                            "/api/pazienti",
-                            {"nome": nome.strip(), "cognome": cognome.strip(), "email": email.strip() or None, "telefono": tel.strip() or None},
-                            token=token,
-                        )
-                        st.success(f"Paziente creato: {res.get('paziente_id')}")
-                    except PermissionError as e:
-                        st.session_state["auth_error"] = str(e)
-                        st.error("Sessione non valida. Premi Logout e rifai login.")
-                    except Exception as e:
-                        st.error(str(e))
-
-        st.divider()
-        st.write("Elenco pazienti:")
+    if not token:
+        return
 
-        try:
-            pazienti = api_get("/api/pazienti", token=token)
-            if not pazienti:
-                st.info("Nessun paziente presente.")
+    with st.expander("Crea nuovo paziente"):
+        c1, c2 = st.columns(2)
+        nome = c1.text_input("Nome", key="paz_nome")
+        cognome = c2.text_input("Cognome", key="paz_cognome")
+        email = st.text_input("Email (opzionale)", key="paz_email")
+        tel = st.text_input("Telefono (opzionale)", key="paz_tel")
+
+        if st.button("Crea paziente", key="paz_submit"):
+            if not nome.strip() or not cognome.strip():
+                st.error("Nome e cognome sono obbligatori.")
             else:
-                for p in pazienti:
-                    st.write(f"- {p['cognome']} {p['nome']} | {p.get('email') or '-'} | {p.get('telefono') or '-'}")
-        except PermissionError as e:
-            st.session_state["auth_error"] = str(e)
-            st.error("Sessione non valida. Premi Logout e rifai login.")
-        except Exception as e:
-            st.error(f"Errore caricamento pazienti: {e}")
+                try:
+                    res = api_post(
+                        "/api/pazienti",
+                        {"nome": nome.strip(), "cognome": cognome.strip(), "email": email.strip() or None, "telefono": tel.strip() or None},
+                        token=token,
+                    )
+                    st.success(f"Paziente creato: {res.get('paziente_id')}")
+                except PermissionError as e:
+                    st.session_state["auth_error"] = str(e)
+                    st.error("Sessione non valida. Premi Logout e rifai login.")
+                except Exception as e:
+                    st.error(str(e))
+
+    st.divider()
+    st.write("Elenco pazienti:")
+
+    tabella_paginata(
+        "/api/pazienti",
+        token,
+        key="paz_elenco",
+        colonne=["cognome", "nome", "email", "telefono"],
+        vuoto="Nessun paziente presente.",
+        errore="Errore caricamento pazienti",
+    )
+
+
+
+# Pagina Notifiche (PROTETTO)
 
+def _riga_notifica(n: dict) -> dict:
+    msg = (n.get("messaggio") or "").strip()
 
+    prefix = "Appuntamento confermato per "
+    if msg.startswith(prefix):
+        tail = msg[len(prefix):].strip().rstrip(".")  # es: "13/01/2026 16:00"
+        parts = tail.split()
+        if len(parts) >= 2:
+            d, t = parts[0], parts[1]
+            msg = f"Appuntamento confermato per il {d} h {t}."
 
-# TAB 4 - Notifiche (PROTETTO)
+    return {"id": n["id"], "tipo": n["tipo"], "paziente": n.get("paziente") or "-", "messaggio": msg}
 
-with tab4:
+
+def pagina_notifiche() -> None:
     st.subheader("Notifiche pendenti (sezione riservata)")
 
     token = require_auth()
-    if token:
-        try:
-            pendenti = api_get("/api/notifiche/pendenti", token=token, params={"limit": 200})
-            if not pendenti:
-                st.info("Nessuna notifica pendente.")
-            else:
-                for n in pendenti:
-                    paz = n.get("paziente") or "-"
+    if not token:
+        return
+
+    pagina = st.number_input("Pagina", min_value=1, value=1, step=1, key="not_elenco_pagina")
+    notifiche_live(token, (pagina - 1) * PAGE_SIZE)
+
+
+@st.fragment(run_every=LIVE_AGGIORNAMENTO)
+def notifiche_live(token: str, offset: int) -> None:
+    try:
+        righe = lista_live(
+            "/api/notifiche/pendenti",
+            "/api/stream/notifiche",
+            token,
+            {"limit": PAGE_SIZE, "offset": offset},
+            lambda righe, evento: applica_notifiche(righe, evento, offset),
+        )
+    except PermissionError as e:
+        st.session_state["auth_error"] = str(e)
+        st.error("Sessione non valida. Premi Logout e rifai login.")
+        return
+    except Exception as e:
+        st.error(f"Errore notifiche: {e}")
+        return
+
+    if righe is None:
+        st.caption("Caricamento notifiche...")
+        return
+    if not righe:
+        st.info("Nessuna notifica pendente.")
+        return
+
+    st.dataframe(
+        [_riga_notifica(n) for n in righe],
+        column_order=["id", "tipo", "paziente", "messaggio"],
+        hide_index=True,
+    )
+    if len(righe) == PAGE_SIZE:
+        st.caption("Altri risultati nella pagina successiva.")
 
-                    msg = (n.get("messaggio") or "").strip()
 
-                    prefix = "Appuntamento confermato per "
-                    if msg.startswith(prefix):
-                        tail = msg[len(prefix):].strip().rstrip(".")  # es: "13/01/2026 16:00"
-                        parts = tail.split()
-                        if len(parts) >= 2:
-                            d, t = parts[0], parts[1]
-                            msg = f"Appuntamento confermato per il {d} h {t}."
 
-                    st.write(f"[{n['id']}] **{n['tipo']}** | Paziente: **{paz}** - {msg}")
+# Navigazione: viene eseguita (e scarica dati) solo la pagina attiva
 
-        except PermissionError as e:
-            st.session_state["auth_error"] = str(e)
-            st.error("Sessione non valida. Premi Logout e rifai login.")
-        except Exception as e:
-            st.error(f"Errore notifiche: {e}")
+st.title("Sistema Studio Medico (API REST + JWT + Streamlit)")
+
+pagina = st.navigation(
+    [
+        st.Page(pagina_prenotazioni, title="Prenotazioni", url_path="prenotazioni", default=True),
+        st.Page(pagina_agenda, title="Agenda Medico", url_path="agenda"),
+        st.Page(pagina_pazienti, title="Pazienti", url_path="pazienti"),
+        st.Page(pagina_notifiche, title="Notifiche", url_path="notifiche"),
+    ]
+)
+pagina.run()